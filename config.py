@@ -7,12 +7,16 @@ RAW_DATA_DIRECTORY = DATA_DIRECTORY / 'raw'
 PREP_DATA_DIRECTORY = DATA_DIRECTORY / 'preprocessed'
 PROC_DATA_DIRECTORY = DATA_DIRECTORY / 'processed'
 PLOT_DATA_DIRECTORY = DATA_DIRECTORY / 'plots'
+SOLAR_GEOMETRY_DIRECTORY = DATA_DIRECTORY / 'solar_geometry'
+VALID_SPANS_DIRECTORY = DATA_DIRECTORY / 'valid_spans'
+TERRAIN_DIRECTORY = DATA_DIRECTORY / 'terrain'
 
 # Dataviz directory.
 DATAVIZ_DIRECTORY = Path('report/figures')
 
 # Special files.
 NIGERIA_SHAPEFILE = DATA_DIRECTORY / 'nigeria_shapefile/gadm36_NGA_0.shp'
+EPHEMERIS_TABLE = DATA_DIRECTORY / 'ephemeris/sun_1980_2030.npy'
 
 # DHS.
 HR_COLS = ['hv001', 'hv206'] # cluster_number, has_electricity
@@ -0,0 +1,16 @@
+import time
+
+from config import EPHEMERIS_TABLE
+from src.spa import build_ephemeris_table
+from src.feature_engineering import warm_up_kernels
+
+
+# Compile the numba kernels into the on-disk cache (and build the ephemeris
+# table) once, so that workers running 02_clear_sky_irradiance.py load them
+# instead of paying JIT compilation at startup. Run it again after changing a
+# kernel, or set NUMBA_CACHE_DIR to share the cache between machines.
+start = time.perf_counter()
+if not EPHEMERIS_TABLE.exists():
+    build_ephemeris_table()
+warm_up_kernels()
+print(f'Kernels compiled and cached in {time.perf_counter()-start:.1f}s')
@@ -1,106 +1,16 @@
 from pathlib import Path
 
 import numpy as np
-import rasterio as rio
-from numba import njit, jit, prange
 from tqdm import tqdm
 
-from config import DATA_DIRECTORY, PROC_DATA_DIRECTORY
+from config import PROC_DATA_DIRECTORY, SOLAR_GEOMETRY_DIRECTORY
 from src.utils import *
 from src import datasets
-from src.spa import solar_position
-from src.feature_engineering import calc_shadow_mask, clear_sky_irradiance
-
-
-def _dem_array(stepsize):
-    """TBA.
-    """
-    nga_elevation = datasets.load_elevation()
-    n_rows, n_cols = nga_elevation.meta['height'], nga_elevation.meta['width']
-
-    rows = np.arange(int((stepsize-1)/2), int(n_rows+1), step=stepsize, dtype=np.int32)
-    cols = np.arange(int((stepsize-1)/2), int(n_cols+1), step=stepsize, dtype=np.int32)
-    
-    n_rows, n_cols = len(rows), len(cols)
-    rows, cols = np.meshgrid(rows, cols, copy=False, indexing='ij')
-    
-    print('Creating DEM array, this might take a while.')
-    
-    lons, lats = nga_elevation.xy(cols.ravel(), rows.ravel())
-    elevs = nga_elevation.read(1)[rows, cols]
-
-    dem_array = np.zeros((n_rows, n_cols, 3))
-    dem_array[:, :, 0] = np.array(lons).reshape((n_rows, n_cols))
-    dem_array[:, :, 1] = np.array(lats).reshape((n_rows, n_cols))
-    dem_array[:, :, 2] = elevs
-    np.save(DATA_DIRECTORY / 'dem_array', dem_array, allow_pickle=False)
-
-
-def solar_position_array(year, month, day, hour, create_solar_pos_array=False, create_dem_array=False, stepsize=1):
-    """TBA.
-    """
-    if not (DATA_DIRECTORY / 'dem_array.npy').exists():
-        print("DEM array doesn't exist.")
-        _dem_array(stepsize)
-    elif create_dem_array:
-        print("DEM array exists, overwriting.")
-        _dem_array(stepsize)
-    if create_solar_pos_array:
-        dem_array = np.load(DATA_DIRECTORY / 'dem_array.npy')
-        rows, cols = dem_array.shape[0], dem_array.shape[1]
-        solar_pos_array = np.zeros((rows, cols, 3))
-
-        lons = dem_array[:, :, 0].ravel()
-        lats = dem_array[:, :, 1].ravel()
-        elevs = dem_array[:, :, 2].ravel()
-
-        elevations, azimuths, aois = _solar_position_array(year, month, day, hour, lons, lats, elevs)
-        solar_pos_array[:, :, 0] = elevations.reshape((rows, cols))
-        solar_pos_array[:, :, 1] = azimuths.reshape((rows, cols))
-        solar_pos_array[:, :, 2] = aois.reshape((rows, cols))
-
-        np.save(DATA_DIRECTORY / 'solar_position_array', solar_pos_array, allow_pickle=False)
-        return solar_pos_array
-    elif (DATA_DIRECTORY / 'solar_position_array.npy').exists():
-        return np.load(DATA_DIRECTORY / 'solar_position_array.npy')
-
-
-@jit(nopython=True)
-def angle_of_incidence(sol_elev, sol_a, arr_t=0.10471975511965978, arr_a=np.pi):
-    """TBA.
-    """
-    sol_z = np.pi/2 - sol_elev
-    aoi = np.arccos(np.cos(sol_z)*np.cos(arr_t)+np.sin(sol_z)*np.sin(arr_t)*np.cos(sol_a-arr_a))
-    if 0 <= aoi <= np.pi/4:
-        return aoi
-    else:
-        return np.pi/4
-
-
-@njit(parallel=True)
-def _solar_position_array(year, month, day, hour, lons, lats, elevs):
-    """TBA.
-    """
-    elevations = np.zeros(lons.shape)
-    azimuths = np.zeros(lons.shape)
-    aois = np.zeros(lons.shape)
-
-    for i in prange(len(lons)):        
-        cur_lon, cur_lat, cur_elev = lons[i], lats[i], elevs[i]
-        
-        elev_angle, azimuth = solar_position(
-            cur_lat,
-            cur_lon,
-            cur_elev,
-            year,
-            month,
-            day,
-            hour
-        )
-        elevations[i] = elev_angle
-        azimuths[i] = azimuth
-        aois[i] = angle_of_incidence(elev_angle, azimuth)
-    return elevations, azimuths, aois
+from src.spa import sun_ephemeris_array
+from src.feature_engineering import clear_sky_irradiance_windows, lattice_indices, solar_geometry,\
+    solar_lattice_stepsize, clear_sky_aggregates_windows, AGGREGATES,\
+    clear_sky_orientation_windows, slope_aspect_rasters, clear_sky_uncertainty_windows,\
+    sky_view_factor_raster
 
 
 start_year = 2014
@@ -110,48 +20,285 @@ months = [i for i in range(1, 13)]
 days_per_month = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
 hours = [9, 12]
 
+# Maximum angular error (radians) of the interpolated solar geometry.
+max_angular_error = 1e-4
+
+# Reuse solar geometry from earlier runs, set to None to keep it in memory only.
+solar_geometry_cache = SOLAR_GEOMETRY_DIRECTORY
+
+# Peak memory of the windowed clear sky computation, whatever the DEM size.
+max_memory = 2*1024**3
+
+# Monthly, seasonal and yearly means are accumulated in one pass into
+# PROC_DATA_DIRECTORY/tmy/<year>, set to True to also write the rasters of
+# every day and hour, which 03_solar_irradiance_monthly_averages.py and
+# 04_tmy.py average again into the same monthly rasters.
+save_hourly_rasters = False
+
+# Candidate panel tilts and azimuths (eastward from north) of the optimal
+# orientation of every pixel over the year, set to None to skip the sweep,
+# e.g. np.radians(np.arange(0, 31, 2)) and np.radians(np.arange(90, 271, 15)).
+orientation_tilts = None
+orientation_azimuths = None
+
+# Bands of the hourly rasters, see COMPONENTS. The monthly averages of 03 and
+# 04 read the first band, so 'poa' stays first.
+hourly_components = ['poa']
+
+# Monte Carlo samples per coarse cell of the mean and quantile rasters written
+# next to the daytime hourly rasters, set to None to skip them.
+uncertainty_samples = None
+
+# Put the panels on the terrain slope and aspect instead of the fixed array
+# plane, for the hourly rasters, the means and the gain of the optimal
+# orientation.
+terrain_aware = False
+
+# Let the surrounding terrain hide part of the diffuse sky, from the sky view
+# factor of every pixel, for the hourly rasters, the means and the optimal
+# orientation.
+terrain_sky_view = False
+
 nga_elevation = datasets.load_elevation()
+nga_shape = (nga_elevation.height, nga_elevation.width)
+if terrain_aware:
+    nga_slope, nga_aspect = slope_aspect_rasters(nga_elevation, max_memory=max_memory)
+else:
+    nga_slope, nga_aspect = None, None
+nga_sky_view = sky_view_factor_raster(nga_elevation, max_memory=max_memory) if terrain_sky_view else None
+nga_lons, nga_lats = coordinate_axes(
+    nga_elevation.transform, nga_elevation.height, nga_elevation.width
+)
+
+# Pick the solar lattice from the equinoxes and solstices of the first year,
+# on every stride-th pixel of the DEM so that it is never read whole.
+n_hours = len(hours)
+sample_days = [(3, 20), (6, 21), (9, 22), (12, 21)]
+stride = 8
+sample_rows = np.arange(0, nga_shape[0], stride)
+sample_cols = np.arange(0, nga_shape[1], stride)
+sample_stepsize, lattice_errors = solar_lattice_stepsize(
+    sun_ephemeris_array(
+        np.full(len(sample_days)*n_hours, start_year),
+        np.repeat([month for month, _ in sample_days], n_hours),
+        np.repeat([day for _, day in sample_days], n_hours),
+        np.tile(np.array(hours, dtype=np.float64), len(sample_days))
+    ),
+    nga_lons[sample_cols],
+    nga_lats[sample_rows],
+    read_pixels(nga_elevation, sample_rows, sample_cols),
+    max_error=max_angular_error
+)
+stepsize = sample_stepsize*stride
+print(f'Solar lattice stepsize {stepsize}, max error vs full-resolution SPA (rad):', lattice_errors)
+elev_rows = lattice_indices(nga_shape[0], stepsize)
+elev_cols = lattice_indices(nga_shape[1], stepsize)
+
+# The solar geometry only needs the DEM at the lattice nodes.
+lattice_dem = read_pixels(nga_elevation, elev_rows, elev_cols)
+lattice_rows = np.arange(len(elev_rows))
+lattice_cols = np.arange(len(elev_cols))
+
+# DEM pixel to coarse grid lookups, the CAMS and Meteosat grids being the same
+# at every timestep.
+nga_coloz = datasets.load_coloz(start_year, months[0], hours[0])
+nga_albedo = datasets.load_albedo(start_year, months[0], 1)
+cams_rows, cams_cols = grid_index_maps(
+    nga_elevation.transform, *nga_shape, nga_coloz.transform, nga_coloz.height, nga_coloz.width
+)
+meteosat_rows, meteosat_cols = grid_index_maps(
+    nga_elevation.transform, *nga_shape, nga_albedo.transform, nga_albedo.height, nga_albedo.width
+)
 
 pbar = tqdm(total=(end_year-start_year+1)*sum(days_per_month)*len(hours))
 for year in range(start_year, end_year+1):
+    # Every timestep of the year.
+    dates = list()
     for month in months:
         days = days_per_month[month-1]
         if year % 4 == 0 and month == 2:
             days += 1
-        for day in range(1, days+1):
-            for hour in hours:
-                ### Calculate elevation angle and azimuth
-                solar_pos = solar_position_array(year, month, day, hour, create_solar_pos_array=True)
-
-
-
-                nga_coloz = datasets.load_coloz(year, month, hour)
-                nga_colwv = datasets.load_colwv(year, month, hour)
-                nga_aod = datasets.load_aod(year, month, hour)
-                nga_albedo = datasets.load_albedo(year, month, day)
-                nga_cloud_cover = datasets.load_cloud_cover(year, month, day, hour)
-
-                clear_sky_irr = clear_sky_irradiance(
-                    solar_pos[:, :, 0],
-                    solar_pos[:, :, 2],
-                    nga_elevation.read(1),
-                    nga_coloz.read(1),
-                    nga_colwv.read(1),
-                    nga_aod.read(1),
-                    nga_albedo.read(1),
-                    nga_cloud_cover.read(1),
+        dates += [(month, day) for day in range(1, days+1)]
+    n_times = len(dates)*n_hours
+    years_t = np.full(n_times, year)
+    months_t = np.repeat([month for month, _ in dates], n_hours)
+    days_t = np.repeat([day for _, day in dates], n_hours)
+    hours_t = np.tile(np.array(hours, dtype=np.float64), len(dates))
+
+    ### Calculate elevation angle and azimuth for all timesteps at once
+    elevations, azimuths, aois = solar_geometry(
+        years_t,
+        months_t,
+        days_t,
+        hours_t,
+        nga_lons[elev_cols],
+        nga_lats[elev_rows],
+        lattice_dem,
+        lattice_rows,
+        lattice_cols,
+        cache_directory=solar_geometry_cache
+    )
+
+    # Coarse inputs of every timestep, None at night where they are unused.
+    inputs = {'coloz': [], 'colwv': [], 'aod': [], 'albedo': [], 'cloud_cover': []}
+    for t in range(n_times):
+        month, day, hour = months_t[t], days_t[t], hours[t % n_hours]
+        str_month = month_to_string(month)
+        str_day = day_to_string(day)
+        str_hour = hour_to_string(hour)
+        path = Path(f'/media/hdd1/data/processed/{year}/{str_month}/')
+        filename = f'{str_day}_{str_hour}.tif'
+
+        # Interpolation never exceeds the lattice, so the sun is down everywhere.
+        if elevations[t].max() <= 0:
+            for stack in inputs.values():
+                stack.append(None)
+            if save_hourly_rasters:
+                path.mkdir(parents=True, exist_ok=True)
+                map_raster_windows(
+                    lambda window, dem: np.broadcast_to(
+                        np.where(dem == -32768, -32768.0, 0.0), (len(hourly_components),) + dem.shape
+                    ),
+                    nga_elevation,
+                    path / filename,
+                    max_memory,
+                    band_names=hourly_components
+                )
+            pbar.update(1)
+            continue
+
+        nga_coloz = datasets.load_coloz(year, month, hour)
+        nga_colwv = datasets.load_colwv(year, month, hour)
+        nga_aod = datasets.load_aod(year, month, hour)
+        nga_albedo = datasets.load_albedo(year, month, day)
+        nga_cloud_cover = datasets.load_cloud_cover(year, month, day, hour)
+        inputs['coloz'].append(nga_coloz.read(1))
+        inputs['colwv'].append(nga_colwv.read(1))
+        inputs['aod'].append(nga_aod.read(1))
+        inputs['albedo'].append(nga_albedo.read(1))
+        inputs['cloud_cover'].append(nga_cloud_cover.read(1))
+
+        if save_hourly_rasters:
+            path.mkdir(parents=True, exist_ok=True)
+            clear_sky_irradiance_windows(
+                nga_elevation,
+                path / filename,
+                elevations[t],
+                aois[t],
+                elev_rows,
+                elev_cols,
+                inputs['coloz'][t],
+                inputs['colwv'][t],
+                inputs['aod'][t],
+                inputs['albedo'][t],
+                inputs['cloud_cover'][t],
+                cams_rows,
+                cams_cols,
+                meteosat_rows,
+                meteosat_cols,
+                year,
+                month,
+                day,
+                max_memory=max_memory,
+                components=hourly_components,
+                azis=azimuths[t],
+                slope=nga_slope,
+                aspect=nga_aspect,
+                sky_view=nga_sky_view
+            )
+            if uncertainty_samples is not None:
+                clear_sky_uncertainty_windows(
+                    nga_elevation,
+                    path / f'{str_day}_{str_hour}_uncertainty.tif',
+                    elevations[t],
+                    aois[t],
+                    elev_rows,
+                    elev_cols,
+                    inputs['coloz'][t],
+                    inputs['colwv'][t],
+                    inputs['aod'][t],
+                    inputs['albedo'][t],
+                    inputs['cloud_cover'][t],
+                    cams_rows,
+                    cams_cols,
+                    meteosat_rows,
+                    meteosat_cols,
                     year,
                     month,
-                    day
+                    day,
+                    n_samples=uncertainty_samples,
+                    max_memory=max_memory,
+                    azis=azimuths[t],
+                    slope=nga_slope,
+                    aspect=nga_aspect,
+                    sky_view=nga_sky_view
                 )
-                str_month = month_to_string(month)
-                str_day = day_to_string(day)
-                str_hour = hour_to_string(hour)
-                path = Path(f'/media/hdd1/data/processed/{year}/{str_month}/')
-                path.mkdir(parents=True, exist_ok=True)
-                filename = f'{str_day}_{str_hour}.tif'
-                save_array_to_geotiff(clear_sky_irr, path / filename, nga_elevation.meta)
-                pbar.update(1)
-pbar.close()
+        pbar.update(1)
+
+    # Without a daytime step there is no input to stack, and nothing to average.
+    if all(array is None for array in inputs['coloz']):
+        continue
 
+    # Stack the inputs, night timesteps only need the right shape.
+    for name, stack in inputs.items():
+        day_array = next(array for array in stack if array is not None)
+        inputs[name] = np.stack([np.zeros_like(day_array) if array is None else array for array in stack])
 
+    ### Accumulate the means of every month, season and the year in one pass
+    tmy_path = PROC_DATA_DIRECTORY / 'tmy' / str(year)
+    tmy_path.mkdir(parents=True, exist_ok=True)
+    clear_sky_aggregates_windows(
+        nga_elevation,
+        [tmy_path / f'{name}.tif' for name in AGGREGATES],
+        elevations,
+        aois,
+        elev_rows,
+        elev_cols,
+        inputs['coloz'],
+        inputs['colwv'],
+        inputs['aod'],
+        inputs['albedo'],
+        inputs['cloud_cover'],
+        cams_rows,
+        cams_cols,
+        meteosat_rows,
+        meteosat_cols,
+        years_t,
+        months_t,
+        days_t,
+        max_memory=max_memory,
+        azis=azimuths,
+        slope=nga_slope,
+        aspect=nga_aspect,
+        sky_view=nga_sky_view
+    )
+
+    ### Optimal panel orientation of every pixel over the year
+    if orientation_tilts is not None:
+        clear_sky_orientation_windows(
+            nga_elevation,
+            tmy_path / 'orientation.tif',
+            elevations,
+            azimuths,
+            elev_rows,
+            elev_cols,
+            inputs['coloz'],
+            inputs['colwv'],
+            inputs['aod'],
+            inputs['albedo'],
+            inputs['cloud_cover'],
+            cams_rows,
+            cams_cols,
+            meteosat_rows,
+            meteosat_cols,
+            years_t,
+            months_t,
+            days_t,
+            orientation_tilts,
+            orientation_azimuths,
+            max_memory=max_memory,
+            slope=nga_slope,
+            aspect=nga_aspect,
+            sky_view=nga_sky_view
+        )
+pbar.close()
@@ -0,0 +1,54 @@
+"""Cost of the horizon angle database and of the shadow masks looked up in
+it, compared with sweeping the DEM along every sun azimuth.
+
+The horizons of a synthetic DEM the size of a 2048 x 2048 window of the 1
+arc second grid, with smooth steep ridges and a strip without data, are
+built once for HORIZON_SECTORS azimuths. Masks are then looked up for suns
+on and between the sectors, and compared with :func:`calc_shadow_mask` on
+the same sun. Both follow the sun over the interpolated terrain, so on the
+sectors they differ only where the sun is within the rounding of the
+stored angles from the horizon, or where the points that decide a pixel
+fall on other lines. Between sectors the lookup interpolates the horizon.
+"""
+import time
+
+import numpy as np
+
+from src.feature_engineering import calc_shadow_mask, horizon_angles, horizon_shadow_mask, dem_spans,\
+    HORIZON_SECTORS
+
+
+def _best_time(func, *args, repeat=3):
+    # Best of `repeat` runs after one run to compile.
+    result = func(*args)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+### Synthetic DEM
+n_rows, n_cols = 2048, 2048
+x, y = np.ogrid[:n_rows, :n_cols]
+dem = (400 + 250*np.sin(x/37)*np.cos(y/53) + 150*np.cos((x + 2*y)/29)).astype(np.int16)
+dem[:, :n_cols//10] = -32768
+spans = dem_spans(dem)
+valid = dem != -32768
+print(f'DEM {n_rows} x {n_cols}, {valid.sum()} valid pixels')
+
+horizons, build = _best_time(horizon_angles, dem, HORIZON_SECTORS, repeat=1)
+print(f'{HORIZON_SECTORS} sectors built in {build:.1f} s, {horizons.nbytes/2**20:.0f} MiB')
+
+sector = 360 / HORIZON_SECTORS
+for elevation in (0.15, 0.4):
+    for azimuth in (0, 30, 100, 200, 300, 30 + sector/2, 100 + sector/3):
+        elevs = np.full((1, 1), elevation)
+        azis = np.full((1, 1), np.radians(azimuth))
+        cast, casting = _best_time(calc_shadow_mask, dem, spans, elevs, azis)
+        looked_up, lookup = _best_time(horizon_shadow_mask, horizons, elevs, azis)
+        print(
+            f'elevation {elevation:.2f} azimuth {azimuth:5.1f}: shadow {cast[valid].mean():.3f}, '
+            f'differ {(cast != looked_up)[valid].mean():.4f}, casting {casting:.3f} s, lookup {lookup:.3f} s'
+        )
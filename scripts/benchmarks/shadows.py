@@ -0,0 +1,147 @@
+"""Cost of the horizon sweep of :func:`calc_shadow_mask`, compared with
+casting a ray from every pixel as it did before, building the Bresenham line
+of every pixel up to the end of its shadow and walking it.
+
+Both run on synthetic DEMs the size of a 2048 x 2048 window of the 1 arc
+second grid with a strip without data, for a low and a moderate sun: rough
+terrain, with 20 m of noise between pixels and steep blocks rising from it,
+and smooth steep ridges. Along the rows and columns the rays follow the
+same lines, so the masks must be equal. At the other azimuths the lines of
+the sweep follow the sun over the interpolated terrain where the Bresenham
+lines step sideways toward the end of every ray, and the share of the
+pixels where the masks differ is reported.
+
+Last, :func:`shadow_mask` is timed on one thread and on all of them, for the
+parallel speedup of its groups of lines and tiles, and
+:func:`calc_shadow_mask` with and without a max-elevation pyramid to enter
+the halos of its blocks with.
+"""
+import time
+
+import numpy as np
+from numba import njit, get_num_threads, set_num_threads
+
+from src.feature_engineering import calc_shadow_mask, shadow_mask, max_pyramid, dem_spans
+from src.feature_engineering._elevation import get_line
+
+
+@njit
+def _bresenham_cast(dem, shadow_mask, x, y, cur_altitude, cur_elevation, cur_azimuth):
+    n_rows, n_cols = dem.shape
+    shadow_dist = cur_altitude / np.tan(cur_elevation)
+    if 0 <= cur_azimuth < np.pi/2:
+        x_end = x + int(np.floor(shadow_dist * np.cos(cur_azimuth) / 30))
+        y_end = y - int(np.floor(shadow_dist * np.sin(cur_azimuth) / 30))
+    elif np.pi/2 <= cur_azimuth < np.pi:
+        x_end = x - int(np.floor(shadow_dist * np.sin(cur_azimuth-np.pi/2) / 30))
+        y_end = y - int(np.floor(shadow_dist * np.cos(cur_azimuth-np.pi/2) / 30))
+    elif np.pi <= cur_azimuth < 3*np.pi/2:
+        x_end = x - int(np.floor(shadow_dist * np.cos(cur_azimuth-np.pi) / 30))
+        y_end = y + int(np.floor(shadow_dist * np.sin(cur_azimuth-np.pi) / 30))
+    else:
+        x_end = x + int(np.floor(shadow_dist * np.sin(cur_azimuth-(3*np.pi/2)) / 30))
+        y_end = y + int(np.floor(shadow_dist * np.cos(cur_azimuth-(3*np.pi/2)) / 30))
+    x_end = min(max(x_end, 0), n_rows-1)
+    y_end = min(max(y_end, 0), n_cols-1)
+    for shadow_square in get_line((x, y), (x_end, y_end))[1:]:
+        dist_to_cur_square = np.sqrt((x-shadow_square[0])**2 + (y-shadow_square[1])**2)
+        if dem[shadow_square] <= cur_altitude - 30 * dist_to_cur_square * np.tan(cur_elevation):
+            shadow_mask[shadow_square] = 1
+        else:
+            break
+
+
+@njit
+def _ray_casting(dem, spans, elevs, azis):
+    stepsize = np.round(dem.shape[0] / elevs.shape[0])
+    shadow_mask = np.zeros(dem.shape, dtype=np.bool_)
+    row_ptr, starts, stops = spans
+    for x in range(dem.shape[0]):
+        for span in range(row_ptr[x], row_ptr[x+1]):
+            for y in range(starts[span], stops[span]):
+                x_ = int(x/stepsize)
+                y_ = int(y/stepsize)
+                _bresenham_cast(dem, shadow_mask, x, y, dem[x, y], elevs[x_, y_], azis[x_, y_])
+    return shadow_mask
+
+
+def _best_time(func, *args, repeat=3):
+    # Best of `repeat` runs after one run to compile.
+    result = func(*args)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+### Synthetic DEMs
+rng = np.random.default_rng(0)
+n_rows, n_cols = 2048, 2048
+x, y = np.ogrid[:n_rows, :n_cols]
+rough = 300 + 200*np.sin(x/97)*np.cos(y/131) + rng.integers(0, 20, (n_rows, n_cols))
+for row, col in rng.integers(100, 1900, (20, 2)):
+    rough[row:row+40, col:col+40] += 300
+steep = 400 + 250*np.sin(x/37)*np.cos(y/53) + 150*np.cos((x + 2*y)/29)
+stepsize = 64
+
+for name, dem in (('rough', rough), ('steep', steep)):
+    dem = dem.astype(np.int16)
+    dem[:, :n_cols//10] = -32768
+    spans = dem_spans(dem)
+    valid = dem != -32768
+    print(f'{name} DEM {n_rows} x {n_cols}, {valid.sum()} valid pixels')
+
+    for elevation in (0.15, 0.4):
+        for azimuth in (0, 90, 180, 270, 30, 100, 200, 300):
+            elevs = np.full((n_rows // stepsize, n_cols // stepsize), elevation)
+            azis = np.full(elevs.shape, np.radians(azimuth))
+            before, before_time = _best_time(_ray_casting, dem, spans, elevs, azis, repeat=1)
+            after, after_time = _best_time(calc_shadow_mask, dem, spans, elevs, azis)
+            if azimuth % 90 == 0:
+                assert np.array_equal(before[valid], after[valid])
+            assert not after[~valid].any()
+            print(
+                f'  elevation {elevation:.2f} azimuth {azimuth:3d}: shadow {after[valid].mean():.3f}, '
+                f'differ {(before != after)[valid].mean():.4f}, '
+                f'{before_time:.2f} s / {after_time:.3f} s (line lists / sweep)'
+            )
+
+### Parallel speedup
+# shadow_mask on the steep DEM, the last above, on one thread and on all of them, and with
+# four times as many tiles as threads, cut along the sweep when a window
+# has too few groups of lines, which their halos cost.
+n_threads = get_num_threads()
+print(f'shadow_mask, threads: {n_threads}')
+for altitude in (6.0, 25.0):
+    for azimuth in (0.0, 135.0):
+        set_num_threads(1)
+        serial, serial_time = _best_time(shadow_mask, altitude, azimuth, dem, -32768, 1)
+        set_num_threads(n_threads)
+        parallel, parallel_time = _best_time(shadow_mask, altitude, azimuth, dem)
+        tiled, tiled_time = _best_time(shadow_mask, altitude, azimuth, dem, -32768, 4*n_threads)
+        assert np.array_equal(serial, parallel) and np.array_equal(serial, tiled)
+        print(
+            f'  altitude {altitude:4.1f} azimuth {azimuth:5.1f}: {serial_time:.3f} s on one thread, '
+            f'{parallel_time:.3f} s on {n_threads} (x{serial_time/parallel_time:.2f}), '
+            f'{tiled_time:.3f} s with {4*n_threads} tiles'
+        )
+
+### Max-elevation pyramid
+# calc_shadow_mask with a sun per block of 64 pixels, whose halos run up-sun
+# far past the block at a low sun, with and without the pyramid, and the
+# cost of building it.
+for name, dem in (('rough', rough), ('steep', steep)):
+    dem = dem.astype(np.int16)
+    dem[:, :n_cols//10] = -32768
+    spans = dem_spans(dem)
+    pyramid, pyramid_time = _best_time(max_pyramid, dem)
+    print(f'{name} DEM, max_pyramid {pyramid_time:.3f} s')
+    for elevation in (0.05, 0.15, 0.4):
+        elevs = np.full((n_rows // stepsize, n_cols // stepsize), elevation)
+        azis = np.full(elevs.shape, np.radians(135))
+        whole, whole_time = _best_time(calc_shadow_mask, dem, spans, elevs, azis)
+        skipped, skipped_time = _best_time(calc_shadow_mask, dem, spans, elevs, azis, 1, pyramid)
+        assert np.array_equal(whole, skipped)
+        print(f'  elevation {elevation:.2f}: {whole_time:.3f} s without the pyramid, {skipped_time:.3f} s with it')
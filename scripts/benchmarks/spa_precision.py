@@ -0,0 +1,100 @@
+"""Throughput and accuracy of the float32 per-pixel SPA stage.
+
+The ephemerides are computed in float64 relative to the 1980 epoch. The
+per-pixel stage runs in float32 and is compared with the same stage in float64
+for random timestamps between 1980 and 2030 and random pixels over Nigeria.
+"""
+import time
+
+import numpy as np
+from numba import njit, prange
+
+from src.spa import sun_ephemeris_array, topocentric_elevation_azimuth
+from src.feature_engineering import solar_position_array, lattice_indices
+
+
+@njit(parallel=True)
+def _pixel_stage(ephemerides, lat_rads, lon_rads, altitudes):
+    # Evaluate the per-pixel stage in the precision of the inputs.
+    n = len(lat_rads)
+    elevations = np.empty(n, dtype=lat_rads.dtype)
+    azimuths = np.empty(n, dtype=lat_rads.dtype)
+    for i in prange(n):
+        elevations[i], azimuths[i] = topocentric_elevation_azimuth(
+            lat_rads[i], lon_rads[i], altitudes[i],
+            ephemerides[i, 0], ephemerides[i, 1], ephemerides[i, 2]
+        )
+    return elevations, azimuths
+
+
+@njit(parallel=True)
+def _reference_solar_position_array(ephemerides, lons, lats, dem, rows, cols):
+    # float64 counterpart of solar_position_array.
+    n_times = ephemerides.shape[0]
+    elevations = np.empty((n_times, len(rows), len(cols)))
+    azimuths = np.empty((n_times, len(rows), len(cols)))
+    lat_rads = np.pi*lats[rows]/180
+    lon_rads = np.pi*lons[cols]/180
+    for i in prange(n_times*len(rows)):
+        t = i // len(rows)
+        x = i % len(rows)
+        for y in range(len(cols)):
+            elevations[t, x, y], azimuths[t, x, y] = topocentric_elevation_azimuth(
+                lat_rads[x], lon_rads[y], np.float64(dem[rows[x], cols[y]]),
+                ephemerides[t, 0], ephemerides[t, 1], ephemerides[t, 2]
+            )
+    return elevations, azimuths
+
+
+def _random_timestamps(rng, n, start='1980-01-01', end='2030-12-31'):
+    start = np.datetime64(start, 'm')
+    n_minutes = int((np.datetime64(end, 'm') - start) / np.timedelta64(1, 'm'))
+    timestamps = start + rng.integers(0, n_minutes, n).astype('timedelta64[m]')
+    years = timestamps.astype('datetime64[Y]').astype(np.int64) + 1970
+    months = timestamps.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    days = (timestamps.astype('datetime64[D]') - timestamps.astype('datetime64[M]')).astype(np.int64) + 1
+    hours = (timestamps - timestamps.astype('datetime64[D]')).astype(np.int64) / 60
+    return years, months, days, hours
+
+
+rng = np.random.default_rng(0)
+
+### Accuracy
+n_samples = 2_000_000
+years, months, days, hours = _random_timestamps(rng, n_samples)
+ephemerides = sun_ephemeris_array(years, months, days, hours)
+lat_rads = np.radians(rng.uniform(4.2, 13.9, n_samples))
+lon_rads = np.radians(rng.uniform(2.6, 14.7, n_samples))
+altitudes = rng.uniform(0, 2400, n_samples)
+
+ref_elevations, ref_azimuths = _pixel_stage(ephemerides, lat_rads, lon_rads, altitudes)
+elevations, azimuths = _pixel_stage(
+    ephemerides.astype(np.float32),
+    lat_rads.astype(np.float32),
+    lon_rads.astype(np.float32),
+    altitudes.astype(np.float32)
+)
+daylight = ref_elevations > 0
+elev_error = np.abs(elevations[daylight] - ref_elevations[daylight]).max()
+azi_error = (azimuths[daylight] - ref_azimuths[daylight] + np.pi) % (2*np.pi) - np.pi
+print(f'{daylight.sum()} daylight samples between 1980 and 2030')
+print(f'max elevation error: {elev_error:.3e} rad ({np.degrees(elev_error)*3600:.3f} arcsec)')
+print(f'max azimuth error:   {np.abs(azi_error).max():.3e} rad')
+
+### Throughput
+# The DEM grid of Nigeria at 1 arcsec, evaluated on a 1500x1500 lattice.
+n_rows, n_cols = 34639, 43230
+lons = 2.66833333333333 + (np.arange(n_cols) + 0.5) / 3600
+lats = 13.892222222222255 - (np.arange(n_rows) + 0.5) / 3600
+dem = rng.integers(0, 2400, (n_rows, n_cols), dtype=np.int16)
+rows = lattice_indices(n_rows, n_rows // 1500)
+cols = lattice_indices(n_cols, n_cols // 1500)
+ephemerides = sun_ephemeris_array(*_random_timestamps(rng, 8))
+
+for name, kernel in [('float32', solar_position_array), ('float64', _reference_solar_position_array)]:
+    kernel(ephemerides[:1], lons, lats, dem, rows[:2], cols[:2]) # compile
+    start = time.perf_counter()
+    kernel(ephemerides, lons, lats, dem, rows, cols)
+    elapsed = time.perf_counter() - start
+    n_pixels = len(ephemerides) * len(rows) * len(cols)
+    print(f'{name}: {n_pixels / elapsed / 1e6:.2f} Mpixel/s')
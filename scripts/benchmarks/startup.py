@@ -0,0 +1,39 @@
+"""Cold start of the clear sky kernels, with and without the numba cache.
+
+Each run is a fresh interpreter that imports the kernels and calls them once
+through :func:`src.feature_engineering.warm_up_kernels`. The first run
+compiles into an empty NUMBA_CACHE_DIR and the next runs load from it.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+
+_WORKER = """
+import time
+start = time.perf_counter()
+from src.feature_engineering import warm_up_kernels
+imported = time.perf_counter()
+warm_up_kernels()
+called = time.perf_counter()
+print(imported-start, called-imported)
+"""
+
+
+def _startup(cache_directory):
+    env = dict(os.environ)
+    env['NUMBA_CACHE_DIR'] = cache_directory
+    env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+    output = subprocess.run(
+        [sys.executable, '-c', _WORKER], env=env, check=True, capture_output=True, text=True
+    ).stdout
+    import_time, call_time = map(float, output.split()[-2:])
+    return import_time, call_time
+
+
+with tempfile.TemporaryDirectory() as cache_directory:
+    for label in ['cold (compiling)', 'cached', 'cached']:
+        import_time, call_time = _startup(cache_directory)
+        print(f'{label:>16}: import {import_time:6.2f}s, first calls {call_time:6.2f}s, '
+              f'total {import_time+call_time:6.2f}s')
@@ -0,0 +1,107 @@
+"""Throughput of the clear sky kernel in row-major order, compared with the
+column-major traversal it used before. The kernel visits the pixels in
+L2-sized tiles. The shadow kernels sweep lines along the sun azimuth
+instead, see scripts/benchmarks/shadows.py.
+
+The kernel runs on one window of a synthetic DEM on the 1 arc second grid over
+Nigeria, of the size the windowed drivers cut the grid into with their default
+memory budget, with smooth random terrain and the sun high in the sky. The
+column-major reference below shares the per-pixel work of the kernel and
+only differs in the order it visits the pixels in. Throughput is reported in
+pixels per second per core, along with the time it projects for the whole
+grid.
+"""
+import time
+
+import numpy as np
+from numba import njit, prange, get_num_threads
+
+from src.utils import latitude_longitude_bounds, raster_windows, L2_CACHE_SIZE
+from src.feature_engineering import clear_sky_irradiance, dem_spans,\
+    lattice_indices, lattice_weights, bilinear, clip_angle_of_incidence
+from src.feature_engineering._clear_sky import _pixel_irradiance, total_solar_irradiance, radius_correction,\
+    TILE_SIZE, SUMS_TILE_SIZE
+
+
+@njit(parallel=True)
+def _column_major_clear_sky_irradiance(elevs, aois, elev_rows, elev_cols, dem, ozs, wvs, aods, albedos, clouds, cams_rows, cams_cols, meteosat_rows, meteosat_cols, tsi):
+    irradiance = np.full(dem.shape, -32768.0)
+    n_rows, n_cols = dem.shape
+    row_lower, row_weights = lattice_weights(elev_rows, n_rows)
+    col_lower, col_weights = lattice_weights(elev_cols, n_cols)
+    for y in prange(n_cols):
+        for x in range(n_rows):
+            if dem[x, y] == -32768:
+                continue
+            cur_elev = bilinear(elevs, row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+            if cur_elev <= 0:
+                irradiance[x, y] = 0
+                continue
+            aoi = clip_angle_of_incidence(
+                bilinear(aois, row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+            )
+            x_trans, y_trans = cams_rows[x], cams_cols[y]
+            x_alb, y_alb = meteosat_rows[x], meteosat_cols[y]
+            irradiance[x, y] = _pixel_irradiance(
+                tsi, cur_elev, aoi, dem[x, y], ozs[x_trans, y_trans], wvs[x_trans, y_trans],
+                aods[x_trans, y_trans], albedos[x_alb, y_alb], clouds[x_alb, y_alb]
+            )
+    return irradiance
+
+
+def _throughput(func, n_pixels, *args, repeat=1):
+    # Best of `repeat` runs after one run to compile, in pixels/s/core.
+    result = func(*args)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, n_pixels / best / get_num_threads()
+
+
+### Synthetic DEM
+(lat_min, lat_max), (lon_min, lon_max) = latitude_longitude_bounds('nigeria')
+grid_rows = 3600*(int(lat_max[1:]) - int(lat_min[1:]) + 1)
+grid_cols = 3600*(int(lon_max[1:]) - int(lon_min[1:]) + 1)
+window = next(raster_windows(grid_rows, grid_cols, 2*1024**3 // 16))
+window_rows, window_cols = window.height, window.width
+
+rng = np.random.default_rng(0)
+x, y = np.ogrid[:window_rows, :window_cols]
+dem = 300 + 200*np.sin(x/97)*np.cos(y/131) + rng.integers(0, 20, (window_rows, window_cols))
+dem = dem.astype(np.int16)
+dem[:, :window_cols//10] = -32768
+n_pixels = dem.size
+print(f'Nigeria grid {grid_rows} x {grid_cols}, window {window_rows} x {window_cols}, {get_num_threads()} threads')
+print(f'L2 cache {L2_CACHE_SIZE // 1024} KiB, tile sides: clear sky {TILE_SIZE}, sums {SUMS_TILE_SIZE}')
+
+### Inputs
+stepsize = 64
+elev_rows, elev_cols = lattice_indices(window_rows, stepsize), lattice_indices(window_cols, stepsize)
+elevs = rng.uniform(0.9, 1.1, (len(elev_rows), len(elev_cols)))
+aois = rng.uniform(0.2, 0.4, elevs.shape)
+cams_rows, cams_cols = np.arange(window_rows) // 2700, np.arange(window_cols) // 2700
+meteosat_rows, meteosat_cols = np.arange(window_rows) // 200, np.arange(window_cols) // 200
+cams = rng.uniform(0.01, 0.5, (cams_rows[-1] + 1, cams_cols[-1] + 1))
+meteosat = rng.uniform(0, 0.3, (meteosat_rows[-1] + 1, meteosat_cols[-1] + 1)).astype(np.float32)
+spans = dem_spans(dem)
+tsi = total_solar_irradiance(radius_correction(2014, 6, 21))
+clear_sky_args = (
+    elev_rows, elev_cols, dem, cams, cams*50, cams, meteosat, meteosat,
+    cams_rows, cams_cols, meteosat_rows, meteosat_cols
+)
+
+### Clear sky irradiance
+before, before_rate = _throughput(
+    _column_major_clear_sky_irradiance, n_pixels, elevs, aois, *clear_sky_args, tsi
+)
+after, after_rate = _throughput(
+    clear_sky_irradiance, n_pixels, elevs, aois, *clear_sky_args[:3], spans, *clear_sky_args[3:],
+    2014, 6, 21
+)
+assert np.allclose(before, after, rtol=1e-3, equal_nan=True)
+del before, after
+print('clear_sky_irradiance')
+print(f'  column-major {before_rate/1e6:.2f} Mpx/s/core, row-major tiles {after_rate/1e6:.2f} Mpx/s/core')
+print(f'  whole grid {grid_rows*grid_cols/after_rate/get_num_threads()/60:.1f} min')
@@ -0,0 +1,82 @@
+"""Cost of the batched Monte Carlo uncertainty of the clear sky irradiance,
+compared with running the kernel once per sample.
+
+Both run on a synthetic DEM the size of a 2048 x 2048 window of the 1 arc
+second grid, with inputs in the range of the CAMS and Meteosat fields over
+Nigeria. The reference runs :func:`clear_sky_irradiance` on every sample set
+and takes the mean and quantiles of the stack with numpy. It keeps the
+Angstrom exponent fixed, so the batched kernel is checked against it with
+no Angstrom uncertainty, up to the interpolation of its column transmittance
+tables, and timed with it.
+"""
+import time
+
+import numpy as np
+
+from src.feature_engineering import clear_sky_irradiance, clear_sky_uncertainty, input_samples, dem_spans,\
+    lattice_indices, INPUT_UNCERTAINTY, UNCERTAINTY_QUANTILES
+
+
+def _best_time(func, *args, repeat=3):
+    # Best of `repeat` runs after one run to compile.
+    result = func(*args)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def _reference(n_samples, samples, *args):
+    oz_samples, wv_samples, aod_samples, _, albedo_samples = samples
+    stack = np.stack([
+        clear_sky_irradiance(
+            *args[:6], np.ascontiguousarray(oz_samples[..., k]), np.ascontiguousarray(wv_samples[..., k]),
+            np.ascontiguousarray(aod_samples[..., k]), np.ascontiguousarray(albedo_samples[..., k]), *args[6:]
+        )
+        for k in range(n_samples)
+    ])
+    return np.concatenate([stack.mean(axis=0)[None], np.quantile(stack, UNCERTAINTY_QUANTILES, axis=0)])
+
+
+### Synthetic inputs
+rng = np.random.default_rng(0)
+n_rows, n_cols = 2048, 2048
+x, y = np.ogrid[:n_rows, :n_cols]
+dem = (300 + 200*np.sin(x/97)*np.cos(y/131) + rng.integers(0, 20, (n_rows, n_cols))).astype(np.int16)
+dem[:, :n_cols//10] = -32768
+spans = dem_spans(dem)
+
+stepsize = 64
+elev_rows, elev_cols = lattice_indices(n_rows, stepsize), lattice_indices(n_cols, stepsize)
+elevs = rng.uniform(0.9, 1.1, (len(elev_rows), len(elev_cols)))
+aois = rng.uniform(0.2, 0.4, elevs.shape)
+cams_rows, cams_cols = np.arange(n_rows) // 700, np.arange(n_cols) // 700
+meteosat_rows, meteosat_cols = np.arange(n_rows) // 200, np.arange(n_cols) // 200
+cams_shape = (cams_rows[-1] + 1, cams_cols[-1] + 1)
+meteosat_shape = (meteosat_rows[-1] + 1, meteosat_cols[-1] + 1)
+ozs = rng.uniform(0.005, 0.007, cams_shape)
+wvs = rng.uniform(10, 50, cams_shape)
+aods = rng.uniform(0.2, 1.0, cams_shape)
+albedos = rng.uniform(0.1, 0.3, meteosat_shape).astype(np.float32)
+clouds = rng.uniform(0, 0.3, meteosat_shape).astype(np.float32)
+geometry = (elevs, aois, elev_rows, elev_cols, dem, spans)
+grids = (clouds, cams_rows, cams_cols, meteosat_rows, meteosat_cols, 2014, 6, 21)
+quantiles = np.asarray(UNCERTAINTY_QUANTILES)
+out = np.empty((1 + len(quantiles),) + dem.shape)
+valid = dem != -32768
+print(f'DEM {n_rows} x {n_cols}, {valid.sum()} valid pixels')
+
+_, single = _best_time(clear_sky_irradiance, *geometry, ozs, wvs, aods, albedos, *grids)
+print(f'clear_sky_irradiance {single:.2f} s')
+fixed_angstrom = input_samples(ozs, wvs, aods, albedos, 32, {**INPUT_UNCERTAINTY, 'angstrom': 0}, 0)
+clear_sky_uncertainty(*geometry, *fixed_angstrom, *grids, quantiles, out)
+reference = _reference(32, fixed_angstrom, *geometry, *grids)
+assert np.allclose(out[:, valid], reference[:, valid], rtol=1e-5)
+del reference
+
+for n_samples in (8, 32, 128):
+    samples = input_samples(ozs, wvs, aods, albedos, n_samples, seed=0)
+    _, batched = _best_time(clear_sky_uncertainty, *geometry, *samples, *grids, quantiles, out)
+    print(f'K = {n_samples}: batched {batched:.2f} s, {batched/single:.1f} single runs')
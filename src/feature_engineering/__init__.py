@@ -1,3 +1,21 @@
-from ._elevation import shadows, calc_shadow_mask
+from ._elevation import shadows, calc_shadow_mask, slope_aspect, slope_aspect_windows,\
+    slope_aspect_rasters, TERRAIN_BANDS, horizon_angles, horizon_shadow_mask,\
+    horizon_windows, horizon_rasters, horizon_bands, HORIZON_SECTORS,\
+    sky_view_factor, sky_view_factor_windows, sky_view_factor_raster, SKY_VIEW_SECTORS,\
+    shadow_mask, shadow_mask_windows, max_pyramid, max_pyramid_rasters, PYRAMID_LEVELS
 from ._covariates import extract_circle
-from ._clear_sky import clear_sky_irradiance
+from ._clear_sky import clear_sky_irradiance, clear_sky_irradiance_windows,\
+    clear_sky_components, component_bands, COMPONENTS,\
+    clear_sky_irradiance_sums, clear_sky_aggregates_windows, aggregate_groups,\
+    AGGREGATES, transmittance_lut, clear_sky_orientation_sweep,\
+    clear_sky_orientation_windows, ORIENTATION_BANDS, clear_sky_uncertainty,\
+    clear_sky_uncertainty_windows, input_samples, uncertainty_bands,\
+    INPUT_UNCERTAINTY, UNCERTAINTY_QUANTILES, column_transmittance_lut
+from ._solar_position import angle_of_incidence, incidence_angle,\
+    clip_angle_of_incidence, lattice_indices, lattice_window, lattice_weights,\
+    bilinear, bilinear_angle, solar_position_array, sun_elevation_bound,\
+    solar_lattice_error, solar_lattice_stepsize, solar_geometry,\
+    save_solar_geometry, load_solar_geometry, daylight_times,\
+    daylight_quadrature
+from ._valid_pixels import mask_spans, dem_spans, window_spans, polygon_spans, valid_spans
+from ._warm_up import warm_up_kernels
@@ -1,8 +1,21 @@
 import numpy as np
 from numba import njit, jit, prange
 
+from ..utils import map_raster_windows, cache_tile_size
+from ._solar_position import lattice_weights, lattice_window, bilinear, bilinear_angle, incidence_angle,\
+    clip_angle_of_incidence
+from ._valid_pixels import valid_spans, window_spans
 
-@jit(nopython=True)
+
+# Side in pixels of the row-major tiles the kernels traverse, sized so that the
+# DEM and the output of a tile stay in L2. Dark tiles are skipped at once. The
+# sides are the defaults of the `tile_size` arguments of the kernels rather
+# than globals, which numba would freeze into the kernels cached on disk: a
+# default is part of the cached signature, so a machine with another cache
+# compiles its own.
+TILE_SIZE = cache_tile_size(2 + 8)
+
+@jit(nopython=True, cache=True)
 def radius_correction(year, month, day):
     """TBA.
     """
@@ -16,14 +29,14 @@ def radius_correction(year, month, day):
     return rc
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def total_solar_irradiance(radius_correction, solar_constant=1361):
     """TBA.
     """
     return radius_correction*solar_constant
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def atmospheric_air_mass(air_mass, altitude=None):
     """If the atmosphere is treated as a horizontal slab of material of unit
     thickness, the shortest path length is along the vertical to the local
@@ -55,7 +68,7 @@ def atmospheric_air_mass(air_mass, altitude=None):
         return air_mass
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def rayleigh_transmittance(atm_air_mass):
     """TBA.
 
@@ -72,7 +85,7 @@ def rayleigh_transmittance(atm_air_mass):
     return np.exp(-0.0903 * (atm_air_mass**0.84) * (1 + atm_air_mass - atm_air_mass**1.01))
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def mixed_gas_transmittance(atm_air_mass):
     """TBA.
     
@@ -89,7 +102,7 @@ def mixed_gas_transmittance(atm_air_mass):
     return np.exp(-0.0127 * atm_air_mass**0.26)
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def ozone_transmittance(oz, geo_air_mass):
     """TBA.
 
@@ -110,7 +123,7 @@ def ozone_transmittance(oz, geo_air_mass):
     return 1-0.1611 * ozm * (1 + 139.48*ozm)**(-0.3035) - (0.002715*ozm)/(1 + 0.044*ozm + 0.0003*ozm**2)
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def water_vapor_transmittance(pw, geo_air_mass):
     """TBA.
 
@@ -131,7 +144,7 @@ def water_vapor_transmittance(pw, geo_air_mass):
     return 1-2.4959*w / ((1 + 79.034*w)**0.6828 + 6.385*w)
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def aerosol_transmittance(aod, geo_air_mass, angstrom=1.3):
     """TBA.
 
@@ -146,7 +159,7 @@ def aerosol_transmittance(aod, geo_air_mass, angstrom=1.3):
     return np.exp(-tau**0.873 * (1+tau - tau**0.7088) * geo_air_mass**0.9108) # eq. 3.13
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def aerosol_absorptance(geo_air_mass, aerosol_transmittance):
     """TBA.
     """
@@ -155,14 +168,14 @@ def aerosol_absorptance(geo_air_mass, aerosol_transmittance):
     return 1 - (numerator/denominator)
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def sky_diffuse_radiation(tsi, elev_angle, Tg, To, Tw, Taa):
     """TBA.
     """
     return 0.79*tsi * np.cos((np.pi/2)-elev_angle) * Tg*To*Tw*Taa
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def direct_horizontal_irradiance(dni, elev_angle, ds, geo_air_mass, Tr, Ta, Taa, albedo):
     """TBA.
     
@@ -179,26 +192,367 @@ def direct_horizontal_irradiance(dni, elev_angle, ds, geo_air_mass, Tr, Ta, Taa,
     return ghi - (dni * np.cos((np.pi/2)-elev_angle))
 
 
-@jit(nopython=True)
-def ground_reflected_irradiance(dni, dhi, elev_angle, albedo, tilt_angle=0.10471975511965978):
+@jit(nopython=True, cache=True)
+def ground_reflected_irradiance(dni, dhi, elev_angle, albedo, tilt_angle=0.10471975511965978, sky_view_factor=1.0):
     """TBA.
+
+    Parameters
+    ----------
+    dhi : float
+        Diffuse horizontal irradiance, of the sky the terrain leaves.
+
+    sky_view_factor : float
+        Share of the sky left by the surrounding terrain, see
+        :func:`src.feature_engineering.sky_view_factor`. The plane sees the
+        ground and the terrain wherever it does not see the sky.
     """
     ghi = dni*np.cos((np.pi/2)-elev_angle) + dhi
-    view_factor = (1-np.cos(tilt_angle))/2
+    view_factor = 1 - sky_view_factor*(1+np.cos(tilt_angle))/2
     return ghi * albedo * view_factor
 
 
-@njit(parallel=True)
-def clear_sky_irradiance(elevs, aois, dem, ozs, wvs, aods, albedos, clouds, year, month, day):
+@jit(nopython=True, cache=True)
+def _gas_transmittances(atm_air_masses):
+    gas = np.empty((len(atm_air_masses), 2))
+    for i in range(len(atm_air_masses)):
+        gas[i, 0] = rayleigh_transmittance(atm_air_masses[i])
+        gas[i, 1] = mixed_gas_transmittance(atm_air_masses[i])
+    return gas
+
+
+# Range of the transmittance lookup tables and their interpolation error bound.
+LUT_MIN_ALTITUDE = -500
+LUT_MAX_ALTITUDE = 9000
+LUT_MIN_AIR_MASS = 0.9
+LUT_MAX_AIR_MASS = 40.0
+LUT_MAX_ERROR = 1e-6
+
+
+def transmittance_lut(max_error=LUT_MAX_ERROR):
+    """Lookup tables for the pressure correction of the air mass, and the
+    Rayleigh and mixed gas transmittances.
+
+    The pressure factor exp(-0.000832*altitude/1000) of
+    :func:`atmospheric_air_mass` is tabulated for every integer altitude
+    from LUT_MIN_ALTITUDE to LUT_MAX_ALTITUDE, so that it is exact for the
+    int16 DEM. The transmittances only depend on the pressure-corrected air
+    mass and are tabulated on a regular air mass axis from
+    LUT_MIN_AIR_MASS to LUT_MAX_AIR_MASS. The spacing is halved until
+    linear interpolation is within `max_error` of both formulas at every
+    interval midpoint. Interpolation error is largest there, so this bounds
+    the error over the whole axis. Air masses beyond the table, at sun
+    elevations below about 1.4 degrees, are evaluated directly.
+
+    Returns
+    -------
+    pressure_factors : array
+        Pressure factor of every integer altitude from LUT_MIN_ALTITUDE.
+
+    step : float
+        Air mass spacing of the transmittance table.
+
+    gas : array
+        Array of shape (n, 2) of the Rayleigh and mixed gas transmittances
+        at air masses LUT_MIN_AIR_MASS + step*i.
+
+    error : float
+        Maximum interpolation error observed at the midpoints.
+    """
+    altitudes = np.arange(LUT_MIN_ALTITUDE, LUT_MAX_ALTITUDE+1)
+    pressure_factors = np.exp(-0.000832 * altitudes / 1000)
+
+    step = 1.0
+    while True:
+        n = int(np.ceil((LUT_MAX_AIR_MASS - LUT_MIN_AIR_MASS) / step)) + 1
+        gas = _gas_transmittances(LUT_MIN_AIR_MASS + step*np.arange(n))
+        midpoints = _gas_transmittances(LUT_MIN_AIR_MASS + step*(np.arange(n-1) + 0.5))
+        error = np.abs((gas[:-1] + gas[1:])/2 - midpoints).max()
+        if error <= max_error:
+            return pressure_factors, step, gas, error
+        step /= 2
+
+
+# The tables are built once at import and frozen into the compiled kernels.
+_PRESSURE_FACTORS, _GAS_STEP, _GAS, _GAS_ERROR = transmittance_lut()
+
+
+@jit(nopython=True, cache=True)
+def _lookup_atm_air_mass(geo_air_mass, altitude):
+    # Exact for integer altitudes in the table, see transmittance_lut.
+    if LUT_MIN_ALTITUDE <= altitude <= LUT_MAX_ALTITUDE:
+        return geo_air_mass * _PRESSURE_FACTORS[int(altitude) - LUT_MIN_ALTITUDE]
+    return atmospheric_air_mass(geo_air_mass, altitude)
+
+
+@jit(nopython=True, cache=True)
+def _lookup_gas_transmittances(atm_air_mass):
+    # Rayleigh and mixed gas transmittances, interpolated within LUT_MAX_ERROR.
+    k = (atm_air_mass - LUT_MIN_AIR_MASS) / _GAS_STEP
+    if k < 0 or k >= _GAS.shape[0]-1:
+        return rayleigh_transmittance(atm_air_mass), mixed_gas_transmittance(atm_air_mass)
+    i = int(k)
+    w = k - i
+    Tr = _GAS[i, 0] + w*(_GAS[i+1, 0]-_GAS[i, 0])
+    Tg = _GAS[i, 1] + w*(_GAS[i+1, 1]-_GAS[i, 1])
+    return Tr, Tg
+
+
+@jit(nopython=True, cache=True)
+def _air_mass_powers(geo_air_mass):
+    # Powers of the air mass in aerosol_transmittance, aerosol_absorptance and
+    # direct_horizontal_irradiance.
+    return (
+        geo_air_mass**0.9108,
+        1 - geo_air_mass + geo_air_mass**1.06,
+        1 - geo_air_mass + geo_air_mass**1.02
+    )
+
+
+@jit(nopython=True, cache=True)
+def _ground_view_factor(tilt, svf):
+    # Share of the view of a plane of `tilt` taken by the ground and the
+    # terrain, see ground_reflected_irradiance.
+    return 1 - svf*(1+np.cos(tilt))/2
+
+
+@jit(nopython=True, cache=True)
+def _irradiance_budget(tsi, sin_elev, cos_aoi, powers, Tr, Tg, To, Tw, Ta, albedo, svf, ground_view):
+    # Irradiance components of one pixel from its transmittances, in the order
+    # of COMPONENTS and before the cloud cover, with the powers of the air
+    # mass of _air_mass_powers and the view factor of _ground_view_factor.
+    # Shared by _pixel_components and the samples of clear_sky_uncertainty.
+    _, absorptance_numerator, diffuse_denominator = powers
+    dni = tsi * Tr * Tg * To * Tw * Ta
+
+    # aerosol_absorptance, sky_diffuse_radiation and direct_horizontal_irradiance
+    Taa = 1 - absorptance_numerator/(10*(1-Ta))
+    Ds = 0.79*tsi * sin_elev * Tg*To*Tw*Taa
+    ihs = Ds * (0.5*(1-Tr) + 0.85*(1-(Ta/Taa))) / diffuse_denominator
+    Rs = 0.0685 + 0.16*(1-(Ta/Taa))
+    ghi = (dni*sin_elev + ihs)/(1-(albedo*Rs))
+
+    # The terrain hides the share 1 - svf of the diffuse sky, before the
+    # global irradiance the ground reflects is derived from it.
+    dhi = (ghi - dni*sin_elev)*svf
+    ghi = dni*sin_elev + dhi
+
+    # ground_reflected_irradiance
+    Eg = ghi * albedo * ground_view
+    return dni*cos_aoi + dhi + Eg, ghi, dni, dhi, Eg
+
+
+@jit(nopython=True, cache=True)
+def _pixel_components(tsi, cur_elev, aoi, cur_altitude, oz, wv, aod, albedo, cloud, tilt=0.10471975511965978, svf=1.0):
+    # Irradiance components of one pixel with the sun above the horizon, in
+    # the order of COMPONENTS, all scaled by its cloud cover. The tilt of the
+    # receiving plane and the sky view factor of the pixel set its view of
+    # the sky and of the ground.
+
+    # Calculate atmospheric adjusted air mass
+    sin_elev = np.sin(cur_elev)
+    cur_geo_air_mass = 1/sin_elev
+    cur_atm_air_mass = _lookup_atm_air_mass(cur_geo_air_mass, cur_altitude)
+
+    # Calculate rayleigh and mixed gas transmittance from the lookup table
+    Tr, Tg = _lookup_gas_transmittances(cur_atm_air_mass)
+
+    # Calculate ozone transmittance
+    To = ozone_transmittance(oz, cur_geo_air_mass)
+
+    # Calculate water vapour transmittance
+    Tw = water_vapor_transmittance(wv, cur_geo_air_mass)
+
+    # Calculate aerosol transmittance
+    Ta = aerosol_transmittance(aod, cur_geo_air_mass)
+
+    ### DIRECT, DIFFUSE AND GROUND REFLECTED IRRADIANCE
+    poa, ghi, dni, dhi, Eg = _irradiance_budget(
+        tsi, sin_elev, np.cos(aoi), _air_mass_powers(cur_geo_air_mass), Tr, Tg, To, Tw, Ta, albedo,
+        svf, _ground_view_factor(tilt, svf)
+    )
+
+    # Check if cloud
+    cloud_index = 1
+    if cloud != -32768:
+        cloud_index -= cloud
+    return poa*cloud_index, ghi*cloud_index, dni*cloud_index, dhi*cloud_index, Eg*cloud_index
+
+
+@jit(nopython=True, cache=True)
+def _pixel_irradiance(tsi, cur_elev, aoi, cur_altitude, oz, wv, aod, albedo, cloud, tilt=0.10471975511965978, svf=1.0):
+    # Clear sky irradiance of one pixel with the sun above the horizon,
+    # scaled by its cloud cover. The other components are optimized away.
+    return _pixel_components(tsi, cur_elev, aoi, cur_altitude, oz, wv, aod, albedo, cloud, tilt, svf)[0]
+
+
+@jit(nopython=True, cache=True)
+def _tile_max_elevation(elevs, row_lower, col_lower, x0, x1, y0, y1):
+    # An interpolated elevation never exceeds the lattice nodes around it, so
+    # a tile is dark if they are all below the horizon.
+    r0, r1 = row_lower[x0], min(row_lower[x1-1]+1, elevs.shape[0]-1)
+    c0, c1 = col_lower[y0], min(col_lower[y1-1]+1, elevs.shape[1]-1)
+    return elevs[r0:r1+1, c0:c1+1].max()
+
+
+# Irradiance components clear_sky_components can write: the plane of array
+# irradiance of clear_sky_irradiance, the global horizontal, direct normal and
+# diffuse horizontal irradiance, and the ground reflected part of the first.
+COMPONENTS = ['poa', 'ghi', 'dni', 'dhi', 'reflected']
+
+
+def component_bands(components):
+    """Output band of every entry of COMPONENTS, as passed to
+    :func:`clear_sky_components`.
+
+    Parameters
+    ----------
+    components : list of str
+        The requested components, in the order of the output bands.
+
+    Returns
+    -------
+    bands : array
+        Int64 array of the band of each of COMPONENTS, -1 where it is not
+        requested.
+    """
+    bands = np.full(len(COMPONENTS), -1, dtype=np.int64)
+    for band, component in enumerate(components):
+        if component not in COMPONENTS:
+            raise ValueError(f'Unknown irradiance component {component!r}, expected one of {COMPONENTS}.')
+        bands[COMPONENTS.index(component)] = band
+    return bands
+
+
+_POA_BANDS = component_bands(['poa'])
+_DARK = (0.0,)*len(COMPONENTS)
+
+
+@jit(nopython=True, cache=True)
+def _store_components(irradiance, bands, x, y, values):
+    for c in range(len(values)):
+        if bands[c] >= 0:
+            irradiance[bands[c], x, y] = values[c]
+
+
+@njit(parallel=True, cache=True)
+def clear_sky_components(elevs, aois, elev_rows, elev_cols, dem, spans, ozs, wvs, aods, albedos, clouds, cams_rows, cams_cols, meteosat_rows, meteosat_cols, year, month, day, bands, irradiance, azis=None, slopes=None, aspects=None, svfs=None, tile_size=TILE_SIZE):
+    """Fused form of :func:`clear_sky_irradiance` that writes any subset of
+    the irradiance components in one pass.
+
+    The components of a pixel share its air mass and transmittances, so
+    writing several of them costs little more than writing one. They are all
+    scaled by the cloud cover, and add up as poa = dni*cos(aoi) + dhi +
+    reflected.
+
+    Parameters
+    ----------
+    bands : array
+        Band of `irradiance` of each of COMPONENTS, -1 to skip it, see
+        :func:`component_bands`.
+
+    irradiance : array
+        Preallocated float64 output of shape (n_bands,) + dem.shape. Filled
+        with the components in W m**-2, zero where the sun is below the
+        horizon and -32768 outside the DEM.
+
+    azis : array, optional
+        Solar azimuths on the lattice, needed with `slopes`.
+
+    slopes, aspects : array, optional
+        Terrain slope and aspect of every pixel (in radians), see
+        :func:`src.feature_engineering.slope_aspect_rasters`. If given, the
+        panels lie on the terrain plane instead of the fixed array plane of
+        `aois`, for the angle of incidence and the view of the ground.
+
+    svfs : array, optional
+        Sky view factor of every pixel, see
+        :func:`src.feature_engineering.sky_view_factor_raster`. If given, the
+        terrain hides the rest of the diffuse sky irradiance, the ground
+        reflects the global irradiance that is left, and the plane sees
+        the ground reflection from the terrain instead.
+
+    tile_size : int
+        Side in pixels of the tiles the pixels are visited in, TILE_SIZE by
+        default.
+
+    The other parameters are those of :func:`clear_sky_irradiance`.
+    """
+    # Calculate total solar irradiation
+    radius = radius_correction(year, month, day)
+    tsi = total_solar_irradiance(radius)
+    irradiance[:] = -32768.0
+
+    # Lattice weights of the solar geometry
+    n_rows, n_cols = dem.shape
+    row_ptr, starts, stops = spans
+    row_lower, row_weights = lattice_weights(elev_rows, n_rows)
+    col_lower, col_weights = lattice_weights(elev_cols, n_cols)
+
+    # Calculate transmittances
+    n_tile_rows = (n_rows + tile_size - 1) // tile_size
+    n_tile_cols = (n_cols + tile_size - 1) // tile_size
+    for tile in prange(n_tile_rows*n_tile_cols):
+        x0 = tile // n_tile_cols * tile_size
+        y0 = tile % n_tile_cols * tile_size
+        x1 = min(x0 + tile_size, n_rows)
+        y1 = min(y0 + tile_size, n_cols)
+        max_elev = _tile_max_elevation(elevs, row_lower, col_lower, x0, x1, y0, y1)
+
+        for x in range(x0, x1):
+            for span in range(row_ptr[x], row_ptr[x+1]):
+                for y in range(max(starts[span], y0), min(stops[span], y1)):
+                    if dem[x, y] == -32768:
+                        continue
+                    if max_elev <= 0:
+                        _store_components(irradiance, bands, x, y, _DARK)
+                        continue
+
+                    # Interpolate the solar geometry from the lattice
+                    cur_elev = bilinear(elevs, row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+                    if cur_elev <= 0:
+                        _store_components(irradiance, bands, x, y, _DARK)
+                        continue
+                    x_trans, y_trans = cams_rows[x], cams_cols[y]
+                    x_alb, y_alb = meteosat_rows[x], meteosat_cols[y]
+                    if slopes is None:
+                        aoi = clip_angle_of_incidence(
+                            bilinear(aois, row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+                        )
+                        tilt = 0.10471975511965978
+                    else:
+                        cur_azi = bilinear_angle(azis, row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+                        aoi = clip_angle_of_incidence(incidence_angle(cur_elev, cur_azi, slopes[x, y], aspects[x, y]))
+                        tilt = slopes[x, y]
+                    svf = 1.0 if svfs is None else svfs[x, y]
+                    _store_components(irradiance, bands, x, y, _pixel_components(
+                        tsi, cur_elev, aoi, dem[x, y], ozs[x_trans, y_trans], wvs[x_trans, y_trans],
+                        aods[x_trans, y_trans], albedos[x_alb, y_alb], clouds[x_alb, y_alb], tilt, svf
+                    ))
+
+
+@jit(nopython=True, cache=True)
+def clear_sky_irradiance(elevs, aois, elev_rows, elev_cols, dem, spans, ozs, wvs, aods, albedos, clouds, cams_rows, cams_cols, meteosat_rows, meteosat_cols, year, month, day, tile_size=TILE_SIZE):
     """TBA.
 
     Parameters
     ----------
     elevs : array
-        Array of site elevation angles.
+        Array of site elevation angles on the solar lattice.
+
+    aois : array
+        Array of unclipped angles of incidence on the solar lattice.
+
+    elev_rows, elev_cols : array
+        DEM rows and columns of the solar lattice, see
+        :func:`src.feature_engineering.lattice_indices`. The solar geometry is
+        bilinearly interpolated between them.
     
     dem : array
         Array of site altitudes (in meters).
+
+    spans : tuple
+        Row spans of the valid pixels of the DEM, the only ones visited, see
+        :func:`src.feature_engineering.valid_spans`.
     
     ozs : array
         Array of column ozone amount.
@@ -209,6 +563,19 @@ def clear_sky_irradiance(elevs, aois, dem, ozs, wvs, aods, albedos, clouds, year
     aods : array
         Array of aerosol optical depths at 550nm.
 
+    albedos : array
+        Array of surface albedo on the Meteosat grid.
+
+    clouds : array
+        Array of cloud cover fraction on the Meteosat grid.
+
+    cams_rows, cams_cols : array
+        CAMS grid row of every DEM row and column of every DEM column, see
+        :func:`src.utils.grid_index_maps`.
+
+    meteosat_rows, meteosat_cols : array
+        Meteosat grid row of every DEM row and column of every DEM column.
+
     year : float
         Year.
 
@@ -218,95 +585,875 @@ def clear_sky_irradiance(elevs, aois, dem, ozs, wvs, aods, albedos, clouds, year
     day : float
         Day.
 
+    tile_size : int
+        Side in pixels of the tiles the pixels are visited in, TILE_SIZE by
+        default.
+
     Returns
     -------
+    irradiance : array
+        Irradiance in W m**-2, zero where the sun is below the horizon and
+        -32768 outside the DEM.
+    """
+    irradiance = np.empty((1,) + dem.shape)
+    clear_sky_components(
+        elevs, aois, elev_rows, elev_cols, dem, spans, ozs, wvs, aods, albedos, clouds,
+        cams_rows, cams_cols, meteosat_rows, meteosat_cols, year, month, day, _POA_BANDS, irradiance,
+        tile_size=tile_size
+    )
+    return irradiance[0]
+
+
+# Names of the aggregates of clear_sky_irradiance_sums: the months, the
+# seasons and the whole period.
+AGGREGATES = [f'{month:02d}' for month in range(1, 13)] + ['DJF', 'MAM', 'JJA', 'SON', 'year']
+
+# A tile of clear_sky_irradiance_sums holds a float64 sum and an int32 count
+# of every aggregate per pixel.
+SUMS_TILE_SIZE = cache_tile_size(2 + 12*len(AGGREGATES))
+
+
+def aggregate_groups(months):
+    """Aggregates every timestep adds to, as indices into AGGREGATES.
+
+    Returns
+    -------
+    groups : array
+        Int64 array of shape (n_times, 3) with the month, the season and the
+        whole period of each timestep.
+    """
+    months = np.asarray(months)
+    groups = np.empty((len(months), 3), dtype=np.int64)
+    groups[:, 0] = months - 1
+    groups[:, 1] = 12 + (months % 12) // 3
+    groups[:, 2] = 16
+    return groups
+
+
+@njit(parallel=True, cache=True)
+def clear_sky_irradiance_sums(elevs, aois, elev_rows, elev_cols, dem, spans, ozs, wvs, aods, albedos, clouds, cams_rows, cams_cols, meteosat_rows, meteosat_cols, years, months, days, groups, sums, counts, azis=None, slopes=None, aspects=None, svfs=None, tile_size=SUMS_TILE_SIZE):
+    """Accumulation mode of :func:`clear_sky_irradiance` for a stack of
+    timesteps.
+
+    The irradiance of every timestep is added in place to the running sums of
+    the aggregates it belongs to, and the counts are raised where it is
+    valid, so that means come out of one pass without storing a raster per
+    timestep. Calling it again with the next stack keeps accumulating.
+
+    Parameters
+    ----------
+    elevs, aois : array
+        Solar geometry on the lattice, shape (n_times, n_nodes_rows, n_nodes_cols).
+
+    ozs, wvs, aods, albedos, clouds : array
+        Inputs on their coarse grids, shape (n_times, grid_rows, grid_cols).
+
+    years, months, days : array
+        Date of each timestep.
+
+    groups : array
+        Int64 array of shape (n_times, n_groups) of the aggregates each
+        timestep adds to, negative entries are skipped, see
+        :func:`aggregate_groups`.
+
+    sums : array
+        Float64 running sums of shape (n_aggregates,) + dem.shape.
+
+    counts : array
+        Integer counts of valid timesteps of the same shape.
+
+    azis, slopes, aspects : array, optional
+        Solar azimuths on the lattice, stacked as `elevs`, and terrain slope
+        and aspect to put the panels on the terrain plane, see
+        :func:`clear_sky_components`.
+
+    svfs : array, optional
+        Sky view factor of every pixel, see :func:`clear_sky_components`.
+
+    tile_size : int
+        Side in pixels of the tiles the pixels are visited in,
+        SUMS_TILE_SIZE by default.
+
+    The other parameters are those of :func:`clear_sky_irradiance`.
+    """
+    n_times = elevs.shape[0]
+    tsis = np.empty(n_times)
+    for t in range(n_times):
+        tsis[t] = total_solar_irradiance(radius_correction(years[t], months[t], days[t]))
+
+    # Lattice weights of the solar geometry
+    n_rows, n_cols = dem.shape
+    row_ptr, starts, stops = spans
+    row_lower, row_weights = lattice_weights(elev_rows, n_rows)
+    col_lower, col_weights = lattice_weights(elev_cols, n_cols)
+
+    n_tile_rows = (n_rows + tile_size - 1) // tile_size
+    n_tile_cols = (n_cols + tile_size - 1) // tile_size
+    for tile in prange(n_tile_rows*n_tile_cols):
+        x0 = tile // n_tile_cols * tile_size
+        y0 = tile % n_tile_cols * tile_size
+        x1 = min(x0 + tile_size, n_rows)
+        y1 = min(y0 + tile_size, n_cols)
+        dark = np.empty(n_times, dtype=np.bool_)
+        for t in range(n_times):
+            dark[t] = _tile_max_elevation(elevs[t], row_lower, col_lower, x0, x1, y0, y1) <= 0
+
+        for x in range(x0, x1):
+            for span in range(row_ptr[x], row_ptr[x+1]):
+                for y in range(max(starts[span], y0), min(stops[span], y1)):
+                    if dem[x, y] == -32768:
+                        continue
+                    x_trans, y_trans = cams_rows[x], cams_cols[y]
+                    x_alb, y_alb = meteosat_rows[x], meteosat_cols[y]
+                    svf = 1.0 if svfs is None else svfs[x, y]
+                    for t in range(n_times):
+                        value = 0.0
+                        if not dark[t]:
+                            cur_elev = bilinear(elevs[t], row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+                            if cur_elev > 0:
+                                if slopes is None:
+                                    aoi = clip_angle_of_incidence(
+                                        bilinear(aois[t], row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+                                    )
+                                    tilt = 0.10471975511965978
+                                else:
+                                    cur_azi = bilinear_angle(azis[t], row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+                                    aoi = clip_angle_of_incidence(
+                                        incidence_angle(cur_elev, cur_azi, slopes[x, y], aspects[x, y])
+                                    )
+                                    tilt = slopes[x, y]
+                                value = _pixel_irradiance(
+                                    tsis[t], cur_elev, aoi, dem[x, y], ozs[t, x_trans, y_trans],
+                                    wvs[t, x_trans, y_trans], aods[t, x_trans, y_trans],
+                                    albedos[t, x_alb, y_alb], clouds[t, x_alb, y_alb], tilt, svf
+                                )
+                        if not np.isfinite(value):
+                            continue
+                        for g in groups[t]:
+                            if g >= 0:
+                                sums[g, x, y] += value
+                                counts[g, x, y] += 1
+
+
+def _window_terrain(window, r0, r1, c0, c1, azis, slope, aspect):
+    # Optional terrain arguments of the kernels for a window, see
+    # clear_sky_components.
+    if slope is None:
+        return ()
+    return (
+        np.ascontiguousarray(azis[..., r0:r1, c0:c1]),
+        slope.read(1, window=window),
+        aspect.read(1, window=window)
+    )
+
+
+def _window_sky_view(window, sky_view):
+    # Optional sky view factor argument of the kernels for a window, passed
+    # by keyword so that the terrain can be left out.
+    if sky_view is None:
+        return {}
+    return {'svfs': sky_view.read(1, window=window)}
+
+
+def clear_sky_irradiance_windows(elevation, path, elevs, aois, elev_rows, elev_cols, ozs, wvs, aods, albedos, clouds, cams_rows, cams_cols, meteosat_rows, meteosat_cols, year, month, day, max_memory=2*1024**3, spans=None, components=('poa',), azis=None, slope=None, aspect=None, sky_view=None):
+    """Clear sky irradiance of a whole DEM raster, streamed window by window
+    into a tiled GeoTIFF so that peak memory stays near `max_memory`
+    whatever the raster size.
+
+    Each window of the DEM is read from `elevation`, evaluated with
+    :func:`clear_sky_irradiance` on the part of the solar lattice and of the
+    index maps that covers it, and written to `path`. The arguments are those
+    of :func:`clear_sky_irradiance` for the whole raster, see
+    :func:`src.utils.map_raster_windows` for `max_memory`. The valid pixel
+    `spans` default to those of the country polygon on the DEM grid, see
+    :func:`src.feature_engineering.valid_spans`.
+
+    The `components` of COMPONENTS are computed in the same pass by
+    :func:`clear_sky_components` and written as the bands of `path`, in that
+    order and named after them. Given the solar `azis` on the lattice and
+    the open `slope` and `aspect` rasters of
+    :func:`src.feature_engineering.slope_aspect_rasters`, the panels lie on
+    the terrain. Given the open `sky_view` raster of
+    :func:`src.feature_engineering.sky_view_factor_raster`, the terrain
+    hides part of the diffuse sky.
+    """
+    if spans is None:
+        spans = valid_spans(elevation.transform, elevation.height, elevation.width)
+    bands = component_bands(components)
+
+    def window_irradiance(window, dem):
+        rows, cols = window.toslices()
+        r0, r1, window_rows = lattice_window(elev_rows, rows.start, rows.stop)
+        c0, c1, window_cols = lattice_window(elev_cols, cols.start, cols.stop)
+        irradiance = np.empty((len(components),) + dem.shape)
+        terrain = _window_terrain(window, r0, r1, c0, c1, azis, slope, aspect)
+        clear_sky_components(
+            np.ascontiguousarray(elevs[r0:r1, c0:c1]),
+            np.ascontiguousarray(aois[r0:r1, c0:c1]),
+            window_rows,
+            window_cols,
+            dem,
+            window_spans(spans, rows.start, cols.start, *dem.shape),
+            ozs,
+            wvs,
+            aods,
+            albedos,
+            clouds,
+            cams_rows[rows],
+            cams_cols[cols],
+            meteosat_rows[rows],
+            meteosat_cols[cols],
+            year,
+            month,
+            day,
+            bands,
+            irradiance,
+            *terrain,
+            **_window_sky_view(window, sky_view)
+        )
+        return irradiance
+
+    # The DEM, the float64 components and their float32 copies, the terrain
+    # and the sky view factor.
+    bytes_per_pixel = 2 + len(components)*(8 + 4) + 8 + 4
+    map_raster_windows(
+        window_irradiance, elevation, path, max_memory, bytes_per_pixel, band_names=list(components)
+    )
+
+
+def clear_sky_aggregates_windows(elevation, paths, elevs, aois, elev_rows, elev_cols, ozs, wvs, aods, albedos, clouds, cams_rows, cams_cols, meteosat_rows, meteosat_cols, years, months, days, max_memory=2*1024**3, spans=None, azis=None, slope=None, aspect=None, sky_view=None):
+    """Monthly, seasonal and whole-period mean clear sky irradiance of a DEM
+    raster in one pass over a stack of timesteps.
+
+    The DEM is streamed window by window as in
+    :func:`clear_sky_irradiance_windows`, and each window accumulates the
+    whole stack with :func:`clear_sky_irradiance_sums`. Means are written to
+    one GeoTIFF per aggregate, nodata where no timestep was valid.
+
+    Parameters
+    ----------
+    paths : list of Path
+        One output per name in AGGREGATES, in that order.
+
+    elevs, aois, ozs, wvs, aods, albedos, clouds, years, months, days : array
+        The stacked inputs of :func:`clear_sky_irradiance_sums`.
+
+    azis : array, optional
+        Stacked solar azimuths on the lattice, with the `slope` and `aspect`
+        rasters to put the panels on the terrain.
+
+    The other parameters are those of :func:`clear_sky_irradiance_windows`.
+    """
+    groups = aggregate_groups(months)
+    years, months, days = np.asarray(years), np.asarray(months), np.asarray(days)
+    if spans is None:
+        spans = valid_spans(elevation.transform, elevation.height, elevation.width)
+
+    def window_means(window, dem):
+        rows, cols = window.toslices()
+        r0, r1, window_rows = lattice_window(elev_rows, rows.start, rows.stop)
+        c0, c1, window_cols = lattice_window(elev_cols, cols.start, cols.stop)
+        sums = np.zeros((len(AGGREGATES),) + dem.shape)
+        counts = np.zeros((len(AGGREGATES),) + dem.shape, dtype=np.int32)
+        terrain = _window_terrain(window, r0, r1, c0, c1, azis, slope, aspect)
+        clear_sky_irradiance_sums(
+            np.ascontiguousarray(elevs[:, r0:r1, c0:c1]),
+            np.ascontiguousarray(aois[:, r0:r1, c0:c1]),
+            window_rows,
+            window_cols,
+            dem,
+            window_spans(spans, rows.start, cols.start, *dem.shape),
+            ozs,
+            wvs,
+            aods,
+            albedos,
+            clouds,
+            cams_rows[rows],
+            cams_cols[cols],
+            meteosat_rows[rows],
+            meteosat_cols[cols],
+            years,
+            months,
+            days,
+            groups,
+            sums,
+            counts,
+            *terrain,
+            **_window_sky_view(window, sky_view)
+        )
+        means = np.full(sums.shape, -32768.0)
+        np.divide(sums, counts, out=means, where=counts > 0)
+        return means
+
+    # Sums, counts and means of every aggregate, the DEM, the terrain and the
+    # sky view factor.
+    bytes_per_pixel = len(AGGREGATES)*(8 + 4 + 8 + 4) + 2 + 8 + 4
+    map_raster_windows(window_means, elevation, paths, max_memory, bytes_per_pixel)
+
+
+# Bands of clear_sky_orientation_sweep: the optimal tilt and azimuth (radians),
+# the mean plane of array irradiance there (W m**-2) and its relative gain over
+# the reference orientation.
+ORIENTATION_BANDS = ['tilt', 'azimuth', 'poa', 'gain']
+
+# A tile of clear_sky_orientation_sweep holds every band per pixel.
+SWEEP_TILE_SIZE = cache_tile_size(2 + 8*len(ORIENTATION_BANDS))
+
+
+@njit(parallel=True, cache=True)
+def clear_sky_orientation_sweep(elevs, azis, elev_rows, elev_cols, dem, spans, ozs, wvs, aods, albedos, clouds, cams_rows, cams_cols, meteosat_rows, meteosat_cols, years, months, days, tilts, azimuths, out, ref_tilt=0.10471975511965978, ref_azimuth=np.pi, slopes=None, aspects=None, svfs=None, tile_size=SWEEP_TILE_SIZE):
+    """Optimal panel orientation of every pixel over a stack of timesteps,
+    from the mean plane of array irradiance of a grid of candidate tilts and
+    azimuths.
+
+    The direct normal, diffuse horizontal and ground reflected irradiance
+    of a pixel and timestep are computed once and shared by all candidates,
+    which only differ in the angle of incidence and the view factor of the
+    ground. They follow the model of :func:`clear_sky_irradiance`, the angle
+    of incidence being clipped in the same way, so that a sweep costs little
+    more than one run of :func:`clear_sky_irradiance_sums` and the
+    reference orientation reproduces it.
+
+    Parameters
+    ----------
+    elevs, azis : array
+        Solar elevations and azimuths on the lattice, shape (n_times,
+        n_nodes_rows, n_nodes_cols).
+
+    tilts, azimuths : array
+        Candidate tilts and azimuths (in radians, azimuths eastward from
+        north). Every combination of both is evaluated.
+
+    out : array
+        Preallocated float64 output of shape (len(ORIENTATION_BANDS),) +
+        dem.shape. Filled with the bands of ORIENTATION_BANDS, -32768
+        outside the DEM and where no timestep was valid. The first best
+        candidate is kept on ties.
+
+    ref_tilt, ref_azimuth : float
+        Orientation the gain is relative to, by default that of
+        :func:`src.feature_engineering.angle_of_incidence`.
+
+    slopes, aspects : array, optional
+        Terrain slope and aspect of every pixel (in radians). If given, the
+        gain is relative to panels lying on the terrain plane instead of
+        `ref_tilt` and `ref_azimuth`, as in :func:`clear_sky_components`.
+
+    svfs : array, optional
+        Sky view factor of every pixel. If given, the terrain hides part of
+        the diffuse sky from every candidate and the reference, and the
+        ground reflection is seen from the terrain, see
+        :func:`clear_sky_components`.
+
+    tile_size : int
+        Side in pixels of the tiles the pixels are visited in,
+        SWEEP_TILE_SIZE by default.
+
+    The other parameters are those of :func:`clear_sky_irradiance_sums`.
+    """
+    n_times = elevs.shape[0]
+    tsis = np.empty(n_times)
+    for t in range(n_times):
+        tsis[t] = total_solar_irradiance(radius_correction(years[t], months[t], days[t]))
+
+    # Candidate orientations, followed by the reference, which the terrain
+    # plane of every pixel replaces if given.
+    n_candidates = len(tilts)*len(azimuths)
+    cand_tilts = np.empty(n_candidates+1)
+    cand_azimuths = np.empty(n_candidates+1)
+    for i in range(len(tilts)):
+        for j in range(len(azimuths)):
+            cand_tilts[i*len(azimuths)+j] = tilts[i]
+            cand_azimuths[i*len(azimuths)+j] = azimuths[j]
+    cand_tilts[n_candidates] = ref_tilt
+    cand_azimuths[n_candidates] = ref_azimuth
+    cos_tilts, sin_tilts = np.cos(cand_tilts), np.sin(cand_tilts)
+    cos_azimuths, sin_azimuths = np.cos(cand_azimuths), np.sin(cand_azimuths)
+
+    # clip_angle_of_incidence as a lower bound on the cosine.
+    min_cos_aoi = np.cos(np.pi/4)
+
+    out[:] = -32768.0
+    n_rows, n_cols = dem.shape
+    row_ptr, starts, stops = spans
+    row_lower, row_weights = lattice_weights(elev_rows, n_rows)
+    col_lower, col_weights = lattice_weights(elev_cols, n_cols)
+
+    n_tile_rows = (n_rows + tile_size - 1) // tile_size
+    n_tile_cols = (n_cols + tile_size - 1) // tile_size
+    for tile in prange(n_tile_rows*n_tile_cols):
+        x0 = tile // n_tile_cols * tile_size
+        y0 = tile % n_tile_cols * tile_size
+        x1 = min(x0 + tile_size, n_rows)
+        y1 = min(y0 + tile_size, n_cols)
+        dark = np.empty(n_times, dtype=np.bool_)
+        for t in range(n_times):
+            dark[t] = _tile_max_elevation(elevs[t], row_lower, col_lower, x0, x1, y0, y1) <= 0
+        sums = np.empty(n_candidates+1)
+        plane_cos_tilts, plane_sin_tilts = cos_tilts.copy(), sin_tilts.copy()
+        plane_cos_azimuths, plane_sin_azimuths = cos_azimuths.copy(), sin_azimuths.copy()
+        view_factors = np.empty(n_candidates+1)
+
+        for x in range(x0, x1):
+            for span in range(row_ptr[x], row_ptr[x+1]):
+                for y in range(max(starts[span], y0), min(stops[span], y1)):
+                    if dem[x, y] == -32768:
+                        continue
+                    x_trans, y_trans = cams_rows[x], cams_cols[y]
+                    x_alb, y_alb = meteosat_rows[x], meteosat_cols[y]
+                    if slopes is not None:
+                        plane_cos_tilts[n_candidates] = np.cos(slopes[x, y])
+                        plane_sin_tilts[n_candidates] = np.sin(slopes[x, y])
+                        plane_cos_azimuths[n_candidates] = np.cos(aspects[x, y])
+                        plane_sin_azimuths[n_candidates] = np.sin(aspects[x, y])
+                    svf = 1.0 if svfs is None else svfs[x, y]
+                    for k in range(n_candidates+1):
+                        view_factors[k] = 1 - svf*(1+plane_cos_tilts[k])/2
+                    sums[:] = 0
+                    count = 0
+                    for t in range(n_times):
+                        if dark[t]:
+                            count += 1
+                            continue
+                        cur_elev = bilinear(elevs[t], row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+                        if cur_elev <= 0:
+                            count += 1
+                            continue
+                        cur_azi = bilinear_angle(azis[t], row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+                        _, ghi, dni, dhi, _ = _pixel_components(
+                            tsis[t], cur_elev, 0.0, dem[x, y], ozs[t, x_trans, y_trans],
+                            wvs[t, x_trans, y_trans], aods[t, x_trans, y_trans],
+                            albedos[t, x_alb, y_alb], clouds[t, x_alb, y_alb], svf=svf
+                        )
+                        if not (np.isfinite(dni) and np.isfinite(dhi)):
+                            continue
+                        ground = ghi*albedos[t, x_alb, y_alb]
+                        sin_elev, cos_elev = np.sin(cur_elev), np.cos(cur_elev)
+                        cos_azi, sin_azi = np.cos(cur_azi), np.sin(cur_azi)
+                        for k in range(n_candidates+1):
+                            cos_aoi = sin_elev*plane_cos_tilts[k] + cos_elev*plane_sin_tilts[k]*(
+                                cos_azi*plane_cos_azimuths[k] + sin_azi*plane_sin_azimuths[k]
+                            )
+                            if cos_aoi < min_cos_aoi:
+                                cos_aoi = min_cos_aoi
+                            sums[k] += dni*cos_aoi + dhi + ground*view_factors[k]
+                        count += 1
+                    if count == 0:
+                        continue
+
+                    best = np.argmax(sums[:n_candidates])
+                    out[0, x, y] = cand_tilts[best]
+                    out[1, x, y] = cand_azimuths[best]
+                    out[2, x, y] = sums[best] / count
+                    out[3, x, y] = sums[best]/sums[n_candidates] - 1 if sums[n_candidates] > 0 else 0.0
+
+
+def clear_sky_orientation_windows(elevation, path, elevs, azis, elev_rows, elev_cols, ozs, wvs, aods, albedos, clouds, cams_rows, cams_cols, meteosat_rows, meteosat_cols, years, months, days, tilts, azimuths, max_memory=2*1024**3, spans=None, slope=None, aspect=None, sky_view=None):
+    """Optimal panel orientation of a whole DEM raster over a stack of
+    timesteps, streamed window by window into a GeoTIFF with the bands of
+    ORIENTATION_BANDS.
+
+    Each window is evaluated with :func:`clear_sky_orientation_sweep`, the
+    `slope` and `aspect` rasters making the gain relative to the terrain
+    plane. See :func:`clear_sky_aggregates_windows` for the other
+    parameters.
+    """
+    years, months, days = np.asarray(years), np.asarray(months), np.asarray(days)
+    tilts, azimuths = np.asarray(tilts, dtype=np.float64), np.asarray(azimuths, dtype=np.float64)
+    if spans is None:
+        spans = valid_spans(elevation.transform, elevation.height, elevation.width)
+
+    def window_orientation(window, dem):
+        rows, cols = window.toslices()
+        r0, r1, window_rows = lattice_window(elev_rows, rows.start, rows.stop)
+        c0, c1, window_cols = lattice_window(elev_cols, cols.start, cols.stop)
+        out = np.empty((len(ORIENTATION_BANDS),) + dem.shape)
+        terrain = {}
+        if slope is not None:
+            terrain = {'slopes': slope.read(1, window=window), 'aspects': aspect.read(1, window=window)}
+        clear_sky_orientation_sweep(
+            np.ascontiguousarray(elevs[:, r0:r1, c0:c1]),
+            np.ascontiguousarray(azis[:, r0:r1, c0:c1]),
+            window_rows,
+            window_cols,
+            dem,
+            window_spans(spans, rows.start, cols.start, *dem.shape),
+            ozs,
+            wvs,
+            aods,
+            albedos,
+            clouds,
+            cams_rows[rows],
+            cams_cols[cols],
+            meteosat_rows[rows],
+            meteosat_cols[cols],
+            years,
+            months,
+            days,
+            tilts,
+            azimuths,
+            out,
+            **terrain,
+            **_window_sky_view(window, sky_view)
+        )
+        return out
+
+    # The bands and their float32 copies, the DEM, the terrain and the sky
+    # view factor.
+    bytes_per_pixel = len(ORIENTATION_BANDS)*(8 + 4) + 2 + 8 + 4
+    map_raster_windows(
+        window_orientation, elevation, path, max_memory, bytes_per_pixel, band_names=ORIENTATION_BANDS
+    )
+
+
+# Standard deviations of the uncertain inputs of clear_sky_uncertainty per
+# coarse cell: relative for the column amounts and the albedo, absolute for the
+# Angstrom exponent of aerosol_transmittance around its default of 1.3. Set
+# them to the errors of the datasets at hand.
+INPUT_UNCERTAINTY = {'oz': 0.05, 'wv': 0.1, 'aod': 0.3, 'albedo': 0.1, 'angstrom': 0.3}
+
+# Quantiles of the plane of array irradiance written by clear_sky_uncertainty,
+# after its mean.
+UNCERTAINTY_QUANTILES = (0.05, 0.5, 0.95)
+
+# A tile of clear_sky_uncertainty holds the mean and the quantiles per pixel.
+UNCERTAINTY_TILE_SIZE = cache_tile_size(2 + 8*(1 + len(UNCERTAINTY_QUANTILES)))
+
+
+def uncertainty_bands(quantiles=UNCERTAINTY_QUANTILES):
+    """Names of the bands of :func:`clear_sky_uncertainty`, the mean followed
+    by one per quantile, e.g. 'q05' for the 5th percentile.
+    """
+    return ['mean'] + [f'q{100*q:02g}' for q in quantiles]
+
+
+@jit(nopython=True, cache=True)
+def _aerosol_coefficients(aods, angstroms):
+    # The part of aerosol_transmittance that does not depend on the air mass,
+    # Ta = exp(-coefficient * geo_air_mass**0.9108).
+    coefficients = np.empty(aods.shape)
+    flat_aods, flat_angstroms, flat_coefficients = aods.ravel(), angstroms.ravel(), coefficients.ravel()
+    for i in range(flat_aods.size):
+        ta3 = flat_aods[i]*(380/550)**(-flat_angstroms[i])
+        ta5 = flat_aods[i]*(500/550)**(-flat_angstroms[i])
+        tau = 0.2758*ta3 + 0.35*ta5
+        flat_coefficients[i] = tau**0.873 * (1+tau - tau**0.7088)
+    return coefficients
+
+
+def input_samples(ozs, wvs, aods, albedos, n_samples, uncertainty=INPUT_UNCERTAINTY, seed=None):
+    """Draw perturbed inputs of :func:`clear_sky_uncertainty`, independently
+    for every coarse cell.
+
+    The column amounts and the albedo are scaled by lognormal factors of
+    mean one, the albedo is kept below one, and the Angstrom exponent is
+    normal around 1.3 and kept positive.
+
+    Parameters
+    ----------
+    ozs, wvs, aods : array
+        Inputs on the CAMS grid.
+
+    albedos : array
+        Albedo on the Meteosat grid.
+
+    n_samples : int
+        Number of samples K per cell.
+
+    uncertainty : dict
+        Standard deviations of the inputs, see INPUT_UNCERTAINTY.
+
+    Returns
+    -------
+    oz_samples, wv_samples, aod_samples, angstrom_samples, albedo_samples : array
+        Float64 samples with a trailing axis of length K.
+    """
+    rng = np.random.default_rng(seed)
+
+    def perturb(values, sigma):
+        values = np.asarray(values, dtype=np.float64)[..., None]
+        return values*rng.lognormal(-sigma**2/2, sigma, values.shape[:-1] + (n_samples,))
+
+    oz_samples = perturb(ozs, uncertainty['oz'])
+    wv_samples = perturb(wvs, uncertainty['wv'])
+    aod_samples = perturb(aods, uncertainty['aod'])
+    angstroms = np.maximum(rng.normal(1.3, uncertainty['angstrom'], aod_samples.shape), 0)
+    albedo_samples = np.minimum(perturb(albedos, uncertainty['albedo']), 1)
+    return oz_samples, wv_samples, aod_samples, angstroms, albedo_samples
+
+
+# Range of the column path tables of clear_sky_uncertainty, in atm-cm as in
+# ozone_transmittance and water_vapor_transmittance.
+LUT_MAX_OZONE_PATH = 5.0
+LUT_MAX_WATER_PATH = 300.0
+
+
+def _column_lut(transmittance, max_path, max_error):
+    step = 1.0
+    while True:
+        roots = step*np.arange(int(np.ceil(np.sqrt(max_path) / step)) + 1)
+        table = transmittance(10*roots**2, 1.0)
+        midpoints = transmittance(10*((roots[:-1] + roots[1:])/2)**2, 1.0)
+        error = np.abs((table[:-1] + table[1:])/2 - midpoints).max()
+        if error <= max_error:
+            return step, table, error
+        step /= 2
+
+
+def column_transmittance_lut(max_error=LUT_MAX_ERROR):
+    """Lookup tables for the ozone and water vapour transmittances of the
+    samples of :func:`clear_sky_uncertainty`.
+
+    Both only depend on the column amount times the air mass, the path. They
+    are tabulated on a regular axis of its square root, which keeps the
+    steep start of the curves smooth, from zero to LUT_MAX_OZONE_PATH and
+    LUT_MAX_WATER_PATH. The spacing is halved until linear interpolation is
+    within `max_error` at every interval midpoint, as in
+    :func:`transmittance_lut`. Longer paths are evaluated directly.
+
+    Returns
+    -------
+    ozone, water : tuple
+        The square root spacing, the table and the maximum interpolation
+        error observed at the midpoints, for each gas.
+    """
+    return (
+        _column_lut(ozone_transmittance, LUT_MAX_OZONE_PATH, max_error),
+        _column_lut(water_vapor_transmittance, LUT_MAX_WATER_PATH, max_error)
+    )
+
+
+# Built at import and frozen into the kernels, as the gas tables.
+(_OZONE_STEP, _OZONE, _OZONE_ERROR), (_WATER_STEP, _WATER, _WATER_ERROR) = column_transmittance_lut()
+
+
+@jit(nopython=True, cache=True)
+def _lookup_ozone_transmittance(oz, geo_air_mass):
+    # Interpolated within LUT_MAX_ERROR, see column_transmittance_lut.
+    k = np.sqrt(oz * geo_air_mass / 10) / _OZONE_STEP
+    if not k < _OZONE.shape[0]-1:
+        return ozone_transmittance(oz, geo_air_mass)
+    i = int(k)
+    return _OZONE[i] + (k-i)*(_OZONE[i+1]-_OZONE[i])
+
+
+@jit(nopython=True, cache=True)
+def _lookup_water_vapor_transmittance(wv, geo_air_mass):
+    # Interpolated within LUT_MAX_ERROR, see column_transmittance_lut.
+    k = np.sqrt(wv * geo_air_mass / 10) / _WATER_STEP
+    if not k < _WATER.shape[0]-1:
+        return water_vapor_transmittance(wv, geo_air_mass)
+    i = int(k)
+    return _WATER[i] + (k-i)*(_WATER[i+1]-_WATER[i])
+
+
+@jit(nopython=True, cache=True)
+def _sample_irradiance(tsi, sin_elev, cos_aoi, geo_air_mass, powers, Tr, Tg, oz, wv, aerosol, albedo, cloud_index, svf, ground_view):
+    # Plane of array irradiance of one sample of a pixel, with the powers of
+    # the air mass and the view factor of the ground computed once per pixel
+    # and the column transmittances looked up, see _irradiance_budget.
+    To = _lookup_ozone_transmittance(oz, geo_air_mass)
+    Tw = _lookup_water_vapor_transmittance(wv, geo_air_mass)
+    Ta = np.exp(-aerosol * powers[0])
+    return _irradiance_budget(tsi, sin_elev, cos_aoi, powers, Tr, Tg, To, Tw, Ta, albedo, svf, ground_view)[0]*cloud_index
+
+
+@jit(nopython=True, cache=True)
+def _insertion_argsort(order, values):
+    # Sort the indices in `order` by `values` in place. Neighbouring pixels
+    # rank their samples almost alike, so starting from the order of the last
+    # pixel this takes close to one pass.
+    for i in range(1, len(order)):
+        index = order[i]
+        value = values[index]
+        j = i - 1
+        while j >= 0 and values[order[j]] > value:
+            order[j+1] = order[j]
+            j -= 1
+        order[j+1] = index
+
+
+@jit(nopython=True, cache=True)
+def _sorted_quantile(values, order, n, q):
+    # Quantile of the n smallest values, ranked by order, with linear
+    # interpolation as np.quantile.
+    if n == 1:
+        return values[order[0]]
+    position = q*(n-1)
+    i = min(int(position), n-2)
+    return values[order[i]] + (position-i)*(values[order[i+1]]-values[order[i]])
+
+
+@njit(parallel=True, cache=True)
+def clear_sky_uncertainty(elevs, aois, elev_rows, elev_cols, dem, spans, oz_samples, wv_samples, aod_samples, angstrom_samples, albedo_samples, clouds, cams_rows, cams_cols, meteosat_rows, meteosat_cols, year, month, day, quantiles, out, azis=None, slopes=None, aspects=None, svfs=None, tile_size=UNCERTAINTY_TILE_SIZE):
+    """Monte Carlo uncertainty of :func:`clear_sky_irradiance` from K
+    perturbed input sets per coarse cell, evaluated together.
+
+    The samples of a pixel share its interpolated solar geometry, air masses
+    and Rayleigh and mixed gas transmittances, and the part of the aerosol
+    transmittance that does not depend on the air mass is computed once per
+    cell and sample. Only the ozone, water vapour and aerosol transmittances
+    and the diffuse and reflected parts are evaluated per sample, the first
+    two from the tables of :func:`column_transmittance_lut`, so K samples
+    cost far less than K runs. The quantiles come from ranking the
+    K values of a pixel, starting from the ranks of the previous pixel.
+
+    Parameters
+    ----------
+    oz_samples, wv_samples, aod_samples, angstrom_samples, albedo_samples : array
+        Samples of the inputs on their coarse grids, with a trailing axis of
+        length K, see :func:`input_samples`. The Angstrom exponents replace
+        the fixed one of :func:`aerosol_transmittance`.
+
+    quantiles : array
+        Quantiles to write, between 0 and 1.
+
+    out : array
+        Preallocated float64 output of shape (1 + len(quantiles),) +
+        dem.shape. Filled with the mean and the quantiles of the plane of
+        array irradiance in W m**-2 over the finite samples, zero where the
+        sun is below the horizon and -32768 outside the DEM.
+
+    tile_size : int
+        Side in pixels of the tiles the pixels are visited in,
+        UNCERTAINTY_TILE_SIZE by default.
+
+    The terrain parameters `azis`, `slopes`, `aspects` and `svfs` are those
+    of :func:`clear_sky_components`, and the other parameters those of
+    :func:`clear_sky_irradiance`.
     """
-    # Calculate total solar irradiation
     radius = radius_correction(year, month, day)
     tsi = total_solar_irradiance(radius)
-    irradiance = np.full(dem.shape, -32768.0)
+    n_samples = oz_samples.shape[-1]
+    aerosol_samples = _aerosol_coefficients(aod_samples, angstrom_samples)
+    out[:] = -32768.0
 
-    # Calculate stepsizes
     n_rows, n_cols = dem.shape
-    elev_stepsize = np.round(n_rows / elevs.shape[0])
-    trans_stepsize = np.round(n_rows / ozs.shape[0])
-    albedo_stepsize = np.round(n_rows / albedos.shape[0])
+    row_ptr, starts, stops = spans
+    row_lower, row_weights = lattice_weights(elev_rows, n_rows)
+    col_lower, col_weights = lattice_weights(elev_cols, n_cols)
 
-    # Geometric air mass
-    geo_air_mass = 1/np.sin(elevs)
+    n_tile_rows = (n_rows + tile_size - 1) // tile_size
+    n_tile_cols = (n_cols + tile_size - 1) // tile_size
+    for tile in prange(n_tile_rows*n_tile_cols):
+        x0 = tile // n_tile_cols * tile_size
+        y0 = tile % n_tile_cols * tile_size
+        x1 = min(x0 + tile_size, n_rows)
+        y1 = min(y0 + tile_size, n_cols)
+        max_elev = _tile_max_elevation(elevs, row_lower, col_lower, x0, x1, y0, y1)
+        values = np.empty(n_samples)
+        order = np.arange(n_samples)
 
-    # Calculate transmittances
-    for y in prange(n_cols):
-        # if y % (n_cols // 100) == 0:
-        #     print(100*y/n_cols, 'percent done')
-        for x in range(n_rows):
-            if dem[x, y] == -32768:
-               continue
-            cur_altitude = dem[x, y]
-            x_elev = int(x/elev_stepsize)
-            y_elev = int(y/elev_stepsize)
-
-            x_trans = np.abs(np.arange(ozs.shape[0])-int(x/trans_stepsize)).argmin()
-            y_trans = np.abs(np.arange(ozs.shape[1])-int(y/trans_stepsize)).argmin()
-
-            x_alb = np.abs(np.arange(albedos.shape[0])-int(x/albedo_stepsize)).argmin()
-            y_alb = np.abs(np.arange(albedos.shape[1])-int(y/albedo_stepsize)).argmin()
-
-            # Calculate atmospheric adjusted air mass
-            cur_geo_air_mass = geo_air_mass[x_elev, y_elev]
-            cur_atm_air_mass = atmospheric_air_mass(cur_geo_air_mass, cur_altitude)
-            #air_mass[x, y] = cur_geo_air_mass * np.exp(-0.000832 * cur_altitude / 1000)
-
-            ### DIRECT NORMAL IRRADIANCE
-            # Calculate rayleigh transmittance
-            Tr = rayleigh_transmittance(cur_atm_air_mass)
-
-            # Calculate mixed gas transmittance
-            Tg = mixed_gas_transmittance(cur_atm_air_mass)
-
-            # Calculate ozone transmittance
-            To = ozone_transmittance(ozs[x_trans, y_trans], cur_geo_air_mass)
-
-            # Calculate water vapour transmittance
-            Tw = water_vapor_transmittance(wvs[x_trans, y_trans], cur_geo_air_mass)
-
-            # Calculate aerosol transmittance
-            Ta = aerosol_transmittance(aods[x_trans, y_trans], cur_geo_air_mass)
-
-            # Calculate total transmittance
-            total_trans = Tr * Tg * To * Tw * Ta
-
-            # Calculate DNI
-            dni = tsi * total_trans
-            
-            ### DIFFUSE HORIZONTAL IRRADIANCE
-            # Calculate aerosol absorptance
-            Taa = aerosol_absorptance(cur_geo_air_mass, Ta)
-
-            # Calculate sky diffuse irradiance
-            Ds = sky_diffuse_radiation(tsi, elevs[x_elev, y_elev], Tg, To, Tw, Taa)
-
-            # Calculate DHI
-            dhi = direct_horizontal_irradiance(dni, elevs[x_elev, y_elev], Ds, cur_geo_air_mass, Tr, Ta, Taa, albedos[x_alb, y_alb])
-
-            ### GROUND REFLECTED IRRADIANCE
-            Eg = ground_reflected_irradiance(dni, dhi, elevs[x_elev, y_elev], albedos[x_alb, y_alb])
-
-            ### IRRADIANCE
-            aoi = aois[x_elev, y_elev]
-            clear = dni*np.cos(aoi) + dhi + Eg
-            # Check if cloud
-            cloud_index = 1
-            if clouds[x_alb, y_alb] != -32768:
-                cloud_index -= clouds[x_alb, y_alb]
-            irradiance[x, y] = clear * cloud_index
-            #irradiance[x, y] = Taa
-
-            # if x % 2500 == 0:
-            #     print('taa', Taa)
-            #     print('ta', Ta)
-            #     print('dni', dni)
-            #     print('tr', Tr)
-            #     print('ds', Ds)
-    return irradiance
-    
\ No newline at end of file
+        for x in range(x0, x1):
+            for span in range(row_ptr[x], row_ptr[x+1]):
+                for y in range(max(starts[span], y0), min(stops[span], y1)):
+                    if dem[x, y] == -32768:
+                        continue
+                    if max_elev <= 0:
+                        out[:, x, y] = 0
+                        continue
+                    cur_elev = bilinear(elevs, row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+                    if cur_elev <= 0:
+                        out[:, x, y] = 0
+                        continue
+                    if slopes is None:
+                        aoi = clip_angle_of_incidence(
+                            bilinear(aois, row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+                        )
+                        tilt = 0.10471975511965978
+                    else:
+                        cur_azi = bilinear_angle(azis, row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+                        aoi = clip_angle_of_incidence(incidence_angle(cur_elev, cur_azi, slopes[x, y], aspects[x, y]))
+                        tilt = slopes[x, y]
+                    svf = 1.0 if svfs is None else svfs[x, y]
+
+                    # Geometry shared by every sample
+                    sin_elev = np.sin(cur_elev)
+                    cos_aoi = np.cos(aoi)
+                    geo_air_mass = 1/sin_elev
+                    powers = _air_mass_powers(geo_air_mass)
+                    ground_view = _ground_view_factor(tilt, svf)
+                    Tr, Tg = _lookup_gas_transmittances(_lookup_atm_air_mass(geo_air_mass, dem[x, y]))
+                    x_trans, y_trans = cams_rows[x], cams_cols[y]
+                    x_alb, y_alb = meteosat_rows[x], meteosat_cols[y]
+                    cloud_index = 1.0
+                    if clouds[x_alb, y_alb] != -32768:
+                        cloud_index -= clouds[x_alb, y_alb]
+
+                    total = 0.0
+                    n_valid = 0
+                    for k in range(n_samples):
+                        value = _sample_irradiance(
+                            tsi, sin_elev, cos_aoi, geo_air_mass, powers, Tr, Tg,
+                            oz_samples[x_trans, y_trans, k], wv_samples[x_trans, y_trans, k],
+                            aerosol_samples[x_trans, y_trans, k], albedo_samples[x_alb, y_alb, k],
+                            cloud_index, svf, ground_view
+                        )
+                        # Rank non-finite samples last and leave them out.
+                        if np.isfinite(value):
+                            total += value
+                            n_valid += 1
+                        else:
+                            value = np.inf
+                        values[k] = value
+                    if n_valid == 0:
+                        continue
+
+                    _insertion_argsort(order, values)
+                    out[0, x, y] = total / n_valid
+                    for q in range(len(quantiles)):
+                        out[1+q, x, y] = _sorted_quantile(values, order, n_valid, quantiles[q])
+
+
+def clear_sky_uncertainty_windows(elevation, path, elevs, aois, elev_rows, elev_cols, ozs, wvs, aods, albedos, clouds, cams_rows, cams_cols, meteosat_rows, meteosat_cols, year, month, day, n_samples=32, quantiles=UNCERTAINTY_QUANTILES, uncertainty=INPUT_UNCERTAINTY, seed=None, max_memory=2*1024**3, spans=None, azis=None, slope=None, aspect=None, sky_view=None):
+    """Monte Carlo uncertainty of the clear sky irradiance of a whole DEM
+    raster, streamed window by window into a GeoTIFF with the bands of
+    :func:`uncertainty_bands`.
+
+    The samples are drawn once for the whole coarse grids with
+    :func:`input_samples`, so that windows agree at their edges, and every
+    window is evaluated with :func:`clear_sky_uncertainty`. See
+    :func:`clear_sky_irradiance_windows` for the other parameters, including
+    the terrain.
+    """
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    samples = input_samples(ozs, wvs, aods, albedos, n_samples, uncertainty, seed)
+    band_names = uncertainty_bands(quantiles)
+    if spans is None:
+        spans = valid_spans(elevation.transform, elevation.height, elevation.width)
+
+    def window_uncertainty(window, dem):
+        rows, cols = window.toslices()
+        r0, r1, window_rows = lattice_window(elev_rows, rows.start, rows.stop)
+        c0, c1, window_cols = lattice_window(elev_cols, cols.start, cols.stop)
+        out = np.empty((len(band_names),) + dem.shape)
+        terrain = _window_terrain(window, r0, r1, c0, c1, azis, slope, aspect)
+        clear_sky_uncertainty(
+            np.ascontiguousarray(elevs[r0:r1, c0:c1]),
+            np.ascontiguousarray(aois[r0:r1, c0:c1]),
+            window_rows,
+            window_cols,
+            dem,
+            window_spans(spans, rows.start, cols.start, *dem.shape),
+            *samples,
+            clouds,
+            cams_rows[rows],
+            cams_cols[cols],
+            meteosat_rows[rows],
+            meteosat_cols[cols],
+            year,
+            month,
+            day,
+            quantiles,
+            out,
+            *terrain,
+            **_window_sky_view(window, sky_view)
+        )
+        return out
+
+    # The bands and their float32 copies, the DEM, the terrain and the sky
+    # view factor.
+    bytes_per_pixel = len(band_names)*(8 + 4) + 2 + 8 + 4
+    map_raster_windows(
+        window_uncertainty, elevation, path, max_memory, bytes_per_pixel, band_names=band_names
+    )
@@ -1,189 +1,1095 @@
+import hashlib
+from functools import lru_cache
+from pathlib import Path
+
 import numpy as np
-from numba import jit
+import rasterio as rio
+from numba import jit, njit, prange, get_num_threads
+from rasterio.transform import Affine
+from rasterio.windows import Window
 
-from ..spa import solar_position
+from config import TERRAIN_DIRECTORY
+from ..utils import coordinate_axes, map_raster_windows, raster_windows
 
 
-def shadows(elevation_map, azimuth_angle, elevation_angle, nodata=-32768):
-    shadows = np.full(elevation_map.shape, nodata, dtype=np.int16)
+def shadows(horizons, azimuth_angle, elevation_angle, nodata=-32768):
+    """Shadow map of a DEM for one sun position, looked up in its horizon
+    angles from :func:`horizon_angles`.
 
-    # Change azimuth and elevation angles to radians.
-    azimuth_angle = _deg_to_rad(azimuth_angle)
-    elevation_angle = _deg_to_rad(elevation_angle)
-    
-    elevation_map = _orient_map(elevation_map, azimuth_angle)
+    Parameters
+    ----------
+    horizons : array
+        Int16 horizon angles of the DEM, one band per azimuth sector.
 
+    azimuth_angle, elevation_angle : float
+        Sun azimuth (eastward from north) and elevation (in degrees).
 
-def _orient_map(elevation_map, azimuth_angle):
-    if 0 <= azimuth_angle < 90:
-        return np.rot90(elevation_map, axes=(1, 0))
-    else:
-        NotImplementedError()
+    Returns
+    -------
+    shadows : array
+        Int16 array, 1 in shadow, 0 in the sun and nodata outside the DEM.
+    """
+    elevs = np.full((1, 1), np.radians(elevation_angle))
+    azis = np.full((1, 1), _deg_to_rad(azimuth_angle))
+    shadows = horizon_shadow_mask(horizons, elevs, azis).astype(np.int16)
+    shadows[horizons[0] == nodata] = nodata
+    return shadows
 
 
 def _deg_to_rad(angle):
     return (angle % 360) * np.pi / 180
 
 
-@jit(nopython=True)
-def calc_shadow_mask(dem, elevs, azis):
-    """TBA.
-    """
-    # Calculate stepsize.
-    stepsize = np.round(dem.shape[0] / elevs.shape[0])
+# Bands of the terrain rasters of slope_aspect_rasters.
+TERRAIN_BANDS = ['slope', 'aspect']
+
+
+@jit(nopython=True, cache=True)
+def _neighbour(dem, x, y, center, nodata):
+    if 0 <= x < dem.shape[0] and 0 <= y < dem.shape[1] and dem[x, y] != nodata:
+        return float(dem[x, y])
+    return center
+
+
+@njit(parallel=True, cache=True)
+def slope_aspect(dem, dxs, dy, nodata=-32768):
+    """Slope and aspect of every pixel of a DEM from Horn's 3x3 stencil.
+
+    Neighbours outside the DEM or without data take the value of the
+    center pixel, so that the edges of the DEM get a one-sided estimate.
+
+    Parameters
+    ----------
+    dem : array
+        Array of altitudes (in meters).
+
+    dxs : array
+        Width of a pixel of every row (in meters), which shrinks with the
+        latitude on a geographic grid.
+
+    dy : float
+        Height of a pixel (in meters). Rows run south.
 
-    # Initiate shadow mask.
+    Returns
+    -------
+    slopes, aspects : array
+        Float32 arrays of the slope and of the azimuth the slope faces,
+        eastward from north (in radians), nodata outside the DEM. Flat
+        pixels face north.
+    """
     n_rows, n_cols = dem.shape
-    shadow_mask = np.full(dem.shape, 0, dtype=np.bool_)
-    
-    for y in range(n_cols):
-        if y % (n_cols // 10) == 0:
-            print(int(100*y/n_cols), 'percent done.')
-        for x in range(n_rows):
-            cur_altitude = dem[x, y]
-            x_ = int(x/stepsize)
-            y_ = int(y/stepsize)
-            cur_elevation = elevs[x_, y_]
-            cur_azimuth = azis[x_, y_]
-
-            # Change altitude and azimuth to radians.
-            #cur_elevation = (cur_elevation % 360) * np.pi / 180
-            #cur_azimuth = (cur_azimuth % 360) * np.pi / 180 # Minus 90 to fit the map's coordinate system.
-
-            # Calculate the distance of the shadow cast by the current square.
-            shadow_dist = cur_altitude / np.tan(cur_elevation)
-
-            # Find the square where the shadow ends.
-            if 0 <= cur_azimuth < np.pi/2:
-                delta_x = int(np.floor(shadow_dist * np.cos(cur_azimuth) / 30))
-                delta_y = int(np.floor(shadow_dist * np.sin(cur_azimuth) / 30))
-                x_end = x + delta_x
-                y_end = y - delta_y
-            elif np.pi/2 <= cur_azimuth < np.pi:
-                delta_x = int(np.floor(shadow_dist * np.sin(cur_azimuth-np.pi/2) / 30))
-                delta_y = int(np.floor(shadow_dist * np.cos(cur_azimuth-np.pi/2) / 30))
-                x_end = x - delta_x
-                y_end = y - delta_y
-            elif np.pi <= cur_azimuth < 3*np.pi/2:
-                delta_x = int(np.floor(shadow_dist * np.cos(cur_azimuth-np.pi) / 30))
-                delta_y = int(np.floor(shadow_dist * np.sin(cur_azimuth-np.pi) / 30))
-                x_end = x - delta_x
-                y_end = y + delta_y
+    slopes = np.full(dem.shape, nodata, dtype=np.float32)
+    aspects = np.full(dem.shape, nodata, dtype=np.float32)
+    for x in prange(n_rows):
+        for y in range(n_cols):
+            if dem[x, y] == nodata:
+                continue
+            center = float(dem[x, y])
+            nw = _neighbour(dem, x-1, y-1, center, nodata)
+            n = _neighbour(dem, x-1, y, center, nodata)
+            ne = _neighbour(dem, x-1, y+1, center, nodata)
+            w = _neighbour(dem, x, y-1, center, nodata)
+            e = _neighbour(dem, x, y+1, center, nodata)
+            sw = _neighbour(dem, x+1, y-1, center, nodata)
+            s = _neighbour(dem, x+1, y, center, nodata)
+            se = _neighbour(dem, x+1, y+1, center, nodata)
+            dz_east = ((ne + 2*e + se) - (nw + 2*w + sw)) / (8*dxs[x])
+            dz_south = ((sw + 2*s + se) - (nw + 2*n + ne)) / (8*dy)
+            slopes[x, y] = np.arctan(np.sqrt(dz_east**2 + dz_south**2))
+            aspects[x, y] = np.arctan2(-dz_east, dz_south) % (2*np.pi)
+    return slopes, aspects
+
+
+def slope_aspect_windows(elevation, paths, max_memory=2*1024**3, radius=6378000):
+    """Slope and aspect of a geographic DEM raster with :func:`slope_aspect`,
+    streamed window by window into GeoTIFFs on the same grid.
+
+    Parameters
+    ----------
+    elevation : rasterio.DatasetReader
+        The DEM, on a north-up EPSG:4326 grid.
+
+    paths : list of Path
+        One output per name in TERRAIN_BANDS, in that order.
+    """
+    _, lats = coordinate_axes(elevation.transform, elevation.height, elevation.width)
+    meters_per_degree = np.pi*radius/180
+    dxs = elevation.transform.a*meters_per_degree*np.cos(np.radians(lats))
+    dy = -elevation.transform.e*meters_per_degree
+
+    def window_slope_aspect(window, dem):
+        rows = np.arange(window.row_off-1, window.row_off+window.height+1).clip(0, len(lats)-1)
+        slopes, aspects = slope_aspect(dem, dxs[rows], dy, elevation.nodata)
+        return np.stack([slopes, aspects])[:, 1:-1, 1:-1]
+
+    # The padded DEM, the slope and aspect and their stacked copy.
+    bytes_per_pixel = 2 + 2*(4 + 4) + 2*4
+    map_raster_windows(
+        window_slope_aspect, elevation, paths, max_memory, bytes_per_pixel, halo=1
+    )
+
+
+@lru_cache(maxsize=None)
+def _file_digest(path, size, modified):
+    # Digest of the contents of a file, computed once per size and
+    # modification time.
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(2**24), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _dem_digest(elevation):
+    # Keyed by the contents of the DEM rather than its grid, as the valid
+    # spans are by those of the shapefile, so that rasters built from an
+    # older DEM on the same grid are not reused.
+    stat = Path(elevation.name).stat()
+    return _file_digest(elevation.name, stat.st_size, stat.st_mtime_ns)
+
+
+def _open_derived(elevation, paths):
+    # The rasters at `paths` if all were built from the current contents of
+    # the DEM raster, see _tag_derived, else None.
+    if not all(path.exists() for path in paths):
+        return None
+    rasters = [rio.open(path) for path in paths]
+    digest = _dem_digest(elevation)
+    if all(raster.tags().get('DEM_DIGEST') == digest for raster in rasters):
+        return rasters
+    for raster in rasters:
+        raster.close()
+    return None
+
+
+def _tag_derived(elevation, paths):
+    # Tag the rasters built from the DEM raster with the digest of its
+    # contents, see _open_derived.
+    digest = _dem_digest(elevation)
+    for path in paths:
+        with rio.open(path, 'r+') as raster:
+            raster.update_tags(DEM_DIGEST=digest)
+
+
+def slope_aspect_rasters(elevation, directory=TERRAIN_DIRECTORY, max_memory=2*1024**3):
+    """Slope and aspect rasters on the grid of a DEM raster, built once with
+    :func:`slope_aspect_windows` and reused while the DEM is unchanged.
+
+    The rasters are tagged with a digest of the contents of the DEM, and
+    rebuilt when it no longer matches.
+
+    Returns
+    -------
+    slope, aspect : rasterio.DatasetReader
+        The open terrain rasters, in radians.
+    """
+    paths = [directory / f'{name}.tif' for name in TERRAIN_BANDS]
+    terrain = _open_derived(elevation, paths)
+    if terrain is not None:
+        return terrain
+    directory.mkdir(parents=True, exist_ok=True)
+    slope_aspect_windows(elevation, paths, max_memory)
+    _tag_derived(elevation, paths)
+    return [rio.open(path) for path in paths]
+
+
+@njit(parallel=True, cache=True)
+def calc_shadow_mask(dem, spans, elevs, azis, n_tiles=1, pyramid=None):
+    """Shadow mask of a DEM, swept along the sun azimuth with a running
+    horizon envelope.
+
+    The DEM is split into the blocks of `stepsize` pixels that share a sun
+    position on the coarse grid of `elevs` and `azis`. The pixels of a block
+    are swept along lines that follow the direction of the shadow exactly,
+    one pixel apart, from far enough up-sun to meet every pixel whose shadow
+    can reach the block, given the relief. The terrain is interpolated
+    across a line between the two pixels on either side of it, and a point
+    of the line decides the pixel nearest to it, as in
+    :func:`horizon_angles`. A point is in shadow if the ray of a point
+    before it on its line passes at or above it. A ray stopped by the
+    terrain is overtaken by the ray of the terrain that stopped it, so the
+    running maximum of the altitude of the points plus the drop of their
+    rays so far decides every pixel in O(1). Lines are swept in parallel,
+    SWEEP_LINES at a time, and if that makes fewer than `n_tiles` work
+    items, the blocks are also cut into tiles along the sweep, each swept
+    from its own halo up-sun as long as the longest shadow onto it, so
+    that every core has work. With a max-elevation pyramid, the sweep of
+    a halo skips the cells too low to shadow the block it leads into, so
+    that a low sun costs little more than a high one.
+
+    Along the rows and columns, on terrain above sea level, this is the
+    mask of casting a ray from every valid pixel along the Bresenham lines
+    of :func:`get_line`. At other azimuths those lines step sideways toward
+    where each ray ends, and the lines here follow the sun: on smooth
+    terrain the mask is within about one percent of the pixels of marching
+    a ray from every pixel over the bilinear terrain, at the edges of the
+    shadows, and as close to the horizons of :func:`horizon_angles`, which
+    sample the terrain in the same way.
+
+    Parameters
+    ----------
+    dem : array
+        Array of altitudes (in meters) on a 30 m grid.
+
+    spans : tuple
+        Row spans of the valid pixels of the DEM, the only ones that cast
+        shadows or are shadowed, see
+        :func:`src.feature_engineering.valid_spans`.
+
+    elevs, azis : array
+        Sun elevations and azimuths (eastward from north) on a coarse grid
+        (in radians). Pixel (x, y) is shadowed with the sun of its block
+        (x // stepsize, y // stepsize), stepsize being the ratio of the
+        number of rows.
+
+    n_tiles : int
+        Least number of work items to run in parallel, typically the
+        number of threads. Tiles are never shorter than their halo, so the
+        halos at most double the work.
+
+    pyramid : tuple, optional
+        Max-elevation pyramid of the DEM, see :func:`max_pyramid`. The
+        halos are swept whole without it.
+
+    Returns
+    -------
+    shadow_mask : array
+        Boolean array, True for the valid pixels in shadow or with the sun
+        below the horizon.
+    """
+    valid = np.zeros(dem.shape, dtype=np.bool_)
+    row_ptr, starts, stops = spans
+    for x in prange(dem.shape[0]):
+        for span in range(row_ptr[x], row_ptr[x+1]):
+            valid[x, starts[span]:stops[span]] = True
+    if pyramid is None:
+        return _sweep_shadow_mask(dem, valid, elevs, azis, 0, 0, 0, n_tiles, _no_pyramid())
+    return _sweep_shadow_mask(dem, valid, elevs, azis, 0, 0, 0, n_tiles, pyramid)
+
+
+# Sweep lines of calc_shadow_mask and horizon_angles handled by one parallel
+# work item.
+SWEEP_LINES = 64
+
+
+@jit(nopython=True, cache=True)
+def _sweep_direction(azimuth):
+    # Sweep lines along the shadow of a sun at `azimuth`: the major axis (0
+    # for rows, 1 for columns) they advance one pixel per step along, the
+    # sign of that step, the minor offset per step and the length of a step
+    # in pixels.
+    d_row, d_col = np.cos(azimuth), -np.sin(azimuth)
+    if abs(d_row) >= abs(d_col):
+        return 0, 1 if d_row >= 0 else -1, d_col/abs(d_row), 1/abs(d_row)
+    return 1, 1 if d_col >= 0 else -1, d_row/abs(d_col), 1/abs(d_col)
+
+
+@jit(nopython=True, cache=True)
+def _line_altitude(dem, valid, major, a, b, w, n_minor):
+    # Altitude of the terrain at minor coordinate b + w of major index a,
+    # 0 <= w < 1, linear between the two pixels around it, or the one of
+    # them that is valid. NaN if neither is.
+    lower, upper = np.nan, np.nan
+    if 0 <= b < n_minor:
+        lower = dem[a, b] if major == 0 else dem[b, a]
+        lower = lower if (valid[a, b] if major == 0 else valid[b, a]) else np.nan
+    if 0 <= b+1 < n_minor and w > 0:
+        upper = dem[a, b+1] if major == 0 else dem[b+1, a]
+        upper = upper if (valid[a, b+1] if major == 0 else valid[b+1, a]) else np.nan
+    if np.isnan(upper):
+        return lower
+    if np.isnan(lower):
+        return upper
+    return lower + w*(upper-lower)
+
+
+# Azimuth sectors of the horizon angles, the int16 units per radian they are
+# stored in and the sun elevation above which they are exact.
+HORIZON_SECTORS = 72
+HORIZON_SCALE = 20000
+HORIZON_MIN_ELEVATION = np.radians(2)
+
+
+def horizon_bands(n_sectors=HORIZON_SECTORS):
+    """Names of the bands of the horizon rasters, one per azimuth sector."""
+    return [f'azimuth_{360*sector/n_sectors:g}' for sector in range(n_sectors)]
+
+
+@jit(nopython=True, cache=True)
+def _sweep_horizons(dem, valid, horizons, x0, x1, y0, y1, azimuth, n_halo, first_line, last_line, hull_distances, hull_altitudes):
+    # Horizon angles toward `azimuth` of the pixels of [x0, x1) x [y0, y1),
+    # along lines that follow the azimuth exactly, one pixel apart, swept
+    # from n_halo steps before the block. The terrain is interpolated across
+    # a line, and a point of it decides the pixel nearest to it. The steepest
+    # elevation from a point to the terrain before it on its line is that of
+    # the tangent to the upper convex hull of the profile, which is updated
+    # in amortized O(1) per point as in Dozier and Frew (1990).
+    major, step, slope, step_length = _sweep_direction(azimuth)
+    if major == 0:
+        a0, a1, b0, b1, n_major, n_minor = x0, x1, y0, y1, dem.shape[0], dem.shape[1]
+    else:
+        a0, a1, b0, b1, n_major, n_minor = y0, y1, x0, x1, dem.shape[1], dem.shape[0]
+    entry = a0 if step > 0 else a1-1
+    end_offset = int(np.floor(slope*(a1-a0-1) + 0.5))
+    first_minor = b0 - max(end_offset, 0)
+    k_start = max(n_halo - (entry if step > 0 else n_major-1-entry), 0)
+
+    for line in range(first_line, last_line):
+        c = first_minor + line
+        n_hull = 0
+        for k in range(k_start, n_halo + a1-a0):
+            a = entry + step*(k-n_halo)
+            f = c + slope*(k-n_halo)
+            b = int(np.floor(f + 0.5))
+            if not 0 <= b < n_minor:
+                continue
+            if major == 0:
+                x, y = a, b
             else:
-                delta_x = int(np.floor(shadow_dist * np.sin(cur_azimuth-(3*np.pi/2)) / 30))
-                delta_y = int(np.floor(shadow_dist * np.cos(cur_azimuth-(3*np.pi/2)) / 30))
-                x_end = x + delta_x
-                y_end = y + delta_y
-
-            # Adjust if the end square is out of bounds.
-            if x_end >= n_rows:
-                x_end = int(n_rows-1)
-            elif x_end < 0:
-                x_end = 0
-            
-            if y_end >= n_cols:
-                y_end = int(n_cols-1)
-            elif y_end < 0:
-                y_end = 0
-            
-            # Use Bresenham's algorithm to find all squares between current and end square.
-            shadow_squares = get_line((x, y), (x_end, y_end))
-
-            # Skip the first square as it's the current square.
-            for shadow_square in shadow_squares[1:]: 
-                # Calculate distance from shadow square to start square.
-                dist_to_cur_square = np.sqrt((x-shadow_square[0])**2 + (y-shadow_square[1])**2)
-
-                # Calculate if the shadow square is low enough to be covered by the shadow,
-                # and remember to multiply by 30 to accomodate the resolution of the map.
-                if dem[shadow_square] <= cur_altitude - 30 * dist_to_cur_square * np.tan(cur_elevation):
-                    shadow_mask[shadow_square] = 1
-                else:
-                    # Since the shadow squares are ordered, we skip the rest,
-                    # if we run into a shadow square that isnt covered.
-                    break
+                x, y = b, a
+            if not valid[x, y]:
+                continue
+            altitude = _line_altitude(dem, valid, major, a, int(np.floor(f)), f - np.floor(f), n_minor)
+            distance = 30*step_length*k
+
+            # Drop the points of the hull below the segment to this one.
+            while n_hull >= 2 and (
+                (hull_altitudes[n_hull-1] - altitude)*(distance - hull_distances[n_hull-2])
+                <= (hull_altitudes[n_hull-2] - altitude)*(distance - hull_distances[n_hull-1])
+            ):
+                n_hull -= 1
+            if k >= n_halo and b0 <= b < b1:
+                horizon = 0.0
+                if n_hull:
+                    rise = hull_altitudes[n_hull-1] - altitude
+                    horizon = max(np.arctan(rise / (distance - hull_distances[n_hull-1])), 0.0)
+                horizons[x-x0, y-y0] = np.int16(np.round(horizon*HORIZON_SCALE))
+            hull_distances[n_hull] = distance
+            hull_altitudes[n_hull] = altitude
+            n_hull += 1
+
+
+@njit(parallel=True, cache=True)
+def horizon_angles(dem, n_sectors=HORIZON_SECTORS, min_elevation=HORIZON_MIN_ELEVATION, halo=0):
+    """Horizon angles of every pixel of a DEM toward `n_sectors` azimuths.
+
+    The horizon toward an azimuth is the steepest elevation from the pixel
+    to the terrain in that direction, along lines that follow the azimuth
+    over the terrain interpolated between pixels, which are swept in
+    parallel, sector by sector. A pixel is in shadow when the sun is at or below the horizon
+    toward it, so the angles decide the shadows of every sun position.
+
+    Lines start far enough away for the horizon to be exact from
+    `min_elevation` up, given the relief of the DEM. Lower horizons,
+    which only the sun just after sunrise and before sunset would fall
+    below, are lower bounds.
+
+    Parameters
+    ----------
+    dem : array
+        Array of altitudes (in meters) on a 30 m grid.
+
+    n_sectors : int
+        Number of azimuths, eastward from north starting at north.
+
+    min_elevation : float
+        Lowest exact horizon angle (in radians).
+
+    halo : int
+        Pixels of context on every side of the DEM, which cast horizons
+        but get none.
+
+    Returns
+    -------
+    horizons : array
+        Int16 array of shape (n_sectors, rows, columns) without the halo, of
+        the horizon angles in 1 / HORIZON_SCALE radians, no lower than
+        zero, and -32768 for the pixels without data.
+    """
+    n_rows, n_cols = dem.shape
+    x0, x1, y0, y1 = halo, n_rows-halo, halo, n_cols-halo
+    horizons = np.full((n_sectors, x1-x0, y1-y0), -32768, dtype=np.int16)
+    valid = dem != -32768
+    if not valid[x0:x1, y0:y1].any():
+        return horizons
+    relief = dem.ravel()[valid.ravel()].max() - dem[x0:x1, y0:y1].ravel()[valid[x0:x1, y0:y1].ravel()].min()
+
+    # Work items of SWEEP_LINES lines of a sector each.
+    halos = np.zeros(n_sectors, dtype=np.int64)
+    n_lines = np.zeros(n_sectors, dtype=np.int64)
+    for sector in range(n_sectors):
+        major, _, slope, step_length = _sweep_direction(2*np.pi*sector/n_sectors)
+        length = x1-x0 if major == 0 else y1-y0
+        n_lines[sector] = (y1-y0 if major == 0 else x1-x0) + abs(int(np.floor(slope*(length-1) + 0.5)))
+        halos[sector] = int(np.ceil(relief / (30*np.tan(min_elevation)*step_length))) + 1
+    sector_items = (n_lines + SWEEP_LINES - 1) // SWEEP_LINES
+    item_ptr = np.zeros(n_sectors+1, dtype=np.int64)
+    item_ptr[1:] = np.cumsum(sector_items)
+
+    for item in prange(item_ptr[-1]):
+        sector = np.searchsorted(item_ptr, item, side='right') - 1
+        first_line = (item - item_ptr[sector])*SWEEP_LINES
+        n_steps = halos[sector] + max(n_rows, n_cols)
+        _sweep_horizons(
+            dem, valid, horizons[sector], x0, x1, y0, y1, 2*np.pi*sector/n_sectors, halos[sector],
+            first_line, min(first_line + SWEEP_LINES, n_lines[sector]), np.empty(n_steps), np.empty(n_steps)
+        )
+    return horizons
+
+
+@njit(parallel=True, cache=True)
+def horizon_shadow_mask(horizons, elevs, azis):
+    """Shadow mask of a DEM from its horizon angles, see
+    :func:`horizon_angles`.
+
+    A pixel is in shadow if the sun is at or below its horizon toward the
+    sun azimuth, interpolated linearly between the two sectors around it.
+    Sun positions are taken per block as in :func:`calc_shadow_mask`.
+
+    Parameters
+    ----------
+    horizons : array
+        Int16 horizon angles of shape (n_sectors, rows, columns).
+
+    elevs, azis : array
+        Sun elevations and azimuths (eastward from north) on a coarse grid
+        (in radians).
+
+    Returns
+    -------
+    shadow_mask : array
+        Boolean array, True for the pixels with data in shadow or with the
+        sun below the horizon.
+    """
+    n_sectors, n_rows, n_cols = horizons.shape
+    stepsize = max(int(np.round(n_rows / elevs.shape[0])), 1)
+    shadow_mask = np.zeros((n_rows, n_cols), dtype=np.bool_)
+
+    # Sectors around the sun of every block, the weight of the upper one and
+    # the elevation in stored units.
+    n_block_rows = min(elevs.shape[0], (n_rows + stepsize - 1) // stepsize)
+    n_block_cols = min(elevs.shape[1], (n_cols + stepsize - 1) // stepsize)
+    lowers = np.empty((n_block_rows, n_block_cols), dtype=np.int64)
+    weights = np.empty((n_block_rows, n_block_cols))
+    thresholds = np.empty((n_block_rows, n_block_cols))
+    for i in range(n_block_rows):
+        for j in range(n_block_cols):
+            position = (azis[i, j] % (2*np.pi)) / (2*np.pi) * n_sectors
+            lowers[i, j] = int(position) % n_sectors
+            weights[i, j] = position - int(position)
+            thresholds[i, j] = elevs[i, j]*HORIZON_SCALE
+
+    for x in prange(n_rows):
+        i = min(x // stepsize, n_block_rows-1)
+        for j in range(n_block_cols):
+            lower = horizons[lowers[i, j], x]
+            upper = horizons[(lowers[i, j] + 1) % n_sectors, x]
+            weight, threshold = weights[i, j], thresholds[i, j]
+            y1 = n_cols if j == n_block_cols-1 else (j+1)*stepsize
+            for y in range(j*stepsize, y1):
+                if lower[y] != -32768:
+                    shadow_mask[x, y] = threshold <= lower[y] + weight*(upper[y] - lower[y])
     return shadow_mask
 
 
-@jit(nopython=True)
-def shadow_mask(altitude, azimuth, elevation_map, nodata=-32768):
-    # Intitiate shadow mask.
-    shadow_map = np.full(elevation_map.shape, nodata, dtype=np.int16)
+def _raster_range(dataset, max_memory=2*1024**3):
+    # Lowest and highest altitude of a DEM raster, read window by window.
+    lowest, highest = np.inf, -np.inf
+    for window in raster_windows(dataset.height, dataset.width, max_memory // 4):
+        dem = dataset.read(1, window=window)
+        dem = dem[dem != dataset.nodata]
+        if dem.size:
+            lowest, highest = min(lowest, dem.min()), max(highest, dem.max())
+    return lowest, highest
 
-    # Change altitude and azimuth to radians.
-    altitude = (altitude % 360) * np.pi / 180
-    azimuth = (azimuth % 360) * np.pi / 180 # Minus 90 to fit the map's coordinate system.
-    
-    M, N = elevation_map.shape
-    count = 0 # to see how far along we are
-    for y in range(M):
-        for x in range(N):
-            count = count + 1
-            if count % (N*M // 100) == 0: # print how far along we are
-                print(int(100*count/(N*M)), 'percent done.')
 
-            current_height = elevation_map[x, y]
+def _horizon_halo(elevation, min_elevation, max_memory):
+    # Farthest a horizon from min_elevation up can be cast from over the
+    # relief of a DEM raster, in pixels.
+    lowest, highest = _raster_range(elevation, max_memory)
+    return int(np.ceil(max(highest - lowest, 0) / (30*np.tan(min_elevation))))
 
-            # Skip the square if it has no data.
-            if current_height == nodata: 
-                continue
 
-            # Calculate the distance of the shadow cast by the current square.
-            shadow_dist = current_height / np.tan(altitude)
-
-            # Find the square where the shadow ends.
-            if 0 <= azimuth < np.pi/2:
-                delta_x = int(np.floor(shadow_dist * np.cos(azimuth) / 30))
-                delta_y = int(np.floor(shadow_dist * np.sin(azimuth) / 30))
-                x_end = x + delta_x
-                y_end = y - delta_y
-            elif np.pi/2 <= azimuth < np.pi:
-                delta_x = int(np.floor(shadow_dist * np.sin(azimuth-np.pi/2) / 30))
-                delta_y = int(np.floor(shadow_dist * np.cos(azimuth-np.pi/2) / 30))
-                x_end = x - delta_x
-                y_end = y - delta_y
-            elif np.pi <= azimuth < 3*np.pi/2:
-                delta_x = int(np.floor(shadow_dist * np.cos(azimuth-np.pi) / 30))
-                delta_y = int(np.floor(shadow_dist * np.sin(azimuth-np.pi) / 30))
-                x_end = x - delta_x
-                y_end = y + delta_y
+def horizon_windows(elevation, path, n_sectors=HORIZON_SECTORS, min_elevation=HORIZON_MIN_ELEVATION, max_memory=2*1024**3):
+    """Horizon angles of a DEM raster with :func:`horizon_angles`, streamed
+    window by window into a GeoTIFF on the same grid.
+
+    Every window is read with a halo as wide as the farthest a horizon
+    from `min_elevation` up can be cast from over the relief of the DEM.
+    The output is tiled, compressed and pixel-interleaved, so that a tile
+    holds every sector of its pixels.
+
+    Parameters
+    ----------
+    elevation : rasterio.DatasetReader
+        The DEM, with a pixel of about 30 m.
+
+    path : Path
+        The output, with one int16 band per name in horizon_bands(n_sectors).
+    """
+    halo = _horizon_halo(elevation, min_elevation, max_memory)
+
+    def window_horizons(window, dem):
+        return horizon_angles(dem, n_sectors, min_elevation, halo)
+
+    # The horizons, their copy for writing and the hulls, and over the halo
+    # the DEM, its padded copy and its valid mask.
+    bytes_per_pixel = n_sectors*2*2 + 16
+    map_raster_windows(
+        window_horizons, elevation, path, max_memory, bytes_per_pixel,
+        band_names=horizon_bands(n_sectors), halo=halo, dtype=np.int16,
+        padded_bytes_per_pixel=2 + 2 + 1
+    )
+
+
+def horizon_rasters(elevation, directory=TERRAIN_DIRECTORY, n_sectors=HORIZON_SECTORS, max_memory=2*1024**3):
+    """Horizon angle raster on the grid of a DEM raster, built once with
+    :func:`horizon_windows` and reused while the DEM is unchanged, see
+    :func:`slope_aspect_rasters`.
+
+    Returns
+    -------
+    horizons : rasterio.DatasetReader
+        The open raster, one int16 band per azimuth sector in 1 /
+        HORIZON_SCALE radians.
+    """
+    path = directory / f'horizons_{n_sectors}.tif'
+    horizons = _open_derived(elevation, [path])
+    if horizons is not None:
+        return horizons[0]
+    directory.mkdir(parents=True, exist_ok=True)
+    horizon_windows(elevation, path, n_sectors, max_memory=max_memory)
+    _tag_derived(elevation, [path])
+    return rio.open(path)
+
+
+# Azimuth sectors of the horizon scans of the sky view factor.
+SKY_VIEW_SECTORS = 32
+
+
+@njit(parallel=True, cache=True)
+def sky_view_factor(horizons):
+    """Sky view factor of every pixel of a DEM from its horizon angles, see
+    :func:`horizon_angles`.
+
+    The share of the diffuse irradiance of an isotropic sky that reaches a
+    horizontal surface past the terrain, the mean over the azimuths of the
+    squared cosine of the horizon angle (Dozier and Marks, 1987). It is one
+    on open ground and lower in valleys. Horizons below the minimum
+    elevation of :func:`horizon_angles` only count as zero, which changes
+    the factor by less than 0.002 at 2 degrees.
+
+    Parameters
+    ----------
+    horizons : array
+        Int16 horizon angles of shape (n_sectors, rows, columns).
+
+    Returns
+    -------
+    svf : array
+        Float32 array of the sky view factor, -32768 outside the DEM.
+    """
+    n_sectors, n_rows, n_cols = horizons.shape
+    svf = np.full((n_rows, n_cols), -32768, dtype=np.float32)
+    for x in prange(n_rows):
+        total = np.zeros(n_cols)
+        for sector in range(n_sectors):
+            for y in range(n_cols):
+                total[y] += np.cos(horizons[sector, x, y] / HORIZON_SCALE)**2
+        for y in range(n_cols):
+            if horizons[0, x, y] != -32768:
+                svf[x, y] = total[y] / n_sectors
+    return svf
+
+
+def sky_view_factor_windows(elevation, path, n_sectors=SKY_VIEW_SECTORS, max_memory=2*1024**3):
+    """Sky view factor of a DEM raster with :func:`sky_view_factor`, streamed
+    window by window into a GeoTIFF on the same grid.
+
+    The horizons of every window are scanned with :func:`horizon_angles`
+    over a halo as in :func:`horizon_windows`, so that the tiles agree
+    where they meet, and only the factor is kept.
+    """
+    halo = _horizon_halo(elevation, HORIZON_MIN_ELEVATION, max_memory)
+
+    def window_sky_view(window, dem):
+        return sky_view_factor(horizon_angles(dem, n_sectors, HORIZON_MIN_ELEVATION, halo))
+
+    # The horizons and hulls, the factor and its copy for writing, and over
+    # the halo the DEM, its padded copy and its valid mask.
+    bytes_per_pixel = n_sectors*2 + 16 + 8 + 4
+    map_raster_windows(
+        window_sky_view, elevation, path, max_memory, bytes_per_pixel, halo=halo,
+        padded_bytes_per_pixel=2 + 2 + 1
+    )
+
+
+def sky_view_factor_raster(elevation, directory=TERRAIN_DIRECTORY, n_sectors=SKY_VIEW_SECTORS, max_memory=2*1024**3):
+    """Sky view factor raster on the grid of a DEM raster, built once with
+    :func:`sky_view_factor_windows` and reused while the DEM is unchanged,
+    see :func:`slope_aspect_rasters`.
+
+    Returns
+    -------
+    sky_view : rasterio.DatasetReader
+        The open float32 raster.
+    """
+    path = directory / f'sky_view_factor_{n_sectors}.tif'
+    sky_view = _open_derived(elevation, [path])
+    if sky_view is not None:
+        return sky_view[0]
+    directory.mkdir(parents=True, exist_ok=True)
+    sky_view_factor_windows(elevation, path, n_sectors, max_memory)
+    _tag_derived(elevation, [path])
+    return rio.open(path)
+
+
+# Levels of the max-elevation pyramid the shadow sweep skips the terrain of
+# its halos with, the coarsest with cells of 2**PYRAMID_LEVELS pixels, a
+# few groups of SWEEP_LINES lines wide.
+PYRAMID_LEVELS = 8
+
+
+@jit(nopython=True, cache=True)
+def max_pyramid(dem, n_levels=PYRAMID_LEVELS, row_off=0, col_off=0):
+    """Max-elevation pyramid of a DEM, the highest altitude in every cell of
+    2**level x 2**level pixels for levels 1 to `n_levels`.
+
+    The cells are aligned to the raster the DEM is a window of, with its top
+    left pixel at (row_off, col_off), so that cell (i, j) of a level covers
+    the raster rows i*2**level to (i+1)*2**level. The pixels without data
+    count at their value, as the shadow rays compare them, and the parts of
+    the cells outside the DEM are left out.
+
+    Returns
+    -------
+    pyramid : tuple
+        The int16 maxima of all levels one after the other, each row-major,
+        and the int64 offsets of the levels in them and shapes of the
+        levels.
+    """
+    n_rows, n_cols = dem.shape
+    offsets = np.zeros(n_levels + 1, dtype=np.int64)
+    shapes = np.empty((n_levels, 2), dtype=np.int64)
+    for level in range(1, n_levels + 1):
+        shapes[level-1, 0] = ((row_off + n_rows - 1) >> level) - (row_off >> level) + 1
+        shapes[level-1, 1] = ((col_off + n_cols - 1) >> level) - (col_off >> level) + 1
+        offsets[level] = offsets[level-1] + shapes[level-1, 0]*shapes[level-1, 1]
+    maxima = np.full(offsets[-1], -32768, dtype=np.int16)
+
+    # Every level from the one below, the first from the DEM, a row at a
+    # time into the row of cells it falls in.
+    for level in range(1, n_levels + 1):
+        if level == 1:
+            below = dem
+            below_row, below_col = row_off, col_off
+        else:
+            start = offsets[level-2]
+            below = maxima[start:start + shapes[level-2, 0]*shapes[level-2, 1]].reshape(
+                (shapes[level-2, 0], shapes[level-2, 1])
+            )
+            below_row, below_col = row_off >> (level-1), col_off >> (level-1)
+        row, col = row_off >> level, col_off >> level
+        for x in range(below.shape[0]):
+            cells = maxima[offsets[level-1] + (((below_row + x) >> 1) - row)*shapes[level-1, 1]:]
+            for y in range(below.shape[1]):
+                j = ((below_col + y) >> 1) - col
+                cells[j] = max(cells[j], below[x, y])
+    return maxima, offsets, shapes
+
+
+def _coarsened(transform, factor):
+    # Transform of a grid of pixels `factor` times as wide from the same corner.
+    return Affine(
+        transform.a*factor, transform.b*factor, transform.c, transform.d*factor, transform.e*factor, transform.f
+    )
+
+
+def _pyramid_paths(elevation, n_levels):
+    # Levels of the pyramid of a DEM raster, next to it.
+    path = Path(elevation.name)
+    return [path.with_name(f'{path.stem}_max_{2**level}.tif') for level in range(1, n_levels + 1)]
+
+
+def max_pyramid_rasters(elevation, n_levels=PYRAMID_LEVELS, max_memory=2*1024**3):
+    """Max-elevation pyramid of a DEM raster, one GeoTIFF per level next to
+    the DEM, built once and reused while the DEM is unchanged, see
+    :func:`slope_aspect_rasters`.
+
+    Every level is reduced window by window from the one below, with the
+    cells of :func:`max_pyramid`. The cells past the edges of the raster
+    also count its nodata, which the windows of :func:`shadow_mask_windows`
+    are padded with there.
+
+    Returns
+    -------
+    pyramid : list of rasterio.DatasetReader
+        The open levels, from cells of 2 x 2 pixels to 2**n_levels.
+    """
+    paths = _pyramid_paths(elevation, n_levels)
+    pyramid = _open_derived(elevation, paths)
+    if pyramid is not None:
+        return pyramid
+
+    nodata = -32768 if elevation.nodata is None else elevation.nodata
+    pyramid, below = list(), elevation
+    for path in paths:
+        profile = below.profile.copy()
+        profile.update(
+            driver='GTiff', count=1, dtype=np.int16, nodata=nodata, height=-(-below.height // 2),
+            width=-(-below.width // 2), transform=_coarsened(below.transform, 2), tiled=True,
+            blockxsize=256, blockysize=256, compress='lzw', predictor=2, BIGTIFF='IF_SAFER'
+        )
+        with rio.open(path, 'w', **profile) as level:
+            # The level below read in pairs of rows and columns, 2 + 2 bytes a
+            # pixel with the padded copy, and the window of the level.
+            for window in raster_windows(level.height, level.width, max_memory // 5):
+                values = below.read(1, window=Window(
+                    2*window.col_off, 2*window.row_off,
+                    min(2*window.width, below.width - 2*window.col_off),
+                    min(2*window.height, below.height - 2*window.row_off)
+                ))
+                values = np.pad(
+                    values, ((0, 2*window.height - values.shape[0]), (0, 2*window.width - values.shape[1])),
+                    constant_values=nodata
+                )
+                level.write(values.reshape(window.height, 2, window.width, 2).max(axis=(1, 3)), 1, window=window)
+            level.update_tags(DEM_DIGEST=_dem_digest(elevation))
+        below = rio.open(path)
+        pyramid.append(below)
+    return pyramid
+
+
+def _read_pyramid(pyramid, row_off, col_off, height, width):
+    # The pyramid of a window of a DEM raster, as max_pyramid builds it, read
+    # from its levels with nodata outside the raster.
+    maxima, shapes = list(), list()
+    for n, level in enumerate(pyramid, 1):
+        row0, col0 = row_off >> n, col_off >> n
+        row1, col1 = ((row_off + height - 1) >> n) + 1, ((col_off + width - 1) >> n) + 1
+        row_in, col_in = (max(row0, 0), min(row1, level.height)), (max(col0, 0), min(col1, level.width))
+        values = np.pad(
+            level.read(1, window=Window.from_slices(row_in, col_in)),
+            ((row_in[0] - row0, row1 - row_in[1]), (col_in[0] - col0, col1 - col_in[1])),
+            constant_values=level.nodata
+        )
+        maxima.append(values.ravel())
+        shapes.append(values.shape)
+    offsets = np.concatenate([[0], np.cumsum([len(values) for values in maxima])])
+    return np.concatenate(maxima).astype(np.int16), offsets.astype(np.int64), np.array(shapes, dtype=np.int64)
+
+
+@jit(nopython=True, cache=True)
+def _shadow_reach(relief, elevation, n_rows, n_cols):
+    # Farthest in pixels along either axis a ray can shadow a pixel from
+    # over the relief of a DEM, as it drops at least 30 * tan(elevation) a
+    # pixel. Zero with the sun down, when no ray is cast.
+    if elevation <= 0:
+        return 0
+    return min(int(np.ceil(max(relief, 0) / (30*np.tan(elevation)))) + 1, max(n_rows, n_cols))
+
+
+@jit(nopython=True, cache=True)
+def _line_point(rate, a):
+    # Offset along the minor axis of the sweep lines at raster index a along
+    # the major axis, line c passing at c + offset + weight, 0 <= weight < 1.
+    shift = rate*a
+    offset = np.floor(shift)
+    return int(offset), shift - offset
+
+
+@jit(nopython=True, cache=True)
+def _line_offset(rate, a):
+    # Offset of the pixels the sweep lines decide at raster index a along the
+    # major axis, line c deciding pixel c + _line_offset(rate, a), the one
+    # nearest to it.
+    offset, weight = _line_point(rate, a)
+    return offset + 1 if weight >= 0.5 else offset
+
+
+@jit(nopython=True, cache=True)
+def _no_pyramid():
+    # A max-elevation pyramid without levels, which skips nothing.
+    return np.empty(0, dtype=np.int16), np.zeros(1, dtype=np.int64), np.empty((0, 2), dtype=np.int64)
+
+
+@jit(nopython=True, cache=True)
+def _skip_halo(pyramid, major, step, rate, drop, entry, k, n_halo, first_minor, first_line, last_line, n_minor, a_off, b_off, threshold):
+    # First step from k of the halo of lines first_line to last_line with a
+    # point whose h + drop*k may reach `threshold`, the lowest of the points
+    # they decide. The steps before it cannot shadow them, and are skipped a
+    # cell of the pyramid at a time, from the coarsest level down to the
+    # finest until a cell rises above the threshold, and from the coarsest
+    # again after every cell skipped. A point is no higher than the pixels
+    # on either side of it and heights compare as in _sweep_shadows, so the
+    # skip is exact.
+    maxima, offsets, shapes = pyramid
+    n_levels = shapes.shape[0]
+    level = n_levels
+    while k < n_halo and level > 0:
+        a = entry + step*(k - n_halo)
+        cell = (a + a_off) >> level
+        a_last = ((cell + 1) << level) - 1 - a_off if step > 0 else (cell << level) - a_off
+        k_last = min(k + step*(a_last - a), n_halo - 1)
+        a_last = entry + step*(k_last - n_halo)
+        first_offset, last_offset = _line_point(rate, a + a_off)[0], _line_point(rate, a_last + a_off)[0]
+        b_first = max(first_minor + min(first_offset, last_offset) + first_line, 0)
+        b_last = min(first_minor + max(first_offset, last_offset) + last_line, n_minor - 1)
+        highest = -np.inf
+        start, n_cols = offsets[level-1], shapes[level-1, 1]
+        i = cell - (a_off >> level)
+        for j in range(((b_first + b_off) >> level) - (b_off >> level), ((b_last + b_off) >> level) - (b_off >> level) + 1):
+            highest = max(highest, maxima[start + i*n_cols + j] if major == 0 else maxima[start + j*n_cols + i])
+        if highest + drop*(step*(a_last + a_off)) < threshold:
+            k, level = k_last + 1, n_levels
+        else:
+            level -= 1
+    return k
+
+
+@jit(nopython=True, cache=True)
+def _sweep_shadows(dem, valid, mask, x0, x1, y0, y1, elevation, azimuth, n_halo, first_line, last_line, row_off, col_off, lowest, pyramid):
+    # Mark the valid pixels of [x0, x1) x [y0, y1) in shadow, sweeping lines
+    # first_line to last_line through it from n_halo steps up-sun. The lines
+    # follow the sun direction exactly, one pixel apart, anchored to the
+    # raster the DEM is a window of at (row_off, col_off), so that every
+    # window and block sweeps the same ones. The terrain is interpolated
+    # across a line, and a point of it decides the valid pixel nearest to
+    # it, as in _sweep_horizons. The ray of a point C covers a point P
+    # further along if h_C - drop*(k_P - k_C) >= h_P, k counting the steps
+    # along the line from the edge of the raster, so the running maximum of
+    # h_C + drop*k_C over the points so far decides every point. The lines
+    # advance together a step at a time, so that a step reads neighbouring
+    # pixels. The halo is entered past the terrain of the pyramid, aligned
+    # as the lines, that is too low to reach `lowest`, the lowest valid
+    # pixel of the rectangle and the pixels around it.
+    major, step, slope, step_length = _sweep_direction(azimuth)
+    drop = 30*np.tan(elevation)*step_length
+    rate = slope*step
+    if major == 0:
+        a0, a1, b0, b1, n_major, n_minor, a_off, b_off = x0, x1, y0, y1, dem.shape[0], dem.shape[1], row_off, col_off
+    else:
+        a0, a1, b0, b1, n_major, n_minor, a_off, b_off = y0, y1, x0, x1, dem.shape[1], dem.shape[0], col_off, row_off
+    first_minor = b0 - max(_line_offset(rate, a0 + a_off), _line_offset(rate, a1 - 1 + a_off))
+    entry = a0 if step > 0 else a1-1
+    k_start = _skip_halo(
+        pyramid, major, step, rate, drop, entry, max(n_halo - (entry if step > 0 else n_major-1-entry), 0), n_halo,
+        first_minor, first_line, last_line, n_minor, a_off, b_off, lowest + drop*(step*(entry + a_off))
+    )
+
+    envelopes = np.full(last_line - first_line, -np.inf)
+    for k in range(k_start, n_halo + a1-a0):
+        a = entry + step*(k-n_halo)
+        offset, weight = _line_point(rate, a + a_off)
+        first_b = first_minor + offset + (1 if weight >= 0.5 else 0)
+        ramp = drop*(step*(a + a_off))
+        for line in range(max(first_line, -first_b), min(last_line, n_minor - first_b)):
+            b = first_b + line
+            if major == 0:
+                x, y = a, b
             else:
-                delta_x = int(np.floor(shadow_dist * np.sin(azimuth-(3*np.pi/2)) / 30))
-                delta_y = int(np.floor(shadow_dist * np.cos(azimuth-(3*np.pi/2)) / 30))
-                x_end = x + delta_x
-                y_end = y + delta_y
-
-            # Adjust if the end square is out of bounds.
-            if x_end >= N:
-                x_end = int(N-1)
-            elif x_end < 0:
-                x_end = 0
-            
-            if y_end >= M:
-                y_end = int(M-1)
-            elif y_end < 0:
-                y_end = 0
-            
-            # Use Bresenham's algorithm to find all squares between current and end square.
-            shadow_squares = get_line((x, y), (x_end, y_end))
-
-            # Skip the first square as it's the current square.
-            for shadow_square in shadow_squares[1:]: 
-                # Calculate distance from shadow square to start square.
-                dist_to_cur_square = np.sqrt((x-shadow_square[0])**2 + (y-shadow_square[1])**2)
-
-                # Calculate if the shadow square is low enough to be covered by the shadow,
-                # and remember to multiply by 30 to accomodate the resolution of the map.
-                if elevation_map[shadow_square] <= current_height - 30 * dist_to_cur_square * np.tan(altitude):
-                    shadow_map[shadow_square] = 1
-                else:
-                    # Since the shadow squares are ordered, we skip the rest,
-                    # if we run into a shadow square that isnt covered.
-                    break
-    return shadow_map
-
-
-@jit(nopython=True)
+                x, y = b, a
+            if not valid[x, y]:
+                continue
+            height = _line_altitude(dem, valid, major, a, first_minor + offset + line, weight, n_minor) + ramp
+            if height > envelopes[line - first_line]:
+                envelopes[line - first_line] = height
+            elif k >= n_halo and b0 <= b < b1:
+                mask[x, y] = True
+
+
+@njit(parallel=True, cache=True)
+def _sweep_shadow_mask(dem, valid, elevs, azis, halo, row_off, col_off, n_tiles, pyramid):
+    # calc_shadow_mask of the valid pixels of a DEM, but for the `halo`
+    # pixels on every side, which only cast shadows, with the lines and the
+    # pyramid anchored to the raster the DEM is a window of at
+    # (row_off, col_off).
+    n_rows, n_cols = dem.shape[0] - 2*halo, dem.shape[1] - 2*halo
+    stepsize = max(int(np.round(n_rows / elevs.shape[0])), 1)
+    shadow_mask = np.zeros(dem.shape, dtype=np.bool_)
+
+    # Block bounds and the lowest pixel of every block and the pixels around
+    # it, which its points are interpolated from, the last blocks reaching
+    # to the edges of the DEM, and the highest pixel of all.
+    n_block_rows = min(elevs.shape[0], (n_rows + stepsize - 1) // stepsize)
+    n_block_cols = min(elevs.shape[1], (n_cols + stepsize - 1) // stepsize)
+    n_blocks = n_block_rows*n_block_cols
+    bounds = np.empty((n_blocks, 4), dtype=np.int64)
+    lowest = np.full(n_blocks, np.inf)
+    for block in prange(n_blocks):
+        i, j = block // n_block_cols, block % n_block_cols
+        bounds[block, 0] = halo + i*stepsize
+        bounds[block, 1] = halo + (n_rows if i == n_block_rows-1 else (i+1)*stepsize)
+        bounds[block, 2] = halo + j*stepsize
+        bounds[block, 3] = halo + (n_cols if j == n_block_cols-1 else (j+1)*stepsize)
+        for x in range(max(bounds[block, 0] - 1, 0), min(bounds[block, 1] + 1, dem.shape[0])):
+            for y in range(max(bounds[block, 2] - 1, 0), min(bounds[block, 3] + 1, dem.shape[1])):
+                if valid[x, y]:
+                    lowest[block] = min(lowest[block], dem[x, y])
+    row_highest = np.full(dem.shape[0], -np.inf)
+    for x in prange(dem.shape[0]):
+        for y in range(dem.shape[1]):
+            if valid[x, y]:
+                row_highest[x] = max(row_highest[x], dem[x, y])
+    highest = row_highest.max() if dem.shape[0] else -np.inf
+
+    # Groups of SWEEP_LINES lines of every block, and the number of steps
+    # up-sun a ray can still reach the lowest pixel of a block from.
+    halos = np.zeros(n_blocks, dtype=np.int64)
+    n_lines = np.zeros(n_blocks, dtype=np.int64)
+    lengths = np.zeros(n_blocks, dtype=np.int64)
+    for block in range(n_blocks):
+        i, j = block // n_block_cols, block % n_block_cols
+        if lowest[block] == np.inf or elevs[i, j] <= 0:
+            continue
+        x0, x1, y0, y1 = bounds[block]
+        major, step, slope, step_length = _sweep_direction(azis[i, j])
+        if major == 0:
+            a0, a1, width, a_off = x0, x1, y1-y0, row_off
+        else:
+            a0, a1, width, a_off = y0, y1, x1-x0, col_off
+        n_lines[block] = width + abs(
+            _line_offset(slope*step, a1 - 1 + a_off) - _line_offset(slope*step, a0 + a_off)
+        )
+        lengths[block] = a1 - a0
+        reach = (highest - lowest[block]) / (30*np.tan(elevs[i, j])*step_length)
+        halos[block] = int(min(reach, max(dem.shape))) + 1
+    groups = (n_lines + SWEEP_LINES - 1) // SWEEP_LINES
+
+    # Tiles of every block along the sweep, as many as it takes to make
+    # n_tiles work items, but none shorter than its halo.
+    tiles_per_group = -(-n_tiles // max(groups.sum(), 1))
+    n_block_tiles = np.ones(n_blocks, dtype=np.int64)
+    for block in range(n_blocks):
+        if groups[block]:
+            n_block_tiles[block] = max(min(tiles_per_group, lengths[block] // halos[block]), 1)
+    item_ptr = np.zeros(n_blocks+1, dtype=np.int64)
+    item_ptr[1:] = np.cumsum(groups*n_block_tiles)
+
+    for item in prange(item_ptr[-1]):
+        block = np.searchsorted(item_ptr, item, side='right') - 1
+        i, j = block // n_block_cols, block % n_block_cols
+        tile, group = divmod(item - item_ptr[block], groups[block])
+        x0, x1, y0, y1 = bounds[block]
+        major, step, slope, step_length = _sweep_direction(azis[i, j])
+        a0 = x0 if major == 0 else y0
+        a1 = a0 + (tile+1)*lengths[block] // n_block_tiles[block]
+        a0 = a0 + tile*lengths[block] // n_block_tiles[block]
+        if major == 0:
+            x0, x1, width, a_off = a0, a1, y1-y0, row_off
+        else:
+            y0, y1, width, a_off = a0, a1, x1-x0, col_off
+        tile_lines = width + abs(_line_offset(slope*step, a1 - 1 + a_off) - _line_offset(slope*step, a0 + a_off))
+        first_line = group*SWEEP_LINES
+        if first_line < tile_lines:
+            _sweep_shadows(
+                dem, valid, shadow_mask, x0, x1, y0, y1, elevs[i, j], azis[i, j], halos[block],
+                first_line, min(first_line + SWEEP_LINES, tile_lines), row_off, col_off, lowest[block], pyramid
+            )
+
+    # The sun is down on the remaining blocks.
+    for block in prange(n_blocks):
+        i, j = block // n_block_cols, block % n_block_cols
+        if lowest[block] < np.inf and elevs[i, j] <= 0:
+            x0, x1, y0, y1 = bounds[block]
+            for x in range(x0, x1):
+                for y in range(y0, y1):
+                    shadow_mask[x, y] = valid[x, y]
+    return shadow_mask[halo:halo+n_rows, halo:halo+n_cols]
+
+
+def shadow_mask(altitude, azimuth, elevation_map, nodata=-32768, n_tiles=None, pyramid=None):
+    """Shadow map of a DEM for one sun position, swept as in
+    :func:`calc_shadow_mask`.
+
+    Parameters
+    ----------
+    altitude, azimuth : float
+        Sun elevation and azimuth (eastward from north) in degrees.
+
+    elevation_map : array
+        Array of altitudes (in meters) on a 30 m grid.
+
+    n_tiles : int, optional
+        Least number of work items to run in parallel, see
+        :func:`calc_shadow_mask`. Defaults to the number of threads.
+
+    pyramid : tuple, optional
+        Max-elevation pyramid of the DEM to skip the terrain of the halos
+        with, see :func:`max_pyramid`.
+
+    Returns
+    -------
+    shadow_map : array
+        Int16 array, 1 for the pixels with data in shadow or with the sun
+        below the horizon and nodata elsewhere.
+    """
+    elevs = np.full((1, 1), np.radians(altitude))
+    azis = np.full((1, 1), _deg_to_rad(azimuth))
+    n_tiles = get_num_threads() if n_tiles is None else n_tiles
+    pyramid = _no_pyramid() if pyramid is None else pyramid
+    shadows = _sweep_shadow_mask(elevation_map, elevation_map != nodata, elevs, azis, 0, 0, 0, n_tiles, pyramid)
+    return np.where(shadows, np.int16(1), np.int16(nodata))
+
+
+def shadow_mask_windows(elevation, path, altitude, azimuth, max_memory=2*1024**3, n_tiles=None, pyramid=None):
+    """Shadow map of a DEM raster for one sun position with
+    :func:`shadow_mask`, streamed window by window into a GeoTIFF on the
+    same grid.
+
+    Every window is read with a halo as wide as the farthest a ray can
+    shadow a pixel from over the relief of the raster at the sun elevation,
+    and swept along the lines of the whole raster, so that the map is that
+    of :func:`shadow_mask` on the whole DEM. The halos are entered past the
+    terrain too low to shadow the window, as the max-elevation pyramid of
+    the raster tells, which is built next to it the first time.
+
+    Parameters
+    ----------
+    elevation : rasterio.DatasetReader
+        The DEM, with a pixel of about 30 m.
+
+    path : Path
+        The output, an int16 band, 1 in shadow or with the sun below the
+        horizon and nodata elsewhere.
+
+    altitude, azimuth : float
+        Sun elevation and azimuth (eastward from north) in degrees.
+
+    n_tiles : int, optional
+        Least number of work items every window runs in parallel, see
+        :func:`calc_shadow_mask`. Defaults to the number of threads.
+
+    pyramid : list of rasterio.DatasetReader, optional
+        Levels of the max-elevation pyramid of the DEM. Defaults to those
+        of :func:`max_pyramid_rasters`.
+    """
+    n_tiles = get_num_threads() if n_tiles is None else n_tiles
+    pyramid = max_pyramid_rasters(elevation, max_memory=max_memory) if pyramid is None else pyramid
+    lowest, highest = _raster_range(elevation, max_memory)
+    halo = _shadow_reach(highest - lowest, np.radians(altitude), elevation.height, elevation.width)
+    elevs = np.full((1, 1), np.radians(altitude))
+    azis = np.full((1, 1), _deg_to_rad(azimuth))
+
+    def window_shadows(window, dem):
+        row_off, col_off = int(window.row_off) - halo, int(window.col_off) - halo
+        shadows = _sweep_shadow_mask(
+            dem, dem != elevation.nodata, elevs, azis, halo, row_off, col_off, n_tiles,
+            _read_pyramid(pyramid, row_off, col_off, *dem.shape)
+        )
+        return np.where(shadows, np.int16(1), np.int16(-32768))
+
+    # The shadows and the copy for writing, and over the halo the DEM, its
+    # valid pixels, the shadows of the halo and its pyramid, a third of an
+    # int16 cell a pixel, twice while its levels are joined.
+    bytes_per_pixel = 2 + 2
+    map_raster_windows(
+        window_shadows, elevation, path, max_memory, bytes_per_pixel, halo=halo, dtype=np.int16,
+        padded_bytes_per_pixel=2 + 1 + 1 + 2
+    )
+
+
+@jit(nopython=True, cache=True)
 def get_line(start, end):
     """
     Accustomed from: http://www.roguebasin.com/index.php?title=Bresenham%27s_Line_Algorithm#Python
@@ -1,11 +1,10 @@
 import numpy as np
 import rasterio as rio
 from numba import njit, jit, prange
-from tqdm import tqdm
 
 from config import PROC_DATA_DIRECTORY
 from ..datasets import load_landcover
-from ..utils import haversine_dist, find_corners
+from ._valid_pixels import valid_spans
 
 
 def proximity_impervious_area(year):
@@ -13,12 +12,15 @@ def proximity_impervious_area(year):
     """
     lulc = load_landcover(year)
     meta = lulc.meta
+    # The cached spans of the country polygon, which the land cover is
+    # cropped to, so that the raster is not scanned again. Inside them the
+    # pixels without data are skipped by _split_valid_pixels.
+    spans = valid_spans(lulc.transform, lulc.height, lulc.width)
     lulc = lulc.read(1)
     dists = np.full(lulc.shape, -32768, dtype=np.float32)
     
     # Find impervious and other idxs
-    other_idxs = np.argwhere((lulc != -32768) & (lulc != 1))
-    impervious_idxs = np.argwhere(lulc == 1)
+    impervious_idxs, other_idxs = _split_valid_pixels(lulc, spans)
     
     # Calculate distances
     min_dists = _proximity_impervious_area(impervious_idxs, other_idxs)
@@ -44,6 +46,36 @@ def proximity_impervious_area(year):
     pia_raster.close()
 
 
+@njit(cache=True)
+def _split_valid_pixels(lulc, spans):
+    """Indices of the impervious and other valid pixels, visiting only the
+    valid row spans.
+    """
+    row_ptr, starts, stops = spans
+    n_impervious, n_other = 0, 0
+    for x in range(len(row_ptr)-1):
+        for span in range(row_ptr[x], row_ptr[x+1]):
+            for y in range(starts[span], stops[span]):
+                if lulc[x, y] == 1:
+                    n_impervious += 1
+                elif lulc[x, y] != -32768:
+                    n_other += 1
+
+    impervious_idxs = np.empty((n_impervious, 2), dtype=np.int64)
+    other_idxs = np.empty((n_other, 2), dtype=np.int64)
+    i, j = 0, 0
+    for x in range(len(row_ptr)-1):
+        for span in range(row_ptr[x], row_ptr[x+1]):
+            for y in range(starts[span], stops[span]):
+                if lulc[x, y] == 1:
+                    impervious_idxs[i, 0], impervious_idxs[i, 1] = x, y
+                    i += 1
+                elif lulc[x, y] != -32768:
+                    other_idxs[j, 0], other_idxs[j, 1] = x, y
+                    j += 1
+    return impervious_idxs, other_idxs
+
+
 @jit(parallel=True, nopython=True)
 def _proximity_impervious_area(impervious_idxs, other_idxs):
     """TBA.
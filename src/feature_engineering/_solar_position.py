@@ -0,0 +1,630 @@
+import numpy as np
+from numba import jit, njit, prange
+
+from ..spa import sun_ephemeris_array, topocentric_elevation_azimuth, refraction_correction
+from ..utils import month_to_string, day_to_string
+
+
+@jit(nopython=True, cache=True)
+def incidence_angle(sol_elev, sol_a, arr_t=0.10471975511965978, arr_a=np.pi):
+    """Angle between the sun and the array normal, before clipping.
+    """
+    sol_z = np.pi/2 - sol_elev
+    return np.arccos(np.cos(sol_z)*np.cos(arr_t)+np.sin(sol_z)*np.sin(arr_t)*np.cos(sol_a-arr_a))
+
+
+@jit(nopython=True, cache=True)
+def clip_angle_of_incidence(aoi):
+    """TBA.
+    """
+    if 0 <= aoi <= np.pi/4:
+        return aoi
+    else:
+        return np.pi/4
+
+
+@jit(nopython=True, cache=True)
+def angle_of_incidence(sol_elev, sol_a, arr_t=0.10471975511965978, arr_a=np.pi):
+    """TBA.
+    """
+    return clip_angle_of_incidence(incidence_angle(sol_elev, sol_a, arr_t, arr_a))
+
+
+def lattice_indices(n, stepsize=1):
+    """Indices of the pixels the solar position is evaluated at along one axis
+    of the DEM, every `stepsize` pixels and always including the last pixel so
+    that bilinear interpolation covers the whole axis.
+    """
+    nodes = np.arange(0, n, step=stepsize, dtype=np.int64)
+    if nodes[-1] != n-1:
+        nodes = np.append(nodes, n-1)
+    return nodes
+
+
+def lattice_window(nodes, start, stop):
+    """Part of a lattice that covers the pixels [start, stop) of an axis,
+    relative to `start`, for interpolating inside a raster window.
+
+    Returns
+    -------
+    first, last : int
+        Slice of the lattice nodes (and of the solar geometry) to keep.
+
+    window_nodes : np.array
+        Those nodes shifted to the window, the first one at or before 0.
+        :func:`lattice_weights` accepts them as they are.
+    """
+    first = max(np.searchsorted(nodes, start, side='right') - 1, 0)
+    last = min(np.searchsorted(nodes, stop-1, side='left') + 1, len(nodes))
+    return first, last, nodes[first:last] - start
+
+
+@jit(nopython=True, cache=True)
+def lattice_weights(nodes, n):
+    """Lower lattice node and bilinear weight of every pixel along one axis.
+
+    Parameters
+    ----------
+    nodes : array
+        Sorted pixel indices of the lattice, see :func:`lattice_indices`.
+
+    n : int
+        Number of pixels along the axis.
+
+    Returns
+    -------
+    lower : array
+        Index into `nodes` of the node at or before each pixel.
+
+    weights : array
+        Weight of the node after each pixel.
+    """
+    lower = np.zeros(n, dtype=np.int64)
+    weights = np.zeros(n, dtype=np.float32)
+    k = 0
+    for i in range(n):
+        while k < len(nodes)-2 and nodes[k+1] <= i:
+            k += 1
+        lower[i] = k
+        if len(nodes) > 1 and i > nodes[k]:
+            weights[i] = min((i-nodes[k]) / (nodes[k+1]-nodes[k]), 1.0)
+    return lower, weights
+
+
+@jit(nopython=True, cache=True)
+def bilinear(grid, x0, wx, y0, wy):
+    """Bilinear interpolation in a lattice grid, see :func:`lattice_weights`.
+    """
+    x1 = min(x0+1, grid.shape[0]-1)
+    y1 = min(y0+1, grid.shape[1]-1)
+    top = grid[x0, y0] + wy*(grid[x0, y1]-grid[x0, y0])
+    bottom = grid[x1, y0] + wy*(grid[x1, y1]-grid[x1, y0])
+    return top + wx*(bottom-top)
+
+
+@jit(nopython=True, cache=True)
+def bilinear_angle(grid, x0, wx, y0, wy):
+    """Bilinear interpolation of an angle in [0, 2*pi) that may wrap around
+    inside the cell, such as the azimuth of a sun close to north.
+    """
+    x1 = min(x0+1, grid.shape[0]-1)
+    y1 = min(y0+1, grid.shape[1]-1)
+    ref = grid[x0, y0]
+    d01 = (grid[x0, y1]-ref+np.pi) % (2*np.pi) - np.pi
+    d10 = (grid[x1, y0]-ref+np.pi) % (2*np.pi) - np.pi
+    d11 = (grid[x1, y1]-ref+np.pi) % (2*np.pi) - np.pi
+    top = wy*d01
+    bottom = d10 + wy*(d11-d10)
+    return (ref + top + wx*(bottom-top)) % (2*np.pi)
+
+
+# Side in lattice nodes of the tiles skipped at once when the sun is down.
+SOLAR_TILE_SIZE = 64
+
+
+@jit(nopython=True, cache=True)
+def _geocentric_elevation(latitude, hour_angle, declination):
+    sin_e = np.sin(latitude)*np.sin(declination) + np.cos(latitude)*np.cos(declination)*np.cos(hour_angle)
+    return np.arcsin(min(max(sin_e, -1.0), 1.0))
+
+
+@jit(nopython=True, cache=True)
+def sun_elevation_bound(sidereal_time, right_ascension, declination, lon0, lon1, lat0, lat1, max_height):
+    """Upper bound of the topocentric sun elevation over a tile.
+
+    The geocentric elevation peaks inside the tile only at the subsolar
+    point. Otherwise it peaks on an edge, at the hour angle closest to zero
+    along a parallel, or at latitude arctan(tan(declination)/cos(H)) along a
+    meridian. The maximum of these candidates, which include the four
+    corners, is raised by the horizon dip seen from `max_height`, the
+    parallax and the largest refraction correction.
+
+    Parameters
+    ----------
+    sidereal_time, right_ascension, declination : float
+        One row of :func:`src.spa.sun_ephemeris_array`.
+
+    lon0, lon1, lat0, lat1 : float
+        Bounds of the tile in radians, with lon0 <= lon1 and lat0 <= lat1.
+
+    max_height : float
+        Highest altitude in the tile in meters.
+
+    Returns
+    -------
+    bound : float
+        Elevation in radians that no pixel of the tile exceeds.
+    """
+    # Hour angles of the west and east edges, the east one unwrapped.
+    h0 = (sidereal_time + lon0 - right_ascension + np.pi) % (2*np.pi) - np.pi
+    h1 = h0 + (lon1 - lon0)
+    if h0 <= 0 <= h1 or h1 >= 2*np.pi:
+        h_near = 0.0
+    elif h1 < 0:
+        h_near = h1
+    elif h0 <= 2*np.pi - h1:
+        h_near = h0
+    else:
+        h_near = h1
+    if h_near == 0.0 and lat0 <= declination <= lat1:
+        elevation = np.pi/2
+    else:
+        # Along the parallels, the corners are dominated by these.
+        elevation = max(
+            _geocentric_elevation(lat0, h_near, declination),
+            _geocentric_elevation(lat1, h_near, declination)
+        )
+        # Along the meridians
+        for h in (h0, h1):
+            lat = np.arctan2(np.sin(declination), np.cos(declination)*np.cos(h))
+            lat = min(max(lat, lat0), lat1)
+            elevation = max(elevation, _geocentric_elevation(lat, h, declination))
+    dip = np.arccos(6378140/(6378140 + max(max_height, 0.0)))
+    parallax = 4.263521e-05
+    # The correction peaks where its two branches meet.
+    refraction = refraction_correction(-0.01)
+    return elevation + dip + parallax + refraction
+
+
+@njit(parallel=True, cache=True)
+def solar_position_array(ephemerides, lons, lats, dem, rows, cols, nodata=-32768):
+    """Solar elevation, azimuth and angle of incidence for a time axis and a
+    pixel grid in one parallel call.
+
+    Parameters
+    ----------
+    ephemerides : array
+        Array of shape (n_times, 3) from :func:`src.spa.sun_ephemeris_array`.
+
+    lons : array
+        Longitude in degrees of every DEM column, see
+        :func:`src.utils.coordinate_axes`.
+
+    lats : array
+        Latitude in degrees of every DEM row.
+
+    dem : array
+        The int16 DEM in meters.
+
+    rows, cols : array
+        DEM rows and columns to evaluate, see :func:`lattice_indices`.
+
+    Returns
+    -------
+    elevations, azimuths, aois : array
+        Arrays of shape (n_times, len(rows), len(cols)) in radians. The angles
+        of incidence are not clipped yet, so they stay smooth for
+        interpolation, see :func:`clip_angle_of_incidence`. Tiles of
+        SOLAR_TILE_SIZE nodes where :func:`sun_elevation_bound` shows the sun
+        below the horizon are not evaluated; their elevations hold the bound,
+        which is at most zero, and their angles of incidence pi/2.
+    """
+    n_times = ephemerides.shape[0]
+    n_rows, n_cols = len(rows), len(cols)
+    elevations = np.empty((n_times, n_rows, n_cols), dtype=np.float32)
+    azimuths = np.empty((n_times, n_rows, n_cols), dtype=np.float32)
+    aois = np.empty((n_times, n_rows, n_cols), dtype=np.float32)
+
+    # The ephemerides are computed in float64 and reduced to angles below 2*pi,
+    # so the per-pixel work can run in float32 without losing the timestamp.
+    pixel_ephemerides = ephemerides.astype(np.float32)
+
+    # Coordinates in radians along the two axes.
+    lat_rads = (np.pi*lats[rows]/180).astype(np.float32)
+    lon_rads = (np.pi*lons[cols]/180).astype(np.float32)
+
+    # Each (timestamp, tile) pair is an independent unit of work.
+    n_tile_rows = (n_rows + SOLAR_TILE_SIZE - 1) // SOLAR_TILE_SIZE
+    n_tile_cols = (n_cols + SOLAR_TILE_SIZE - 1) // SOLAR_TILE_SIZE
+    n_tiles = n_tile_rows*n_tile_cols
+    for i in prange(n_times*n_tiles):
+        t = i // n_tiles
+        x0 = (i % n_tiles) // n_tile_cols * SOLAR_TILE_SIZE
+        y0 = (i % n_tiles) % n_tile_cols * SOLAR_TILE_SIZE
+        x1 = min(x0 + SOLAR_TILE_SIZE, n_rows)
+        y1 = min(y0 + SOLAR_TILE_SIZE, n_cols)
+
+        # Skip the tile if the sun cannot be above its horizon.
+        max_height = 0.0
+        for x in range(x0, x1):
+            for y in range(y0, y1):
+                altitude = dem[rows[x], cols[y]]
+                if altitude != nodata:
+                    max_height = max(max_height, float(altitude))
+        bound = sun_elevation_bound(
+            ephemerides[t, 0],
+            ephemerides[t, 1],
+            ephemerides[t, 2],
+            min(lon_rads[y0], lon_rads[y1-1]),
+            max(lon_rads[y0], lon_rads[y1-1]),
+            min(lat_rads[x0], lat_rads[x1-1]),
+            max(lat_rads[x0], lat_rads[x1-1]),
+            max_height
+        )
+        if bound <= 0:
+            elevations[t, x0:x1, y0:y1] = bound
+            azimuths[t, x0:x1, y0:y1] = 0
+            aois[t, x0:x1, y0:y1] = np.pi/2
+            continue
+
+        sidereal_time = pixel_ephemerides[t, 0]
+        right_ascension = pixel_ephemerides[t, 1]
+        declination = pixel_ephemerides[t, 2]
+        for x in range(x0, x1):
+            for y in range(y0, y1):
+                altitude = np.float32(dem[rows[x], cols[y]])
+                if altitude == nodata:
+                    altitude = np.float32(0)
+                elev_angle, azimuth = topocentric_elevation_azimuth(
+                    lat_rads[x],
+                    lon_rads[y],
+                    altitude,
+                    sidereal_time,
+                    right_ascension,
+                    declination
+                )
+                elevations[t, x, y] = elev_angle
+                azimuths[t, x, y] = azimuth
+                aois[t, x, y] = incidence_angle(elev_angle, azimuth)
+    return elevations, azimuths, aois
+
+
+@jit(nopython=True, cache=True)
+def _lattice_error(elevations, azimuths, aois, rows, cols, mid_rows, mid_cols, n_rows, n_cols, ref_elevations, ref_azimuths, ref_aois):
+    row_lower, row_weights = lattice_weights(rows, n_rows)
+    col_lower, col_weights = lattice_weights(cols, n_cols)
+    elev_error, azi_error, aoi_error, cos_aoi_error = 0.0, 0.0, 0.0, 0.0
+    for t in range(elevations.shape[0]):
+        for i in range(len(mid_rows)):
+            x0, wx = row_lower[mid_rows[i]], row_weights[mid_rows[i]]
+            for j in range(len(mid_cols)):
+                # Only daylight matters, and the refraction correction is discontinuous below the horizon.
+                if ref_elevations[t, i, j] <= 0:
+                    continue
+                y0, wy = col_lower[mid_cols[j]], col_weights[mid_cols[j]]
+                elev = bilinear(elevations[t], x0, wx, y0, wy)
+                azi = bilinear_angle(azimuths[t], x0, wx, y0, wy)
+                aoi = clip_angle_of_incidence(bilinear(aois[t], x0, wx, y0, wy))
+                elev_error = max(elev_error, abs(elev-ref_elevations[t, i, j]))
+                azi_diff = (azi-ref_azimuths[t, i, j]+np.pi) % (2*np.pi) - np.pi
+                azi_error = max(azi_error, abs(azi_diff))
+                ref_aoi = clip_angle_of_incidence(ref_aois[t, i, j])
+                aoi_error = max(aoi_error, abs(aoi-ref_aoi))
+                cos_aoi_error = max(cos_aoi_error, abs(np.cos(aoi)-np.cos(ref_aoi)))
+    return elev_error, azi_error, aoi_error, cos_aoi_error
+
+
+def solar_lattice_error(ephemerides, lons, lats, dem, rows, cols):
+    """Maximum error of the bilinearly interpolated solar geometry against
+    full-resolution SPA.
+
+    The reference is evaluated at the centers of the lattice cells, where the
+    interpolation error of a smooth field is largest, for every timestamp
+    with the sun above the horizon.
+
+    Parameters
+    ----------
+    ephemerides : array
+        Array of shape (n_times, 3) from :func:`src.spa.sun_ephemeris_array`.
+
+    lons, lats : array
+        Coordinate axes of the DEM, see :func:`src.utils.coordinate_axes`.
+
+    dem : array
+        The int16 DEM in meters.
+
+    rows, cols : array
+        The lattice, see :func:`lattice_indices`.
+
+    Returns
+    -------
+    errors : dict
+        Maximum absolute error in radians of 'elevation', 'azimuth' and 'aoi',
+        and the maximum absolute error of 'cos_aoi'.
+    """
+    elevations, azimuths, aois = solar_position_array(ephemerides, lons, lats, dem, rows, cols)
+    mid_rows = (rows[:-1] + rows[1:]) // 2 if len(rows) > 1 else rows
+    mid_cols = (cols[:-1] + cols[1:]) // 2 if len(cols) > 1 else cols
+    ref_elevations, ref_azimuths, ref_aois = solar_position_array(
+        ephemerides, lons, lats, dem, mid_rows, mid_cols
+    )
+    elev_error, azi_error, aoi_error, cos_aoi_error = _lattice_error(
+        elevations, azimuths, aois, rows, cols, mid_rows, mid_cols,
+        dem.shape[0], dem.shape[1], ref_elevations, ref_azimuths, ref_aois
+    )
+    return {
+        'elevation': elev_error,
+        'azimuth': azi_error,
+        'aoi': aoi_error,
+        'cos_aoi': cos_aoi_error
+    }
+
+
+def solar_lattice_stepsize(ephemerides, lons, lats, dem, max_error=1e-4, max_stepsize=None):
+    """Coarsest lattice whose interpolated elevation and cosine of the angle
+    of incidence stay within `max_error` of full-resolution SPA.
+
+    The stepsize starts at `max_stepsize` and is halved until the error
+    observed by :func:`solar_lattice_error` is within bounds. The irradiance
+    only uses the elevation and cos(aoi). The azimuth is ill-conditioned with
+    the sun close to the zenith, and the angle of incidence has a kink where
+    the sun lines up with the panel normal, so both are reported but not
+    bounded.
+
+    Parameters
+    ----------
+    max_error : float
+        Target error in radians, or of the cosine for the angle of incidence.
+
+    max_stepsize : int
+        Coarsest stepsize to try, defaults to the largest DEM side.
+
+    Returns
+    -------
+    stepsize : int
+        The lattice stepsize in pixels.
+
+    errors : dict
+        The error report of the chosen lattice, see :func:`solar_lattice_error`.
+    """
+    n_rows, n_cols = dem.shape
+    stepsize = max_stepsize or max(n_rows, n_cols)
+    while True:
+        rows = lattice_indices(n_rows, stepsize)
+        cols = lattice_indices(n_cols, stepsize)
+        errors = solar_lattice_error(ephemerides, lons, lats, dem, rows, cols)
+        if max(errors['elevation'], errors['cos_aoi']) <= max_error or stepsize == 1:
+            return stepsize, errors
+        stepsize = max(stepsize // 2, 1)
+
+
+def _solar_geometry_path(directory, year, month, day, hour):
+    minutes = int(round(hour*60))
+    filename = f'{day_to_string(day)}_{minutes // 60:02d}{minutes % 60:02d}.npz'
+    return directory / str(year) / month_to_string(month) / filename
+
+
+def save_solar_geometry(directory, year, month, day, hour, elevations, azimuths, aois, node_lons, node_lats):
+    """Store the float32 solar geometry of one timestamp in a compressed
+    cache, keyed by timestamp and tagged with the coordinates of its lattice
+    nodes.
+    """
+    path = _solar_geometry_path(directory, year, month, day, hour)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(
+        path,
+        elevations=elevations.astype(np.float32),
+        azimuths=azimuths.astype(np.float32),
+        aois=aois.astype(np.float32),
+        lons=node_lons,
+        lats=node_lats
+    )
+
+
+def load_solar_geometry(directory, year, month, day, hour, node_lons, node_lats):
+    """Load the cached solar geometry of one timestamp.
+
+    Returns
+    -------
+    geometry : tuple or None
+        The elevations, azimuths and aois, or None if the timestamp is not
+        cached or was cached on a different lattice.
+    """
+    path = _solar_geometry_path(directory, year, month, day, hour)
+    if not path.exists():
+        return None
+    with np.load(path) as cached:
+        if 'lons' not in cached.files or not (
+            np.array_equal(cached['lons'], node_lons) and np.array_equal(cached['lats'], node_lats)
+        ):
+            return None
+        return cached['elevations'], cached['azimuths'], cached['aois']
+
+
+def solar_geometry(years, months, days, hours, lons, lats, dem, rows, cols, cache_directory=None):
+    """Solar elevation, azimuth and unclipped angle of incidence on a lattice
+    for a batch of timestamps, kept in memory.
+
+    If `cache_directory` is given, timestamps already cached on the same
+    lattice are read from it, and the remaining ones are computed in one
+    batched call and added to it. The cache is tagged with the coordinates
+    of the lattice nodes, so `dem` may hold the whole raster or only the
+    nodes, see :func:`src.utils.read_pixels`.
+
+    Returns
+    -------
+    elevations, azimuths, aois : array
+        Float32 arrays of shape (n_times, len(rows), len(cols)).
+    """
+    n_times = len(years)
+    elevations = np.empty((n_times, len(rows), len(cols)), dtype=np.float32)
+    azimuths = np.empty((n_times, len(rows), len(cols)), dtype=np.float32)
+    aois = np.empty((n_times, len(rows), len(cols)), dtype=np.float32)
+
+    node_lons, node_lats = lons[cols], lats[rows]
+    missing = list()
+    for t in range(n_times):
+        cached = None
+        if cache_directory is not None:
+            cached = load_solar_geometry(
+                cache_directory, years[t], months[t], days[t], hours[t], node_lons, node_lats
+            )
+        if cached is None:
+            missing.append(t)
+        else:
+            elevations[t], azimuths[t], aois[t] = cached
+
+    if missing:
+        missing = np.array(missing)
+        ephemerides = sun_ephemeris_array(
+            years[missing], months[missing], days[missing], hours[missing]
+        )
+        elevations[missing], azimuths[missing], aois[missing] = solar_position_array(
+            ephemerides, lons, lats, dem, rows, cols
+        )
+        if cache_directory is not None:
+            for t in missing:
+                save_solar_geometry(
+                    cache_directory, years[t], months[t], days[t], hours[t],
+                    elevations[t], azimuths[t], aois[t], node_lons, node_lats
+                )
+    return elevations, azimuths, aois
+
+
+@jit(nopython=True, cache=True)
+def _horizon_elevation():
+    # Geocentric elevation at which the refracted topocentric elevation of
+    # :func:`src.spa.topocentric_elevation_azimuth` crosses zero. The
+    # refracted elevation increases with the true one below the horizon.
+    low, high = -0.2, 0.0
+    for _ in range(60):
+        mid = (low + high)/2
+        if mid + refraction_correction(mid) > 0:
+            high = mid
+        else:
+            low = mid
+    parallax = 4.263521e-05
+    return (low + high)/2 + parallax
+
+
+@njit(parallel=True, cache=True)
+def _daylight_times(declinations, equations_of_time, lons, lats, dem, rows, cols, nodata):
+    n_days = declinations.shape[0]
+    n_rows, n_cols = len(rows), len(cols)
+    sunrises = np.full((n_days, n_rows, n_cols), np.nan, dtype=np.float32)
+    transits = np.full((n_days, n_rows, n_cols), np.nan, dtype=np.float32)
+    sunsets = np.full((n_days, n_rows, n_cols), np.nan, dtype=np.float32)
+    h0 = _horizon_elevation()
+    for i in prange(n_days*n_rows):
+        d = i // n_rows
+        x = i % n_rows
+        latitude = np.pi*lats[rows[x]]/180
+        for y in range(n_cols):
+            if dem[rows[x], cols[y]] == nodata:
+                continue
+            longitude = np.pi*lons[cols[y]]/180
+            # The hour angle of the sun at hour h (UT) is
+            # 2*pi*h/24 - pi + longitude + equation_of_time(h). Each event is
+            # the fixed point of that relation at its target hour angle.
+            for event in range(3):
+                hour = 12 - 12*longitude/np.pi + 6*(event-1)
+                for _ in range(4):
+                    # Hourly samples start at -12h.
+                    k = min(max(hour + 12, 0.0), declinations.shape[1]-1.001)
+                    j = int(k)
+                    w = k - j
+                    declination = declinations[d, j] + w*(declinations[d, j+1]-declinations[d, j])
+                    eot = equations_of_time[d, j] + w*(equations_of_time[d, j+1]-equations_of_time[d, j])
+                    hour_angle = 0.0
+                    if event != 1:
+                        cos_h = (np.sin(h0) - np.sin(latitude)*np.sin(declination)) \
+                            / (np.cos(latitude)*np.cos(declination))
+                        if abs(cos_h) > 1:
+                            hour_angle = np.nan
+                            break
+                        hour_angle = np.arccos(cos_h)*(event-1)
+                    hour = 12 + 12*(hour_angle - longitude - eot)/np.pi
+                if np.isnan(hour_angle):
+                    continue
+                if event == 0:
+                    sunrises[d, x, y] = hour
+                elif event == 1:
+                    transits[d, x, y] = hour
+                else:
+                    sunsets[d, x, y] = hour
+    return sunrises, transits, sunsets
+
+
+def daylight_times(years, months, days, lons, lats, dem, rows, cols, nodata=-32768):
+    """Sunrise, solar transit and sunset of every pixel for a range of dates
+    in one parallel call.
+
+    The events are where the elevation of
+    :func:`src.spa.topocentric_elevation_azimuth`, refraction included,
+    crosses zero and where the hour angle is zero. The declination and
+    equation of time are interpolated from hourly ephemerides and each event
+    is refined by fixed-point iteration, to a few seconds. The times are
+    smooth in space, so a coarse lattice from :func:`lattice_indices` can be
+    interpolated like the solar geometry.
+
+    Parameters
+    ----------
+    years, months, days : array
+        Integer arrays with the dates.
+
+    lons, lats : array
+        Coordinate axes of the DEM, see :func:`src.utils.coordinate_axes`.
+
+    dem : array
+        The int16 DEM, only used for its nodata mask.
+
+    rows, cols : array
+        DEM rows and columns to evaluate, see :func:`lattice_indices`.
+
+    Returns
+    -------
+    sunrises, transits, sunsets : array
+        Float32 arrays of shape (n_days, len(rows), len(cols)) in decimal UT
+        hours since 0h of each date, which may fall outside [0, 24) far from
+        Greenwich. NaN outside the DEM, and for sunrise and sunset on polar
+        days and nights.
+    """
+    years, months, days = np.asarray(years), np.asarray(months), np.asarray(days)
+    n_days = len(years)
+    sample_hours = np.arange(-12, 37, dtype=np.float64)
+    n_samples = len(sample_hours)
+    ephemerides = sun_ephemeris_array(
+        np.repeat(years, n_samples),
+        np.repeat(months, n_samples),
+        np.repeat(days, n_samples),
+        np.tile(sample_hours, n_days)
+    ).reshape(n_days, n_samples, 3)
+    # Hour angle of the sun at Greenwich minus that of the mean sun.
+    mean_hour_angles = 2*np.pi*sample_hours/24 - np.pi
+    equations_of_time = (ephemerides[..., 0] - ephemerides[..., 1] - mean_hour_angles + np.pi) % (2*np.pi) - np.pi
+    return _daylight_times(
+        np.ascontiguousarray(ephemerides[..., 2]), equations_of_time, lons, lats, dem, rows, cols, nodata
+    )
+
+
+def daylight_quadrature(sunrises, sunsets, n_nodes):
+    """Gauss-Legendre nodes and weights over the daylight window, for
+    integrating a quantity over a day from `n_nodes` samples.
+
+    Returns
+    -------
+    hours : array
+        Array of shape (n_nodes,) + sunrises.shape with the sample hours.
+
+    weights : array
+        Weights in hours of the same shape, such that the sum of
+        weights*f(hours) over the first axis integrates f over daylight.
+        Zero where there is no sunrise or sunset.
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(n_nodes)
+    half = np.nan_to_num((sunsets - sunrises)/2)
+    middle = np.nan_to_num((sunsets + sunrises)/2)
+    shape = (n_nodes,) + (1,)*np.ndim(sunrises)
+    hours = middle + half*nodes.reshape(shape)
+    weights = half*weights.reshape(shape)
+    return hours.astype(np.float32), weights.astype(np.float32)
@@ -0,0 +1,237 @@
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+from numba import jit
+
+from config import NIGERIA_SHAPEFILE, VALID_SPANS_DIRECTORY
+
+
+@jit(nopython=True, cache=True)
+def mask_spans(mask):
+    """Run-length row spans of the True pixels of a mask.
+
+    The spans are stored like a CSR matrix: the spans of row x are
+    starts[row_ptr[x]:row_ptr[x+1]] to stops[row_ptr[x]:row_ptr[x+1]], with
+    the stops exclusive, in increasing column order.
+
+    Returns
+    -------
+    spans : tuple
+        The int64 arrays (row_ptr, starts, stops).
+    """
+    n_rows, n_cols = mask.shape
+    row_ptr = np.zeros(n_rows+1, dtype=np.int64)
+    n_spans = 0
+    for x in range(n_rows):
+        inside = False
+        for y in range(n_cols):
+            if mask[x, y] and not inside:
+                n_spans += 1
+            inside = mask[x, y]
+        row_ptr[x+1] = n_spans
+
+    starts = np.empty(n_spans, dtype=np.int64)
+    stops = np.empty(n_spans, dtype=np.int64)
+    k = 0
+    for x in range(n_rows):
+        y = 0
+        while y < n_cols:
+            if mask[x, y]:
+                starts[k] = y
+                while y < n_cols and mask[x, y]:
+                    y += 1
+                stops[k] = y
+                k += 1
+            else:
+                y += 1
+    return row_ptr, starts, stops
+
+
+def dem_spans(dem, nodata=-32768):
+    """Row spans of the pixels of an in-memory raster that are not nodata,
+    see :func:`mask_spans`.
+    """
+    return mask_spans(dem != nodata)
+
+
+@jit(nopython=True, cache=True)
+def window_spans(spans, row_off, col_off, height, width):
+    """Row spans of a raster window, clipped to it and relative to its
+    upper left corner.
+    """
+    row_ptr, starts, stops = spans
+    window_ptr = np.zeros(height+1, dtype=np.int64)
+    window_starts = np.empty(row_ptr[row_off+height] - row_ptr[row_off], dtype=np.int64)
+    window_stops = np.empty_like(window_starts)
+    k = 0
+    for x in range(height):
+        for s in range(row_ptr[row_off+x], row_ptr[row_off+x+1]):
+            start = max(starts[s], col_off) - col_off
+            stop = min(stops[s], col_off+width) - col_off
+            if start < stop:
+                window_starts[k] = start
+                window_stops[k] = stop
+                k += 1
+        window_ptr[x+1] = k
+    return window_ptr, window_starts[:k], window_stops[:k]
+
+
+@jit(nopython=True, cache=True)
+def _merge_spans(rows, firsts, lasts, height):
+    # Spans of the column ranges firsts to lasts (inclusive) of rows, sorted
+    # by row and first column, merged where they overlap or touch.
+    row_ptr = np.zeros(height+1, dtype=np.int64)
+    starts = np.empty(len(rows), dtype=np.int64)
+    stops = np.empty(len(rows), dtype=np.int64)
+    k = -1
+    for i in range(len(rows)):
+        if k >= 0 and rows[i] == rows[i-1] and firsts[i] <= stops[k]:
+            stops[k] = max(stops[k], lasts[i]+1)
+        else:
+            k += 1
+            starts[k], stops[k] = firsts[i], lasts[i]+1
+            row_ptr[rows[i]+1] += 1
+    return np.cumsum(row_ptr), starts[:k+1], stops[:k+1]
+
+
+def polygon_spans(geometry, transform, height, width):
+    """Row spans of the pixels of a grid that a polygon touches, as
+    rasterized with all_touched.
+
+    The rings of the polygon are taken to pixel coordinates once, and every
+    row gets the columns where the inside of its pixels meets the polygon:
+    along the parts of the edges that cross the row, and just inside its
+    top and bottom, between pairs of edge crossings. As in GDAL, a pixel the
+    boundary only runs along the side of is not touched, and neither is one
+    it only meets at a corner, where GDAL sometimes burns the pixel of a
+    vertex. No mask of the grid is built, so memory goes with the length of
+    the boundary, and every row depends only on the polygon and the grid,
+    as in a single pass over a mask.
+
+    Parameters
+    ----------
+    geometry : shapely Polygon or MultiPolygon
+        In the coordinates of the grid.
+
+    transform : Affine
+        The affine transform of the grid.
+
+    height, width : int
+        Shape of the grid.
+
+    Returns
+    -------
+    spans : tuple
+        The int64 arrays (row_ptr, starts, stops), see :func:`mask_spans`.
+    """
+    polygons = geometry.geoms if hasattr(geometry, 'geoms') else [geometry]
+    x0, y0, x1, y1 = list(), list(), list(), list()
+    for polygon in polygons:
+        for ring in (polygon.exterior, *polygon.interiors):
+            coords = np.asarray(ring.coords)
+            cols, rows = ~transform * (coords[:, 0], coords[:, 1])
+            x0.append(cols[:-1]), y0.append(rows[:-1]), x1.append(cols[1:]), y1.append(rows[1:])
+    x0, y0, x1, y1 = np.concatenate(x0), np.concatenate(y0), np.concatenate(x1), np.concatenate(y1)
+    y_min, y_max = np.minimum(y0, y1), np.maximum(y0, y1)
+    sloped = np.flatnonzero(y0 != y1)
+    flat = np.flatnonzero((y0 == y1) & (y0 != np.floor(y0)))
+    slopes = (x1[sloped]-x0[sloped]) / (y1[sloped]-y0[sloped])
+
+    def along(first, last):
+        # Every sloped edge once for each integer from first to last, within
+        # the rows of the grid.
+        counts = np.maximum(np.minimum(last, height-1) - np.maximum(first, 0) + 1, 0).astype(np.int64)
+        steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(np.arange(len(sloped)), counts), np.repeat(np.maximum(first, 0), counts) + steps
+
+    def x_at(edges, y):
+        return x0[sloped][edges] + (y - y0[sloped][edges])*slopes[edges]
+
+    # The parts of the sloped edges inside every row they cross, and the
+    # edges that run along a row.
+    edges, rows = along(np.floor(y_min[sloped]), np.ceil(y_max[sloped]) - 1)
+    top_x = x_at(edges, np.maximum(y_min[sloped][edges], rows))
+    bottom_x = x_at(edges, np.minimum(y_max[sloped][edges], rows+1))
+    all_rows = [rows, np.floor(y0[flat])]
+    lefts = [np.minimum(top_x, bottom_x), np.minimum(x0, x1)[flat]]
+    rights = [np.maximum(top_x, bottom_x), np.maximum(x0, x1)[flat]]
+
+    # The inside of the polygon just below and just above every grid line,
+    # between pairs of crossings of the edges that go on past the line, in
+    # the row on that side of it.
+    for first, last, row_shift in (
+        (np.ceil(y_min[sloped]), np.ceil(y_max[sloped]) - 1, 0),
+        (np.floor(y_min[sloped]), np.floor(y_max[sloped]) - 1, 1)
+    ):
+        edges, rows = along(first, last)
+        crossings = x_at(edges, rows + row_shift)
+        order = np.lexsort((crossings, rows))
+        rows, crossings = rows[order], crossings[order]
+        all_rows.append(rows[::2])
+        lefts.append(crossings[::2])
+        rights.append(crossings[1::2])
+
+    # The columns of the pixels whose inside meets the parts.
+    rows, lefts, rights = np.concatenate(all_rows).astype(np.int64), np.concatenate(lefts), np.concatenate(rights)
+    firsts = np.maximum(np.floor(lefts), 0).astype(np.int64)
+    lasts = np.minimum(np.ceil(rights) - 1, width-1).astype(np.int64)
+    kept = (rows >= 0) & (rows < height) & (firsts <= lasts)
+    rows, firsts, lasts = rows[kept], firsts[kept], lasts[kept]
+    order = np.lexsort((firsts, rows))
+    return _merge_spans(rows[order], firsts[order], lasts[order], height)
+
+
+# Bumped whenever the rasterization of valid_spans changes, so that spans
+# cached by an older one are not reused.
+_VALID_SPANS_VERSION = 2
+
+
+def _valid_spans_path(transform, height, width, shapefile):
+    # Keyed by the contents of the shapefile rather than its path, so that
+    # spans of an older polygon saved under the same name are not reused.
+    with open(shapefile, 'rb') as polygon:
+        digest = hashlib.sha1(polygon.read()).hexdigest()
+    key = repr(((transform.a, transform.b, transform.c, transform.d,
+                  transform.e, transform.f), height, width, digest, _VALID_SPANS_VERSION))
+    return VALID_SPANS_DIRECTORY / (hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+
+@lru_cache(maxsize=None)
+def valid_spans(transform, height, width, shapefile=NIGERIA_SHAPEFILE):
+    """Row spans of the pixels of a grid inside the country polygon, shared by
+    every raster on that grid.
+
+    The polygon is rasterized with all_touched, as in the crop of the
+    preprocessed datasets, straight into spans with :func:`polygon_spans`,
+    which keeps memory bounded without cutting the grid into blocks. The
+    spans are stored in VALID_SPANS_DIRECTORY, keyed by the grid and the
+    contents of the shapefile, and kept in memory.
+
+    Parameters
+    ----------
+    transform : Affine
+        The affine transform of the grid.
+
+    height, width : int
+        Shape of the grid.
+
+    Returns
+    -------
+    spans : tuple
+        The int64 arrays (row_ptr, starts, stops), see :func:`mask_spans`.
+    """
+    path = _valid_spans_path(transform, height, width, shapefile)
+    if path.exists():
+        with np.load(path) as cached:
+            return cached['row_ptr'], cached['starts'], cached['stops']
+
+    # Imported here, as geopandas alone takes longer to import than the kernels.
+    import geopandas as gpd
+
+    geometry = gpd.read_file(shapefile)['geometry'][0]
+    spans = polygon_spans(geometry, transform, height, width)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(path, row_ptr=spans[0], starts=spans[1], stops=spans[2])
+    return spans
@@ -0,0 +1,110 @@
+import numpy as np
+
+from ..spa import sun_ephemeris_array, _sun_ephemeris_array, _table_positions, _interpolate_ephemerides
+from ._solar_position import lattice_indices, solar_lattice_error, solar_geometry, daylight_times
+from ._valid_pixels import dem_spans, window_spans, _merge_spans
+from ._elevation import calc_shadow_mask, shadow_mask, max_pyramid, slope_aspect, horizon_angles, horizon_shadow_mask,\
+    sky_view_factor, HORIZON_MIN_ELEVATION
+from ._clear_sky import clear_sky_irradiance, clear_sky_irradiance_sums, aggregate_groups, AGGREGATES,\
+    clear_sky_orientation_sweep, ORIENTATION_BANDS, clear_sky_uncertainty, input_samples, UNCERTAINTY_QUANTILES,\
+    clear_sky_components, component_bands
+
+
+def warm_up_kernels():
+    """Compile the numba kernels of the clear sky pipeline into the on-disk
+    cache.
+
+    The kernels are cached with `cache=True` next to their modules, or in
+    NUMBA_CACHE_DIR if set, keyed by their argument types. They are called
+    here on a tiny grid with the types the pipeline uses: an int16 DEM,
+    float64 coordinate axes and ephemerides, float32 solar geometry, float64
+    CAMS fields and float32 albedo and cloud cover. Later processes load the
+    machine code instead of compiling it again.
+
+    The kernels the windowed drivers call are compiled as those call them,
+    without a tile size, with and without the terrain and the sky view
+    factor, since an argument left to its default is typed apart from one
+    that is passed.
+    """
+    dem, spans = _warm_up_clear_sky_kernels()
+
+    # The land cover datasets it is imported with are slow to import, so only
+    # here.
+    from ._proximity_impervious import _split_valid_pixels
+    _split_valid_pixels(dem, spans)
+
+
+def _warm_up_clear_sky_kernels():
+    # The kernels of warm_up_kernels but the land cover one, on an 8 x 8 DEM,
+    # which is returned with its spans.
+    years = np.array([2014, 2014], dtype=np.int64)
+    months = np.array([6, 6], dtype=np.int64)
+    days = np.array([21, 21], dtype=np.int64)
+    hours = np.array([9.0, 12.0])
+    ephemerides = sun_ephemeris_array(years, months, days, hours)
+    _sun_ephemeris_array(years, months, days, hours)
+
+    # The interpolation of the ephemeris table, on a read-only stand-in for
+    # the memory map so that it compiles whether the table is built or not.
+    table = np.zeros((2, 4), dtype=np.float32)
+    table.setflags(write=False)
+    _interpolate_ephemerides(table, _table_positions(years, months, days, hours) % 1)
+
+    dem = np.zeros((8, 8), dtype=np.int16)
+    lons = np.linspace(3.0, 4.0, dem.shape[1])
+    lats = np.linspace(10.0, 9.0, dem.shape[0])
+    rows = lattice_indices(dem.shape[0], 4)
+    cols = lattice_indices(dem.shape[1], 4)
+    solar_lattice_error(ephemerides, lons, lats, dem, rows, cols)
+    elevations, azimuths, aois = solar_geometry(years, months, days, hours, lons, lats, dem, rows, cols)
+    daylight_times(years, months, days, lons, lats, dem, rows, cols)
+
+    spans = window_spans(dem_spans(dem), 0, 0, *dem.shape)
+    cams = np.ones((2, 2))
+    surface = np.zeros((2, 2), dtype=np.float32)
+    grid_rows = np.zeros(dem.shape[0], dtype=np.int64)
+    grid_cols = np.zeros(dem.shape[1], dtype=np.int64)
+    _merge_spans(np.arange(dem.shape[0]), np.zeros(dem.shape[0], dtype=np.int64), grid_rows, dem.shape[0])
+    clear_sky_irradiance(
+        elevations[0], aois[0], rows, cols, dem, spans, cams, cams, cams,
+        surface, surface, grid_rows, grid_cols, grid_rows, grid_cols, 2014, 6, 21
+    )
+    calc_shadow_mask(dem, spans, elevations[0], azimuths[0])
+    calc_shadow_mask(dem, spans, elevations[0], azimuths[0], 1, max_pyramid(dem))
+
+    shadow_mask(30.0, 135.0, dem)
+    horizons = horizon_angles(dem, 4, HORIZON_MIN_ELEVATION, 1)
+    horizon_shadow_mask(horizons, elevations[0], azimuths[0])
+    svfs = np.pad(sky_view_factor(horizons), 1, constant_values=1)
+    slopes, aspects = slope_aspect(dem, np.full(dem.shape[0], 30.0), 30.0)
+    sums = np.zeros((len(AGGREGATES),) + dem.shape)
+    counts = np.zeros((len(AGGREGATES),) + dem.shape, dtype=np.int32)
+    samples = input_samples(cams, cams, cams, surface, 2, seed=0)
+    uncertainty = np.empty((1 + len(UNCERTAINTY_QUANTILES),) + dem.shape)
+    # The terrain arguments as the windowed drivers pass them: none, the
+    # azimuths, slopes and aspects, the sky view factor, or all of them.
+    terrains = [((), {}), ((slopes, aspects), {}), ((), {'svfs': svfs}), ((slopes, aspects), {'svfs': svfs})]
+    stacks = (np.stack([cams]*2), np.stack([cams]*2), np.stack([cams]*2), np.stack([surface]*2), np.stack([surface]*2))
+    for terrain, sky_view in terrains:
+        clear_sky_components(
+            elevations[0], aois[0], rows, cols, dem, spans, cams, cams, cams, surface, surface, grid_rows,
+            grid_cols, grid_rows, grid_cols, 2014, 6, 21, component_bands(['poa']), np.empty((1,) + dem.shape),
+            *((azimuths[0],) + terrain if terrain else ()), **sky_view
+        )
+        clear_sky_irradiance_sums(
+            elevations, aois, rows, cols, dem, spans, *stacks, grid_rows, grid_cols, grid_rows, grid_cols,
+            years, months, days, aggregate_groups(months), sums, counts,
+            *((azimuths,) + terrain if terrain else ()), **sky_view
+        )
+        clear_sky_uncertainty(
+            elevations[0], aois[0], rows, cols, dem, spans, *samples, surface, grid_rows, grid_cols,
+            grid_rows, grid_cols, 2014, 6, 21, np.array(UNCERTAINTY_QUANTILES), uncertainty,
+            *((azimuths[0],) + terrain if terrain else ()), **sky_view
+        )
+        clear_sky_orientation_sweep(
+            elevations, azimuths, rows, cols, dem, spans, *stacks, grid_rows, grid_cols, grid_rows,
+            grid_cols, years, months, days, np.zeros(1), np.zeros(1),
+            np.empty((len(ORIENTATION_BANDS),) + dem.shape),
+            **(dict(zip(('slopes', 'aspects'), terrain))), **sky_view
+        )
+    return dem, spans
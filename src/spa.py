@@ -1,9 +1,35 @@
+from datetime import date, timedelta
+from functools import lru_cache
+from warnings import warn
+
 import numpy as np
 import numba as nb
-from numba import jit, float32
+from numba import jit, prange
+
+from config import EPHEMERIS_TABLE
+
+
+# Julian date of the epoch the modified Julian dates count from, 1980-01-01 0h.
+# The time-dependent terms are evaluated in float64 days since this epoch, so
+# they keep sub-second resolution over the 1980-2030 range of delta_t.
+EPOCH_JULIAN_DATE = 2444239.5
+
+# The precomputed ephemeris table holds one row per minute from the epoch to
+# the end of the delta_t validity range.
+EPHEMERIS_TABLE_START = date(1980, 1, 1)
+EPHEMERIS_TABLE_END = date(2031, 1, 1)
+
+
+def _pixel_signatures(n_args):
+    # The per-pixel stage is compiled in float32, the fast path used by the
+    # raster kernels, and in float64, the reference it is benchmarked against.
+    return [
+        nb.types.UniTuple(dtype, 2)(*([dtype]*n_args))
+        for dtype in (nb.float32, nb.float64)
+    ]
 
 
-@jit(nopython=True, fastmath=True)
+@jit(nopython=True, fastmath=True, cache=True)
 def delta_t(year, month):
     """Difference between Universal Time (UT, defined by Earth's rotation)
     from Terrestrial Time (TT, independent of the Earth's rotation).
@@ -40,7 +66,7 @@ def delta_t(year, month):
     return sum_
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def universal_julian_date(year, month, day, hour):
     """The Universal Time Julian day corresponds to the decimal number of days
     starting from January 1, in the year -4712 at 12:00:00 UT.
@@ -80,12 +106,11 @@ def universal_julian_date(year, month, day, hour):
         dayfrac += 1
         date -= 1
 
-    # Fraction of a day
-    frac = dayfrac + (hour - int(hour)) / 1440 # minute frac
-    return date + frac
+    # Fraction of a day, minutes are already part of the decimal hour
+    return date + dayfrac
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def terrestrial_julian_date(year, month, day, hour):
     """TBA.
     """
@@ -94,21 +119,21 @@ def terrestrial_julian_date(year, month, day, hour):
     return jut + (dt / 86400)
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def modified_universal_julian_date(uni_julian_date):
     """TBA.
     """
-    return uni_julian_date - 2444239.5
+    return uni_julian_date - EPOCH_JULIAN_DATE
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def modified_terrestrial_julian_date(terre_julian_date):
     """TBA.
     """
-    return terre_julian_date - 2444239.5
+    return terre_julian_date - EPOCH_JULIAN_DATE
 
 
-@nb.jit(float32(float32), nopython=True, fastmath=True)
+@jit(nopython=True, fastmath=True, cache=True)
 def earth_heliocentric_longitude(mod_terre_julian_date):
     """TBA.
 
@@ -123,15 +148,15 @@ def earth_heliocentric_longitude(mod_terre_julian_date):
     f = np.array([
         1/365.261278, 1/182.632412, 1/29.530634, 1/399.529850, 1/291.956812,
         1/583.598201, 1/4652.629372, 1/1450.236684, 1/199.459709, 1/365.355291
-    ], dtype=np.float32)
+    ])
     rho = np.array([
         3.401508e-02, 3.486440e-04, 3.136227e-05, 3.578979e-05, 2.676185e-05,
         2.333925e-05, 1.221214e-05, 1.217941e-05, 1.343914e-05, 8.499475e-04
-    ], dtype=np.float32)
+    ])
     phi = np.array([
         1.600780, 1.662976, -1.195905, -1.042052, 2.012613,
         -2.867714, 1.225038, -0.828601, -3.108253, -2.353709
-    ], dtype=np.float32)
+    ])
 
     sum_ = 0
     for i in range(10):
@@ -140,7 +165,7 @@ def earth_heliocentric_longitude(mod_terre_julian_date):
     return sum_ + a*mjtt + b
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def refraction_correction(elevation, annual_pressure=1013.25, annual_temp=27):
     """TBA.
 
@@ -163,7 +188,7 @@ def refraction_correction(elevation, annual_pressure=1013.25, annual_temp=27):
     return correction
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def earth_heliocentric_latitude(terre_julian_date):
     """TBA.
 
@@ -191,7 +216,7 @@ def earth_heliocentric_latitude(terre_julian_date):
     return B
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def nutation_sun_geocentric_longitude(mod_terre_julian_date):
     """TBA.
 
@@ -208,7 +233,7 @@ def nutation_sun_geocentric_longitude(mod_terre_julian_date):
     return rho * np.cos(2*np.pi*f*mjtt - phi)
     
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def true_earth_obliguity(mod_terre_julian_date):
     """TBA.
 
@@ -227,8 +252,7 @@ def true_earth_obliguity(mod_terre_julian_date):
     return rho * np.cos(2*np.pi*f * mjtt - phi) + a*mjtt + b
 
 
-#@jit(nopython=True)
-@nb.jit(nb.types.UniTuple(nb.float32,2)(nb.float32),nopython=True)
+@jit(nopython=True, cache=True)
 def apparent_sun_longitude(mod_terre_julian_date):
     """TBA.
 
@@ -244,39 +268,228 @@ def apparent_sun_longitude(mod_terre_julian_date):
     return Sigma + delta_psi + delta_tau, delta_psi
 
 
-@nb.jit(nb.types.UniTuple(nb.float32,2)(nb.float32, nb.float32, nb.float32, nb.float32),nopython=True)
-def H_and_delta(longitude, terre_julian_date, mod_terre_julian_date, mod_uni_julian_date):
+@jit(nopython=True, cache=True)
+def sun_ephemeris(year, month, day, hour):
+    """Time-dependent part of the solar position.
+
+    The Julian dates, heliocentric longitude and latitude, nutation, obliquity,
+    sidereal time and the geocentric right ascension and declination depend
+    only on the timestamp. They are computed once here and shared by every
+    pixel through :func:`topocentric_elevation_azimuth`.
+
+    Parameters
+    ----------
+    year : int
+        Input year.
+
+    month : int
+        Input month.
+
+    day : int
+        Input day.
+
+    hour : float
+        Decimal UT hour.
+
+    Returns
+    -------
+    sidereal_time : float
+        Apparent sidereal time at Greenwich in radians, reduced to [0, 2*pi).
+
+    right_ascension : float
+        Geocentric sun right ascension in radians.
+
+    declination : float
+        Geocentric sun declination in radians.
+    """
+    uni_julian_date = universal_julian_date(year, month, day, hour)
+    terre_julian_date = terrestrial_julian_date(year, month, day, hour)
+    mod_uni_julian_date = modified_universal_julian_date(uni_julian_date)
+    mod_terre_julian_date = modified_terrestrial_julian_date(terre_julian_date)
+
     epsilon = true_earth_obliguity(mod_terre_julian_date)
     lambd, delta_psi = apparent_sun_longitude(mod_terre_julian_date)
     beta = -earth_heliocentric_latitude(terre_julian_date)
 
     # Calculate apparent sidereal time
     v0 = 6.300388099*mod_uni_julian_date + 1.742079 # ADJUSTED! removed one 0
-    v = v0 + delta_psi*np.cos(epsilon)
+    v = (v0 + delta_psi*np.cos(epsilon)) % (2*np.pi)
 
     # Calculate sun right ascension
     numerator = np.sin(lambd)*np.cos(epsilon) - np.tan(beta)*np.sin(epsilon)
     denominator = np.cos(lambd)
     alpha = np.arctan2(numerator, denominator)
 
-    # Calculate observer local hour angle
-    H = v + longitude - alpha
-
     # Calculate geocentric declination
     delta = np.arcsin(
         np.sin(beta)*np.cos(epsilon) + np.cos(beta)*np.sin(epsilon)*np.sin(lambd)
     )
 
-    return H, delta
+    return v, alpha, delta
+
+
+@jit(nopython=True, cache=True)
+def _sun_ephemeris_array(years, months, days, hours):
+    ephemerides = np.empty((len(years), 3))
+    for t in range(len(years)):
+        sidereal_time, right_ascension, declination = sun_ephemeris(
+            years[t], months[t], days[t], hours[t]
+        )
+        ephemerides[t, 0] = sidereal_time
+        ephemerides[t, 1] = right_ascension
+        ephemerides[t, 2] = declination
+    return ephemerides
+
+
+@jit(nopython=True, cache=True)
+def _wrap_angle(angle):
+    # Wrap an angle difference to [-pi, pi).
+    return (angle + np.pi) % (2*np.pi) - np.pi
+
+
+@jit(nopython=True, cache=True)
+def _table_positions(years, months, days, hours):
+    # Fractional row of each timestamp in the ephemeris table.
+    positions = np.empty(len(years))
+    for t in range(len(years)):
+        day_index = universal_julian_date(years[t], months[t], days[t], 0.0) - EPOCH_JULIAN_DATE
+        positions[t] = np.round(day_index)*1440 + hours[t]*60
+    return positions
+
+
+@jit(nopython=True, cache=True)
+def _interpolate_ephemerides(table, positions):
+    ephemerides = np.empty((len(positions), 3))
+    for t in range(len(positions)):
+        i = int(np.floor(positions[t]))
+        w = positions[t] - i
+        if i == table.shape[0]-1:
+            i, w = i-1, 1.0
+        ephemerides[t, 0] = (table[i, 2] + w*_wrap_angle(table[i+1, 2]-table[i, 2])) % (2*np.pi)
+        ephemerides[t, 1] = table[i, 1] + w*_wrap_angle(table[i+1, 1]-table[i, 1])
+        ephemerides[t, 2] = table[i, 0] + w*(table[i+1, 0]-table[i, 0])
+    return ephemerides
 
 
-@nb.jit(nb.types.UniTuple(nb.float32,2)(nb.float32, nb.float32, nb.float32, nb.float32, nb.float32, nb.float32),nopython=True)
-def topocentric_coords(latitude, longitude, elevation, terre_julian_date, mod_terre_julian_date, mod_uni_julian_date):
+def sun_ephemeris_array(years, months, days, hours):
+    """Ephemerides of a whole time axis.
+
+    Timestamps covered by the precomputed table, see
+    :func:`load_ephemeris_table`, are linearly interpolated from it. Any
+    other timestamp, and every timestamp while the table is not built, is
+    evaluated with :func:`sun_ephemeris`.
+
+    Parameters
+    ----------
+    years, months, days : array
+        Integer arrays with the date of each timestamp.
+
+    hours : array
+        Decimal UT hour of each timestamp.
+
+    Returns
+    -------
+    ephemerides : array
+        Array of shape (n_timestamps, 3) holding the sidereal time, right
+        ascension and declination of each timestamp, see :func:`sun_ephemeris`.
+    """
+    years, months = np.asarray(years), np.asarray(months)
+    days, hours = np.asarray(days), np.asarray(hours, dtype=np.float64)
+    table = load_ephemeris_table()
+    if table is None:
+        return _sun_ephemeris_array(years, months, days, hours)
+    positions = _table_positions(years, months, days, hours)
+    in_table = (positions >= 0) & (positions <= table.shape[0]-1)
+
+    ephemerides = np.empty((len(years), 3))
+    ephemerides[in_table] = _interpolate_ephemerides(table, positions[in_table])
+    if not in_table.all():
+        ephemerides[~in_table] = _sun_ephemeris_array(
+            years[~in_table], months[~in_table], days[~in_table], hours[~in_table]
+        )
+    return ephemerides
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _ephemeris_table(table, years, months, days):
+    for d in prange(len(years)):
+        for minute in range(1440):
+            hour = minute/60
+            sidereal_time, right_ascension, declination = sun_ephemeris(
+                years[d], months[d], days[d], hour
+            )
+            # The equation of time is the hour angle of the true sun at
+            # Greenwich minus the hour angle of the mean sun.
+            mean_hour_angle = 2*np.pi*hour/24 - np.pi
+            equation_of_time = _wrap_angle(sidereal_time - right_ascension - mean_hour_angle)
+
+            row = d*1440 + minute
+            table[row, 0] = declination
+            table[row, 1] = right_ascension
+            table[row, 2] = sidereal_time
+            table[row, 3] = equation_of_time
+
+
+def build_ephemeris_table(path=EPHEMERIS_TABLE):
+    """Precompute the sun declination, right ascension, apparent sidereal time
+    and equation of time (all in radians) at every minute from 1980 to 2030,
+    and store them as a float32 array of shape (n_minutes, 4) in a .npy file
+    that can be memory-mapped.
+
+    The table takes about 430 MB, so it is only built on request, by
+    scripts/00_warm_up.py.
+    """
+    print('Building ephemeris table. This can take a while.')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    n_days = (EPHEMERIS_TABLE_END - EPHEMERIS_TABLE_START).days
+    table = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n_days*1440, 4))
+
+    # One year at a time to keep memory bounded.
+    for year in range(EPHEMERIS_TABLE_START.year, EPHEMERIS_TABLE_END.year):
+        first = (date(year, 1, 1) - EPHEMERIS_TABLE_START).days
+        dates = [date(year, 1, 1) + timedelta(days=n) for n in range((date(year+1, 1, 1) - date(year, 1, 1)).days)]
+        years = np.array([d.year for d in dates])
+        months = np.array([d.month for d in dates])
+        days = np.array([d.day for d in dates])
+        _ephemeris_table(table[first*1440:(first+len(dates))*1440], years, months, days)
+    table.flush()
+    del table
+    load_ephemeris_table.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def load_ephemeris_table(path=EPHEMERIS_TABLE):
+    """Memory-mapped ephemeris table, see :func:`build_ephemeris_table`.
+
+    Returns
+    -------
+    table : np.memmap or None
+        Read-only array of shape (n_minutes, 4) with the declination, right
+        ascension, sidereal time and equation of time of every minute since
+        1980-01-01 0h UT, or None with a warning if it is not built yet.
+    """
+    if not path.exists():
+        warn(f'No ephemeris table at {path}, evaluating the ephemerides instead. '
+             'Run scripts/00_warm_up.py to build it.')
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+@nb.jit(_pixel_signatures(4), nopython=True, cache=True)
+def H_and_delta(longitude, sidereal_time, right_ascension, declination):
+    """Observer local hour angle and geocentric declination.
+    """
+    H = sidereal_time + longitude - right_ascension
+    return H, declination
+
+
+@nb.jit(_pixel_signatures(6), nopython=True, cache=True)
+def topocentric_coords(latitude, longitude, elevation, sidereal_time, right_ascension, declination):
     """TBA.
     """
     # Calculate observer local hour angle and geocentric declination
     H, delta = H_and_delta(
-        longitude, terre_julian_date, mod_terre_julian_date, mod_uni_julian_date
+        longitude, sidereal_time, right_ascension, declination
     )
 
     # Geographical ellipsoid reference coordinates
@@ -300,17 +513,21 @@ def topocentric_coords(latitude, longitude, elevation, terre_julian_date, mod_te
     return delta_, H_
 
 
-@nb.jit(nb.types.UniTuple(nb.float32,2)(nb.float32, nb.float32, nb.float32, nb.float32, nb.float32, nb.float32),nopython=True)
-def sun_topocentric_elevation_azimuth(latitude, longitude, elevation, terre_julian_date, mod_terre_julian_date, mod_uni_julian_date):
+@nb.jit(_pixel_signatures(6), nopython=True, cache=True)
+def sun_topocentric_elevation_azimuth(latitude, longitude, elevation, sidereal_time, right_ascension, declination):
     # Calculate topocentric declination and local hour angle
     delta_, H_ = topocentric_coords(
-        latitude, longitude, elevation, terre_julian_date, mod_terre_julian_date, mod_uni_julian_date
+        latitude, longitude, elevation, sidereal_time, right_ascension, declination
     )
 
-    # Calculate the topocentric elevation without atmospheric refraction correction
-    e0 = np.arcsin(
-        np.sin(latitude)*np.sin(delta_) + np.cos(latitude)*np.cos(delta_)*np.cos(H_)
+    # Calculate the topocentric elevation without atmospheric refraction correction,
+    # arctan2 keeps float32 accurate with the sun close to the zenith where arcsin does not
+    sin_e0 = np.sin(latitude)*np.sin(delta_) + np.cos(latitude)*np.cos(delta_)*np.cos(H_)
+    cos_e0 = np.sqrt(
+        (np.cos(latitude)*np.sin(delta_) - np.sin(latitude)*np.cos(delta_)*np.cos(H_))**2
+        + (np.cos(delta_)*np.sin(H_))**2
     )
+    e0 = np.arctan2(sin_e0, cos_e0)
 
     # Calculate topocentric elevation
     delta_e = refraction_correction(e0)
@@ -325,9 +542,26 @@ def sun_topocentric_elevation_azimuth(latitude, longitude, elevation, terre_juli
     return elevation, azimuth
 
 
-@nb.jit(nb.types.UniTuple(nb.float32,2)(nb.float32, nb.float32, nb.float32, nb.float32, nb.float32, nb.float32, nb.float32),nopython=True)
-def solar_position(latitude, longitude, elevation, year, month, day, hour):
-    """TBA.
+@nb.jit(_pixel_signatures(6), nopython=True, cache=True)
+def topocentric_elevation_azimuth(latitude, longitude, elevation, sidereal_time, right_ascension, declination):
+    """Per-pixel part of the solar position.
+
+    Only the topocentric parallax, hour angle and refraction correction are
+    evaluated here, the time-dependent terms come from :func:`sun_ephemeris`.
+
+    Parameters
+    ----------
+    latitude : float
+        Site latitude in radians.
+
+    longitude : float
+        Site longitude in radians.
+
+    elevation : float
+        Site altitude in meters.
+
+    sidereal_time, right_ascension, declination : float
+        Ephemeris of the timestamp as returned by :func:`sun_ephemeris`.
 
     Returns
     -------
@@ -335,19 +569,11 @@ def solar_position(latitude, longitude, elevation, year, month, day, hour):
         In radians.
 
     azimuth : float
-        In radians.
+        In radians, eastward from north.
     """
-    latitude = np.pi*latitude/180 # radians
-    longitude = np.pi*longitude/180 # radians
-
-    uni_julian_date = universal_julian_date(year, month, day, hour)
-    terre_julian_date = terrestrial_julian_date(year, month, day, hour)
-    mod_uni_julian_date = modified_universal_julian_date(uni_julian_date)
-    mod_terre_julian_date = modified_terrestrial_julian_date(terre_julian_date)
-
     elevation, azimuth = sun_topocentric_elevation_azimuth(
         latitude, longitude, elevation,
-        terre_julian_date, mod_terre_julian_date, mod_uni_julian_date
+        sidereal_time, right_ascension, declination
     )
 
     # change westward from south to eastward from north
@@ -357,6 +583,57 @@ def solar_position(latitude, longitude, elevation, year, month, day, hour):
     return elevation, azimuth
 
 
+@nb.jit(_pixel_signatures(7), nopython=True, cache=True)
+def solar_position(latitude, longitude, elevation, year, month, day, hour):
+    """Solar position of one site at one timestamp.
+
+    Evaluates the ephemeris of the timestamp with :func:`sun_ephemeris` and
+    the topocentric elevation and azimuth of the site from it with
+    :func:`topocentric_elevation_azimuth`.
+
+    The ephemeris table of :func:`sun_ephemeris_array` is not used: it is a
+    memory-mapped array loaded on the Python side, which this kernel, being
+    callable from other nopython kernels, cannot reach, and a single
+    timestamp costs one evaluation of the ephemeris either way. Callers with
+    many sites or timestamps should split the two stages, computing the
+    ephemerides of the time axis once with :func:`sun_ephemeris_array`.
+
+    Parameters
+    ----------
+    latitude : float
+        Site latitude in degrees.
+
+    longitude : float
+        Site longitude in degrees, positive east.
+
+    elevation : float
+        Site altitude in meters.
+
+    year, month, day : float
+        Date of the timestamp.
+
+    hour : float
+        Decimal UT hour.
+
+    Returns
+    -------
+    elevation : float
+        Sun elevation in radians, corrected for refraction.
+
+    azimuth : float
+        Sun azimuth in radians, eastward from north.
+    """
+    latitude = np.pi*latitude/180 # radians
+    longitude = np.pi*longitude/180 # radians
+
+    sidereal_time, right_ascension, declination = sun_ephemeris(year, month, day, hour)
+
+    return topocentric_elevation_azimuth(
+        latitude, longitude, elevation,
+        sidereal_time, right_ascension, declination
+    )
+
+
 
 # from datetime import datetime
 
@@ -1,14 +1,50 @@
 import os
+from contextlib import ExitStack
 from datetime import datetime, timedelta
+from functools import lru_cache
 from warnings import warn
 from itertools import product
+from pathlib import Path
 
 import numpy as np
 import rasterio as rio
+from rasterio.windows import Window
 
 from config import COUNTRIES
 
 
+def l2_cache_size(default=1024**2):
+    """Per-core L2 cache size in bytes.
+
+    Taken from the L2_CACHE_SIZE environment variable if it is set, or else
+    from the cache the kernel reports for the first CPU, or else `default`.
+    Sizes may end with K, M or G, as in /sys/devices/system/cpu.
+    """
+    size = os.environ.get('L2_CACHE_SIZE')
+    if size is None:
+        for index in sorted(Path('/sys/devices/system/cpu/cpu0/cache').glob('index*')):
+            try:
+                if (index / 'level').read_text().strip() == '2' and \
+                        (index / 'type').read_text().strip() != 'Instruction':
+                    size = (index / 'size').read_text()
+                    break
+            except OSError:
+                continue
+    if size is None:
+        return default
+    size = size.strip().upper()
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    if size[-1:] in units:
+        return int(size[:-1])*units[size[-1]]
+    return int(size)
+
+
+# Per-core L2 cache size the raster kernels size their tiles for (bytes). The
+# tile sizes are passed to the kernels as the defaults of their arguments,
+# which are part of the signatures they are cached on disk with.
+L2_CACHE_SIZE = l2_cache_size()
+
+
 def add_dist_to_latitude(lat, dist, radius=6378000):
     lat = np.radians(lat)
     lat_rad = lat - dist/radius
@@ -102,6 +138,38 @@ def hour_range(start, end):
     return [start + timedelta(hours=n) for n in range(0, n_hours)]
 
 
+def minute_range(start, end, minutes=15):
+    # Helper function for generating dates in a range with a frequency of given minutes.
+    start = datetime.strptime(start, '%Y-%m-%d')
+    end = datetime.strptime(end, '%Y-%m-%d')
+    n_steps = _timedelta_to_hours(end-start) * 60 // minutes
+    return [start + timedelta(minutes=n*minutes) for n in range(0, n_steps)]
+
+
+def timestamps_to_arrays(timestamps):
+    """Split datetimes into the year, month, day and decimal hour arrays used
+    by the solar position kernels.
+
+    Parameters
+    ----------
+    timestamps : list
+        List of UT datetimes.
+
+    Returns
+    -------
+    years, months, days : np.array
+        Integer arrays.
+
+    hours : np.array
+        Decimal UT hours.
+    """
+    years = np.array([t.year for t in timestamps], dtype=np.int64)
+    months = np.array([t.month for t in timestamps], dtype=np.int64)
+    days = np.array([t.day for t in timestamps], dtype=np.int64)
+    hours = np.array([t.hour + t.minute/60 + t.second/3600 for t in timestamps])
+    return years, months, days, hours
+
+
 def _timedelta_to_hours(td):
     hours = 0
     hours += td.days * 24
@@ -147,6 +215,75 @@ def month_to_string(month):
     return month
 
 
+def coordinate_axes(transform, height, width):
+    """Longitudes of the pixel columns and latitudes of the pixel rows of a
+    north-up raster.
+
+    On a regular EPSG:4326 grid the longitude depends only on the column and
+    the latitude only on the row, so two 1-D axes describe every pixel center.
+
+    Parameters
+    ----------
+    transform : Affine
+        The affine transform of the raster.
+
+    height : int
+        Number of rows.
+
+    width : int
+        Number of columns.
+
+    Returns
+    -------
+    lons : np.array
+        Longitude of each column center, shape (width,).
+
+    lats : np.array
+        Latitude of each row center, shape (height,).
+    """
+    lons = transform.c + transform.a * (np.arange(width) + 0.5)
+    lats = transform.f + transform.e * (np.arange(height) + 0.5)
+    return lons, lats
+
+
+@lru_cache(maxsize=None)
+def grid_index_maps(transform, height, width, grid_transform, grid_height, grid_width):
+    """Row and column of a coarser north-up grid that contain the pixel
+    centers of a raster.
+
+    Computed once per pair of grids and cached, since the transforms are
+    hashable. Pixels outside the coarse grid map to its nearest edge cell.
+
+    Parameters
+    ----------
+    transform : Affine
+        The affine transform of the raster.
+
+    height, width : int
+        Shape of the raster.
+
+    grid_transform : Affine
+        The affine transform of the coarse grid, e.g. CAMS or Meteosat.
+
+    grid_height, grid_width : int
+        Shape of the coarse grid.
+
+    Returns
+    -------
+    rows : np.array
+        Coarse grid row of each raster row, shape (height,).
+
+    cols : np.array
+        Coarse grid column of each raster column, shape (width,).
+    """
+    if transform.b or transform.d or grid_transform.b or grid_transform.d:
+        raise ValueError('Only north-up grids without rotation are supported.')
+    lons, lats = coordinate_axes(transform, height, width)
+    rows = np.floor((lats - grid_transform.f) / grid_transform.e).astype(np.int64)
+    cols = np.floor((lons - grid_transform.c) / grid_transform.a).astype(np.int64)
+    return np.clip(rows, 0, grid_height-1), np.clip(cols, 0, grid_width-1)
+
+
 def save_array_to_geotiff(array, path, meta):
     """TBA.
 
@@ -168,4 +305,169 @@ def save_array_to_geotiff(array, path, meta):
         **meta
     )
     raster.write(array.astype(np.float32), 1)
-    raster.close()
\ No newline at end of file
+    raster.close()
+
+
+def raster_windows(height, width, max_pixels, block_size=256):
+    """Windows covering a raster, aligned to `block_size` and holding at most
+    `max_pixels` pixels each (but at least one block).
+    """
+    side = max(block_size, int(np.sqrt(max_pixels)) // block_size * block_size)
+    for row in range(0, height, side):
+        for col in range(0, width, side):
+            yield Window(col, row, min(side, width-col), min(side, height-row))
+
+
+def cache_tile_size(bytes_per_pixel, cache_size=L2_CACHE_SIZE, min_size=16):
+    """Side of the largest power of two square tile whose per-pixel arrays
+    fill at most half of the cache, leaving the rest to the lookup tables and
+    coarse inputs a kernel reads alongside them.
+    """
+    side = min_size
+    while 4*side*side*bytes_per_pixel <= cache_size // 2:
+        side *= 2
+    return side
+
+
+def read_pixels(dataset, rows, cols, band=1):
+    """Values of a raster band at the pixels rows x cols, read one row at a
+    time so that memory stays proportional to the output.
+
+    Parameters
+    ----------
+    dataset : rasterio.DatasetReader
+        The open raster.
+
+    rows, cols : np.array
+        Sorted pixel rows and columns.
+
+    Returns
+    -------
+    values : np.array
+        Array of shape (len(rows), len(cols)).
+    """
+    values = np.empty((len(rows), len(cols)), dtype=dataset.dtypes[band-1])
+    col_off = int(cols[0])
+    window_width = int(cols[-1]) - col_off + 1
+    for i, row in enumerate(rows):
+        line = dataset.read(band, window=Window(col_off, int(row), window_width, 1))
+        values[i] = line[0, cols-col_off]
+    return values
+
+
+def read_window(dataset, window, halo=0, band=1):
+    """Values of a raster band inside a window padded by `halo` pixels on
+    every side, nodata where the padding falls outside the raster.
+    """
+    if not halo:
+        return dataset.read(band, window=window)
+    row0, col0 = window.row_off - halo, window.col_off - halo
+    row1, col1 = window.row_off + window.height + halo, window.col_off + window.width + halo
+    inside = Window.from_slices(
+        (max(row0, 0), min(row1, dataset.height)), (max(col0, 0), min(col1, dataset.width))
+    )
+    return np.pad(
+        dataset.read(band, window=inside),
+        ((max(-row0, 0), max(row1-dataset.height, 0)), (max(-col0, 0), max(col1-dataset.width, 0))),
+        constant_values=dataset.nodata
+    )
+
+
+def _window_side(max_bytes, bytes_per_pixel, padded_bytes_per_pixel, halo, block_size):
+    # Largest side, in whole blocks, of the windows that fit in `max_bytes`
+    # padded by the halo.
+    def window_bytes(side):
+        if padded_bytes_per_pixel is None:
+            return (side + 2*halo)**2*bytes_per_pixel
+        return side**2*bytes_per_pixel + (side + 2*halo)**2*padded_bytes_per_pixel
+
+    side = int(np.sqrt(max_bytes / bytes_per_pixel)) // block_size * block_size
+    while side >= block_size and window_bytes(side) > max_bytes:
+        side -= block_size
+    if side < block_size:
+        raise ValueError(
+            f'A window of {block_size} pixels with a halo of {halo} takes {window_bytes(block_size)} '
+            f'bytes, more than the {max_bytes} left to the windows.'
+        )
+    return side
+
+
+def map_raster_windows(func, dataset, path, max_memory=2*1024**3, bytes_per_pixel=16, block_size=256, band_names=None, halo=0, dtype=np.float32, padded_bytes_per_pixel=None):
+    """Apply a function to the first band of a raster window by window and
+    write the result to tiled, compressed GeoTIFFs, with bounded memory.
+
+    A quarter of `max_memory` goes to the GDAL block cache and the rest to
+    the windows, at `bytes_per_pixel` for the input, the outputs and the
+    temporaries of `func`. They are counted over the window padded by the
+    halo, unless `padded_bytes_per_pixel` gives the share of the padded
+    window apart from the rest.
+
+    Parameters
+    ----------
+    func : callable
+        Called as func(window, values) with a rasterio Window and the input
+        values inside it. Returns an array of the same shape, or of shape
+        (len(path), height, width) if `path` is a list. With `band_names`,
+        every output gets a band axis before height and width.
+
+    dataset : rasterio.DatasetReader
+        The input raster, which also gives the output grid.
+
+    path : Path or list of Path
+        The output GeoTIFF, or one per band returned by `func`.
+
+    max_memory : int
+        Peak memory budget in bytes.
+
+    band_names : list of str, optional
+        Descriptions of the bands of every output, which are then written
+        pixel-interleaved so that a tile holds all of them.
+
+    halo : int
+        Pixels of context around every window for stencils. The values passed
+        to `func` are then padded by `halo` on every side, with nodata beyond
+        the raster, while its result still covers the window.
+
+    dtype : type
+        Data type of the outputs, with nodata -32768. Integer outputs are
+        compressed with horizontal differencing.
+
+    padded_bytes_per_pixel : int, optional
+        Bytes per pixel of the padded window, for the input and the
+        temporaries of its size. `bytes_per_pixel` then only counts over the
+        window itself.
+
+    Raises
+    ------
+    ValueError
+        If not even a window of one block fits in the budget with its halo.
+    """
+    paths = path if isinstance(path, (list, tuple)) else [path]
+    count = 1 if band_names is None else len(band_names)
+    profile = dataset.profile.copy()
+    profile.update(
+        driver='GTiff',
+        count=count,
+        interleave='pixel',
+        dtype=dtype,
+        nodata=-32768,
+        tiled=True,
+        blockxsize=block_size,
+        blockysize=block_size,
+        compress='lzw',
+        predictor=2 if np.issubdtype(dtype, np.integer) else 1,
+        BIGTIFF='IF_SAFER'
+    )
+    max_pixels = _window_side(
+        3*max_memory // 4, bytes_per_pixel, padded_bytes_per_pixel, halo, block_size
+    )**2
+    with rio.Env(GDAL_CACHEMAX=max(1, max_memory // 4 // 2**20)), ExitStack() as stack:
+        outputs = [stack.enter_context(rio.open(p, 'w', **profile)) for p in paths]
+        for output in outputs:
+            for band, name in enumerate(band_names or []):
+                output.set_band_description(band+1, name)
+        for window in raster_windows(dataset.height, dataset.width, max_pixels, block_size):
+            values = func(window, read_window(dataset, window, halo))
+            values = values.reshape((len(paths), count) + values.shape[-2:])
+            for output, bands in zip(outputs, values):
+                output.write(bands.astype(dtype), window=window)
@@ -0,0 +1,366 @@
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+
+from src.feature_engineering import clear_sky_components, component_bands, COMPONENTS, dem_spans,\
+    lattice_indices, clear_sky_irradiance, clear_sky_aggregates_windows, aggregate_groups, AGGREGATES,\
+    clear_sky_irradiance_sums, clear_sky_orientation_sweep, ORIENTATION_BANDS, clear_sky_irradiance_windows,\
+    clear_sky_uncertainty_windows, clear_sky_orientation_windows, clear_sky_uncertainty, solar_geometry,\
+    input_samples, INPUT_UNCERTAINTY, UNCERTAINTY_QUANTILES
+from src.feature_engineering._clear_sky import atmospheric_air_mass, rayleigh_transmittance,\
+    mixed_gas_transmittance, ozone_transmittance, water_vapor_transmittance, _lookup_atm_air_mass,\
+    _lookup_gas_transmittances, _lookup_ozone_transmittance, _lookup_water_vapor_transmittance, LUT_MIN_ALTITUDE,\
+    LUT_MAX_ALTITUDE, LUT_MIN_AIR_MASS, LUT_MAX_AIR_MASS, LUT_MAX_ERROR, LUT_MAX_OZONE_PATH, LUT_MAX_WATER_PATH
+from src.feature_engineering._warm_up import _warm_up_clear_sky_kernels
+
+
+def _components(svfs=None, aoi=0.3, albedo=0.2, **kwargs):
+    # All components of a small DEM under a fixed sun, with partly cloudy skies.
+    rng = np.random.default_rng(0)
+    dem = rng.integers(100, 900, (40, 50)).astype(np.int16)
+    dem[:, :3] = -32768
+    rows, cols = lattice_indices(dem.shape[0], 16), lattice_indices(dem.shape[1], 16)
+    elevs = np.full((len(rows), len(cols)), 0.8)
+    aois = np.full(elevs.shape, aoi)
+    cams = np.full((1, 1), 0.3)
+    surface = np.full((1, 1), albedo, dtype=np.float32)
+    clouds = np.full((1, 1), 0.25, dtype=np.float32)
+    grid_rows = np.zeros(dem.shape[0], dtype=np.int64)
+    grid_cols = np.zeros(dem.shape[1], dtype=np.int64)
+    irradiance = np.empty((len(COMPONENTS),) + dem.shape)
+    if svfs is not None:
+        kwargs['svfs'] = svfs
+    clear_sky_components(
+        elevs, aois, rows, cols, dem, dem_spans(dem), cams*0.02, cams*100, cams, surface, clouds,
+        grid_rows, grid_cols, grid_rows, grid_cols, 2014, 6, 21, component_bands(COMPONENTS),
+        irradiance, **kwargs
+    )
+    return dict(zip(COMPONENTS, irradiance)), dem != -32768
+
+
+def test_components_add_up_with_sky_view_factor():
+    svfs = np.random.default_rng(1).uniform(0.5, 0.95, (40, 50)).astype(np.float32)
+    components, valid = _components(svfs, aoi=0.3)
+    poa = components['dni']*np.cos(0.3) + components['dhi'] + components['reflected']
+    assert np.allclose(components['poa'][valid], poa[valid], rtol=1e-12)
+
+
+def test_sky_view_factor_is_applied_before_reflection():
+    svfs = np.random.default_rng(1).uniform(0.5, 0.95, (40, 50)).astype(np.float32)
+    open_sky, valid = _components()
+    components, _ = _components(svfs)
+    assert np.allclose(components['dni'][valid], open_sky['dni'][valid], rtol=1e-12)
+    assert np.allclose(components['dhi'][valid], (svfs*open_sky['dhi'])[valid], rtol=1e-12)
+    assert np.allclose(components['ghi'][valid], (components['dni']*np.sin(0.8) + components['dhi'])[valid])
+
+    # The ground reflects the global irradiance the terrain leaves.
+    view_factor = 1 - svfs*(1 + np.cos(0.10471975511965978))/2
+    assert np.allclose(components['reflected'][valid], (components['ghi']*0.2*view_factor)[valid], rtol=1e-6)
+
+
+def test_components_do_not_depend_on_tile_size():
+    components, _ = _components()
+    for tile_size in (7, 16, 1024):
+        tiled, _ = _components(tile_size=tile_size)
+        for name in COMPONENTS:
+            assert np.array_equal(tiled[name], components[name])
+
+
+def test_aggregate_groups():
+    groups = aggregate_groups(np.arange(1, 13))
+    names = [[AGGREGATES[g] for g in group] for group in groups]
+    seasons = ['DJF']*2 + ['MAM']*3 + ['JJA']*3 + ['SON']*3 + ['DJF']
+    assert names == [[f'{month:02d}', season, 'year'] for month, season in zip(range(1, 13), seasons)]
+
+
+def test_aggregates_windows_match_in_memory_means(tmp_path):
+    # Two June timesteps on a DEM of several windows, and no January.
+    rng = np.random.default_rng(0)
+    dem = rng.integers(100, 900, (300, 400)).astype(np.int16)
+    dem[:, :7] = -32768
+    profile = {
+        'driver': 'GTiff', 'height': dem.shape[0], 'width': dem.shape[1], 'count': 1, 'dtype': 'int16',
+        'nodata': -32768, 'crs': 'EPSG:4326', 'transform': from_origin(3, 10, 1/3600, 1/3600)
+    }
+    with rio.open(tmp_path / 'dem.tif', 'w', **profile) as dataset:
+        dataset.write(dem, 1)
+
+    rows, cols = lattice_indices(dem.shape[0], 64), lattice_indices(dem.shape[1], 64)
+    elevs = np.stack([np.full((len(rows), len(cols)), elevation) for elevation in (0.4, 0.9)])
+    aois = np.stack([np.full(elevs.shape[1:], aoi) for aoi in (0.6, 0.2)])
+    ozs, wvs, aods = np.full((2, 1, 1), 0.006), np.full((2, 1, 1), 30.0), np.full((2, 1, 1), 0.3)
+    albedos, clouds = np.full((2, 1, 1), 0.2, dtype=np.float32), np.full((2, 1, 1), 0.25, dtype=np.float32)
+    grid_rows = np.zeros(dem.shape[0], dtype=np.int64)
+    grid_cols = np.zeros(dem.shape[1], dtype=np.int64)
+    years, months, days = np.array([2014, 2014]), np.array([6, 6]), np.array([10, 21])
+    spans = dem_spans(dem)
+
+    paths = [tmp_path / f'{name}.tif' for name in AGGREGATES]
+    with rio.open(tmp_path / 'dem.tif') as elevation:
+        clear_sky_aggregates_windows(
+            elevation, paths, elevs, aois, rows, cols, ozs, wvs, aods, albedos, clouds,
+            grid_rows, grid_cols, grid_rows, grid_cols, years, months, days, max_memory=40*2**20, spans=spans
+        )
+
+    irradiance = [
+        clear_sky_irradiance(
+            elevs[t], aois[t], rows, cols, dem, spans, ozs[t], wvs[t], aods[t], albedos[t], clouds[t],
+            grid_rows, grid_cols, grid_rows, grid_cols, years[t], months[t], days[t]
+        )
+        for t in range(2)
+    ]
+    valid = dem != -32768
+    expected = (irradiance[0] + irradiance[1])/2
+    for name, path in zip(AGGREGATES, paths):
+        with rio.open(path) as dataset:
+            means = dataset.read(1)
+        assert (means[~valid] == -32768).all()
+        if name in ('06', 'JJA', 'year'):
+            assert np.allclose(means[valid], expected[valid], rtol=1e-6)
+        else:
+            assert (means == -32768).all()
+
+
+def test_orientation_reference_matches_sums_on_the_terrain():
+    # Two timesteps on terrain that hides part of the sky: the reference of
+    # the sweep is the terrain plane, whose mean is that of the sums.
+    rng = np.random.default_rng(2)
+    dem = rng.integers(100, 900, (40, 50)).astype(np.int16)
+    dem[:, :3] = -32768
+    rows, cols = lattice_indices(dem.shape[0], 16), lattice_indices(dem.shape[1], 16)
+    elevs = np.stack([np.full((len(rows), len(cols)), elevation) for elevation in (0.4, 0.9)])
+    azis = np.stack([np.full(elevs.shape[1:], azimuth) for azimuth in (1.5, 3.5)])
+    ozs, wvs, aods = np.full((2, 1, 1), 0.006), np.full((2, 1, 1), 30.0), np.full((2, 1, 1), 0.3)
+    albedos, clouds = np.full((2, 1, 1), 0.2, dtype=np.float32), np.full((2, 1, 1), 0.25, dtype=np.float32)
+    grid_rows = np.zeros(dem.shape[0], dtype=np.int64)
+    grid_cols = np.zeros(dem.shape[1], dtype=np.int64)
+    years, months, days = np.array([2014, 2014]), np.array([6, 6]), np.array([10, 21])
+    slopes = rng.uniform(0, 0.5, dem.shape).astype(np.float32)
+    aspects = rng.uniform(0, 2*np.pi, dem.shape).astype(np.float32)
+    svfs = rng.uniform(0.5, 0.95, dem.shape).astype(np.float32)
+    args = (
+        dem, dem_spans(dem), ozs, wvs, aods, albedos, clouds, grid_rows, grid_cols,
+        grid_rows, grid_cols, years, months, days
+    )
+
+    sums = np.zeros((len(AGGREGATES),) + dem.shape)
+    counts = np.zeros((len(AGGREGATES),) + dem.shape, dtype=np.int32)
+    clear_sky_irradiance_sums(
+        elevs, np.zeros(elevs.shape), rows, cols, *args, aggregate_groups(months), sums, counts,
+        azis, slopes, aspects, svfs
+    )
+    out = np.empty((len(ORIENTATION_BANDS),) + dem.shape)
+    clear_sky_orientation_sweep(
+        elevs, azis, rows, cols, *args, np.radians(np.arange(0, 31, 10)), np.radians(np.arange(90, 271, 45)),
+        out, slopes=slopes, aspects=aspects, svfs=svfs
+    )
+    valid = dem != -32768
+    year = AGGREGATES.index('year')
+    reference = out[2]/(1 + out[3])
+    assert np.allclose(reference[valid], sums[year][valid]/counts[year][valid], rtol=1e-6)
+
+
+def test_warm_up_compiles_the_windowed_signatures(tmp_path):
+    # The windowed drivers, called as the clear sky script calls them, find
+    # every kernel signature they need among those of the warm-up.
+    _warm_up_clear_sky_kernels()
+    kernels = [clear_sky_components, clear_sky_irradiance_sums, clear_sky_uncertainty, clear_sky_orientation_sweep]
+    compiled = [len(kernel.signatures) for kernel in kernels]
+
+    dem = np.random.default_rng(0).integers(100, 900, (40, 50)).astype(np.int16)
+    profile = {
+        'driver': 'GTiff', 'height': dem.shape[0], 'width': dem.shape[1], 'count': 1, 'dtype': 'int16',
+        'nodata': -32768, 'crs': 'EPSG:4326', 'transform': from_origin(3, 10, 1/3600, 1/3600)
+    }
+    with rio.open(tmp_path / 'dem.tif', 'w', **profile) as dataset:
+        dataset.write(dem, 1)
+    for name, value in [('slope', 0.1), ('aspect', 3.0), ('sky_view', 0.9)]:
+        with rio.open(tmp_path / f'{name}.tif', 'w', **{**profile, 'dtype': 'float32'}) as dataset:
+            dataset.write(np.full(dem.shape, value, dtype=np.float32), 1)
+
+    rows, cols = lattice_indices(dem.shape[0], 16), lattice_indices(dem.shape[1], 16)
+    years, months, days = np.full(2, 2014), np.array([6, 6]), np.array([21, 21])
+    lons, lats = np.linspace(3.0, 3.01, dem.shape[1]), np.linspace(10.0, 9.99, dem.shape[0])
+    elevs, azis, aois = solar_geometry(years, months, days, np.array([9.0, 12.0]), lons, lats, dem, rows, cols)
+    ozs, wvs, aods = np.full((2, 1, 1), 0.006), np.full((2, 1, 1), 30.0), np.full((2, 1, 1), 0.3)
+    albedos, clouds = np.full((2, 1, 1), 0.2, dtype=np.float32), np.full((2, 1, 1), 0.25, dtype=np.float32)
+    grid_rows = np.zeros(dem.shape[0], dtype=np.int64)
+    grid_cols = np.zeros(dem.shape[1], dtype=np.int64)
+    grids = (grid_rows, grid_cols, grid_rows, grid_cols)
+    spans = dem_spans(dem)
+
+    with rio.open(tmp_path / 'dem.tif') as elevation, rio.open(tmp_path / 'slope.tif') as slope,\
+            rio.open(tmp_path / 'aspect.tif') as aspect, rio.open(tmp_path / 'sky_view.tif') as sky_view:
+        for terrain, view in [(None, None), (slope, None), (None, sky_view), (slope, sky_view)]:
+            terrain_rasters = {'slope': terrain, 'aspect': aspect if terrain else None}
+            clear_sky_irradiance_windows(
+                elevation, tmp_path / 'irradiance.tif', elevs[0], aois[0], rows, cols, ozs[0], wvs[0],
+                aods[0], albedos[0], clouds[0], *grids, 2014, months[0], days[0], spans=spans,
+                components=('poa', 'ghi'), azis=azis[0], sky_view=view, **terrain_rasters
+            )
+            clear_sky_uncertainty_windows(
+                elevation, tmp_path / 'uncertainty.tif', elevs[0], aois[0], rows, cols, ozs[0], wvs[0],
+                aods[0], albedos[0], clouds[0], *grids, 2014, months[0], days[0], n_samples=4, spans=spans,
+                azis=azis[0], sky_view=view, **terrain_rasters
+            )
+            clear_sky_aggregates_windows(
+                elevation, [tmp_path / f'{name}.tif' for name in AGGREGATES], elevs, aois, rows, cols, ozs,
+                wvs, aods, albedos, clouds, *grids, years, months, days, spans=spans, azis=azis,
+                sky_view=view, **terrain_rasters
+            )
+            clear_sky_orientation_windows(
+                elevation, tmp_path / 'orientation.tif', elevs, azis, rows, cols, ozs, wvs, aods, albedos,
+                clouds, *grids, years, months, days, [0.0, 0.2], [np.pi], spans=spans, sky_view=view,
+                **terrain_rasters
+            )
+
+    assert [len(kernel.signatures) for kernel in kernels] == compiled
+
+
+def _uncertainty(**uncertainty):
+    # Mean and quantiles of the plane of array irradiance of the DEM of
+    # _components, with only the given inputs perturbed.
+    rng = np.random.default_rng(0)
+    dem = rng.integers(100, 900, (40, 50)).astype(np.int16)
+    dem[:, :3] = -32768
+    rows, cols = lattice_indices(dem.shape[0], 16), lattice_indices(dem.shape[1], 16)
+    elevs = np.full((len(rows), len(cols)), 0.8)
+    aois = np.full(elevs.shape, 0.3)
+    cams = np.full((1, 1), 0.3)
+    samples = input_samples(
+        cams*0.02, cams*100, cams, np.full((1, 1), 0.2, dtype=np.float32), 64,
+        {**dict.fromkeys(INPUT_UNCERTAINTY, 0.0), **uncertainty}, seed=0
+    )
+    grid_rows = np.zeros(dem.shape[0], dtype=np.int64)
+    grid_cols = np.zeros(dem.shape[1], dtype=np.int64)
+    out = np.empty((1 + len(UNCERTAINTY_QUANTILES),) + dem.shape)
+    clear_sky_uncertainty(
+        elevs, aois, rows, cols, dem, dem_spans(dem), *samples, np.full((1, 1), 0.25, dtype=np.float32),
+        grid_rows, grid_cols, grid_rows, grid_cols, 2014, 6, 21, np.array(UNCERTAINTY_QUANTILES), out
+    )
+    return out, dem != -32768
+
+
+def test_uncertainty_without_perturbation_has_no_spread():
+    out, valid = _uncertainty()
+    assert (out[:, valid] > 0).all()
+    for band in out[1:]:
+        assert np.allclose(band[valid], out[0][valid], rtol=1e-9)
+
+
+def test_uncertainty_spread_grows_with_the_input_error():
+    for name in ('aod', 'wv'):
+        spreads = list()
+        for sigma in (0.05, 0.2, 0.5):
+            out, valid = _uncertainty(**{name: sigma})
+            spreads.append(np.mean((out[-1] - out[1])[valid]))
+        assert 0 < spreads[0] < spreads[1] < spreads[2]
+
+
+def test_uncertainty_keeps_nodata():
+    out, valid = _uncertainty(aod=0.3, wv=0.1)
+    assert (out[:, ~valid] == -32768).all()
+    assert (out[:, valid] != -32768).all()
+
+
+def test_pressure_factors_are_exact():
+    for altitude in range(LUT_MIN_ALTITUDE, LUT_MAX_ALTITUDE + 1, 7):
+        for geo_air_mass in (1.0, 2.7, 38.0):
+            expected = atmospheric_air_mass(geo_air_mass, float(altitude))
+            assert np.isclose(_lookup_atm_air_mass(geo_air_mass, float(altitude)), expected, rtol=1e-14, atol=0)
+
+
+def test_gas_tables_match_the_formulas():
+    # Within LUT_MAX_ERROR anywhere on the air mass axis, and exact past it.
+    atm_air_masses = np.concatenate([
+        np.random.default_rng(0).uniform(LUT_MIN_AIR_MASS, LUT_MAX_AIR_MASS, 20000),
+        np.linspace(LUT_MIN_AIR_MASS, LUT_MAX_AIR_MASS, 1001)[:-1]
+    ])
+    for atm_air_mass in atm_air_masses:
+        Tr, Tg = _lookup_gas_transmittances(atm_air_mass)
+        assert abs(Tr - rayleigh_transmittance(atm_air_mass)) <= LUT_MAX_ERROR
+        assert abs(Tg - mixed_gas_transmittance(atm_air_mass)) <= LUT_MAX_ERROR
+    for atm_air_mass in (0.5, LUT_MAX_AIR_MASS + 1, 60.0):
+        assert _lookup_gas_transmittances(atm_air_mass) == (
+            rayleigh_transmittance(atm_air_mass), mixed_gas_transmittance(atm_air_mass)
+        )
+
+
+def test_column_tables_match_the_formulas():
+    # Within LUT_MAX_ERROR up to the longest tabulated path, the column
+    # amount times the air mass over 10, and exact well past it.
+    rng = np.random.default_rng(0)
+    for lookup, transmittance, max_path in (
+        (_lookup_ozone_transmittance, ozone_transmittance, LUT_MAX_OZONE_PATH),
+        (_lookup_water_vapor_transmittance, water_vapor_transmittance, LUT_MAX_WATER_PATH)
+    ):
+        paths = np.concatenate([rng.uniform(0, max_path, 20000), np.linspace(0, max_path, 1001)[:-1]])
+        geo_air_masses = rng.uniform(1, 40, len(paths))
+        for path, geo_air_mass in zip(paths, geo_air_masses):
+            column = 10*path/geo_air_mass
+            assert abs(lookup(column, geo_air_mass) - transmittance(column, geo_air_mass)) <= LUT_MAX_ERROR
+        for path in (4*max_path, 10*max_path):
+            assert lookup(10*path/2, 2.0) == transmittance(10*path/2, 2.0)
+
+
+def test_irradiance_windows_match_in_memory_components(tmp_path):
+    # A DEM of several windows of one block, coarse inputs that vary across
+    # them and a lattice whose cells straddle their edges, on open ground
+    # and on the terrain.
+    rng = np.random.default_rng(0)
+    dem = rng.integers(100, 900, (600, 560)).astype(np.int16)
+    dem[:, :7] = -32768
+    dem[300:310] = -32768
+    profile = {
+        'driver': 'GTiff', 'height': dem.shape[0], 'width': dem.shape[1], 'count': 1, 'dtype': 'int16',
+        'nodata': -32768, 'crs': 'EPSG:4326', 'transform': from_origin(3, 10, 1/3600, 1/3600)
+    }
+    with rio.open(tmp_path / 'dem.tif', 'w', **profile) as dataset:
+        dataset.write(dem, 1)
+    terrain = {
+        'slope': rng.uniform(0, 0.5, dem.shape).astype(np.float32),
+        'aspect': rng.uniform(0, 2*np.pi, dem.shape).astype(np.float32),
+        'sky_view': rng.uniform(0.6, 1, dem.shape).astype(np.float32)
+    }
+    for name, values in terrain.items():
+        with rio.open(tmp_path / f'{name}.tif', 'w', **{**profile, 'dtype': 'float32'}) as dataset:
+            dataset.write(values, 1)
+
+    rows, cols = lattice_indices(dem.shape[0], 100), lattice_indices(dem.shape[1], 100)
+    lons, lats = np.linspace(3.0, 3.16, dem.shape[1]), np.linspace(10.0, 9.83, dem.shape[0])
+    elevs, azis, aois = (
+        angles[0] for angles in solar_geometry(
+            np.array([2014]), np.array([6]), np.array([21]), np.array([9.5]), lons, lats, dem, rows, cols
+        )
+    )
+    ozs, wvs, aods = rng.uniform(0.005, 0.008, (3, 3)), rng.uniform(10, 50, (3, 3)), rng.uniform(0.1, 0.8, (3, 3))
+    albedos = rng.uniform(0.1, 0.3, (4, 5)).astype(np.float32)
+    clouds = rng.uniform(0, 0.5, (4, 5)).astype(np.float32)
+    cams_rows, cams_cols = np.arange(dem.shape[0])*3 // dem.shape[0], np.arange(dem.shape[1])*3 // dem.shape[1]
+    meteosat_rows = np.arange(dem.shape[0])*4 // dem.shape[0]
+    meteosat_cols = np.arange(dem.shape[1])*5 // dem.shape[1]
+    grids = (cams_rows, cams_cols, meteosat_rows, meteosat_cols)
+    spans = dem_spans(dem)
+    valid = dem != -32768
+
+    for on_terrain in (False, True):
+        expected = np.empty((len(COMPONENTS),) + dem.shape)
+        clear_sky_components(
+            elevs, aois, rows, cols, dem, spans, ozs, wvs, aods, albedos, clouds, *grids, 2014, 6, 21,
+            component_bands(COMPONENTS), expected,
+            *((azis, terrain['slope'], terrain['aspect']) if on_terrain else ()),
+            **({'svfs': terrain['sky_view']} if on_terrain else {})
+        )
+        with rio.open(tmp_path / 'dem.tif') as elevation, rio.open(tmp_path / 'slope.tif') as slope,\
+                rio.open(tmp_path / 'aspect.tif') as aspect, rio.open(tmp_path / 'sky_view.tif') as sky_view:
+            rasters = {'azis': azis, 'slope': slope, 'aspect': aspect, 'sky_view': sky_view} if on_terrain else {}
+            clear_sky_irradiance_windows(
+                elevation, tmp_path / 'irradiance.tif', elevs, aois, rows, cols, ozs, wvs, aods, albedos, clouds,
+                *grids, 2014, 6, 21, max_memory=8*2**20, spans=spans, components=COMPONENTS, **rasters
+            )
+        with rio.open(tmp_path / 'irradiance.tif') as dataset:
+            assert list(dataset.descriptions) == COMPONENTS
+            assert dataset.block_shapes[0] == (256, 256)
+            irradiance = dataset.read()
+        assert (irradiance[:, ~valid] == -32768).all()
+        assert np.allclose(irradiance[:, valid], expected[:, valid], rtol=1e-6, atol=1e-4)
@@ -0,0 +1,495 @@
+from pathlib import Path
+
+import numpy as np
+import rasterio as rio
+from numba import njit
+from rasterio.transform import Affine
+
+from src.feature_engineering import shadow_mask, shadow_mask_windows, calc_shadow_mask, dem_spans,\
+    max_pyramid, max_pyramid_rasters, slope_aspect_rasters, horizon_rasters, sky_view_factor_raster,\
+    slope_aspect, slope_aspect_windows
+from src.utils import coordinate_axes
+from src.feature_engineering._elevation import get_line, _read_pyramid, _sweep_direction, _line_offset,\
+    _line_point, _line_altitude, horizon_angles, horizon_shadow_mask, HORIZON_MIN_ELEVATION, HORIZON_SCALE,\
+    sky_view_factor
+
+
+def _dem():
+    # Rough terrain with a strip without data.
+    dem = np.random.default_rng(0).integers(100, 900, (60, 70)).astype(np.int16)
+    dem[:, :5] = -32768
+    return dem
+
+
+def _terrain():
+    # Hills with noise, a tall block, a pit below sea level and a strip
+    # without data, for rays of all lengths that also leave the DEM.
+    rng = np.random.default_rng(1)
+    x, y = np.ogrid[:90, :120]
+    dem = 300 + 200*np.sin(x/11)*np.cos(y/17) + rng.integers(0, 25, (90, 120))
+    dem[30:40, 50:62] += 400
+    dem[60:66, 20:30] = -40
+    dem = dem.astype(np.int16)
+    dem[:, 100:104] = -32768
+    return dem
+
+
+def _ridges():
+    # Smooth steep ridges with a strip without data.
+    x, y = np.ogrid[:128, :128]
+    dem = (400 + 250*np.sin(x/37)*np.cos(y/53) + 150*np.cos((x + 2*y)/29)).astype(np.int16)
+    dem[:, 100:104] = -32768
+    return dem
+
+
+@njit
+def _ray_marched_shadow_mask(dem, elevation, azimuth):
+    # A ray marched toward the sun from the centre of every pixel with data,
+    # a quarter of a pixel at a time, over the terrain interpolated
+    # bilinearly between the pixels with data.
+    n_rows, n_cols = dem.shape
+    d_row, d_col = -np.cos(azimuth), np.sin(azimuth)
+    rise = 30*np.tan(elevation)
+    highest = dem.max()
+    shadows = np.zeros(dem.shape, dtype=np.bool_)
+    for x in range(n_rows):
+        for y in range(n_cols):
+            if dem[x, y] == -32768:
+                continue
+            s = 0.25
+            while not shadows[x, y]:
+                row, col, height = x + s*d_row, y + s*d_col, dem[x, y] + rise*s
+                if not (0 <= row <= n_rows-1 and 0 <= col <= n_cols-1) or height > highest:
+                    break
+                r, c = min(int(row), n_rows-2), min(int(col), n_cols-2)
+                u, v = row - r, col - c
+                cell = dem[r:r+2, c:c+2]
+                if (cell != -32768).all():
+                    terrain = (1-u)*((1-v)*cell[0, 0] + v*cell[0, 1]) + u*((1-v)*cell[1, 0] + v*cell[1, 1])
+                    shadows[x, y] = terrain >= height
+                s += 0.25
+    return shadows
+
+
+@njit
+def _line_list_cast(dem, shadows, x, y, altitude, elevation, azimuth):
+    # The ray caster the shadow kernels started from, which builds the line
+    # of get_line up to the end of the shadow and walks it.
+    n_rows, n_cols = dem.shape
+    shadow_dist = altitude / np.tan(elevation)
+    if 0 <= azimuth < np.pi/2:
+        x_end = x + int(np.floor(shadow_dist * np.cos(azimuth) / 30))
+        y_end = y - int(np.floor(shadow_dist * np.sin(azimuth) / 30))
+    elif np.pi/2 <= azimuth < np.pi:
+        x_end = x - int(np.floor(shadow_dist * np.sin(azimuth-np.pi/2) / 30))
+        y_end = y - int(np.floor(shadow_dist * np.cos(azimuth-np.pi/2) / 30))
+    elif np.pi <= azimuth < 3*np.pi/2:
+        x_end = x - int(np.floor(shadow_dist * np.cos(azimuth-np.pi) / 30))
+        y_end = y + int(np.floor(shadow_dist * np.sin(azimuth-np.pi) / 30))
+    else:
+        x_end = x + int(np.floor(shadow_dist * np.sin(azimuth-(3*np.pi/2)) / 30))
+        y_end = y + int(np.floor(shadow_dist * np.cos(azimuth-(3*np.pi/2)) / 30))
+    x_end = min(max(x_end, 0), n_rows-1)
+    y_end = min(max(y_end, 0), n_cols-1)
+    for square in get_line((x, y), (x_end, y_end))[1:]:
+        dist = np.sqrt((x-square[0])**2 + (y-square[1])**2)
+        if dem[square] <= altitude - 30 * dist * np.tan(elevation):
+            shadows[square] = 1
+        else:
+            break
+
+
+@njit
+def _line_list_shadow_mask(elevation, azimuth, dem):
+    shadows = np.zeros(dem.shape, dtype=np.bool_)
+    for x in range(dem.shape[0]):
+        for y in range(dem.shape[1]):
+            if dem[x, y] != -32768:
+                _line_list_cast(dem, shadows, x, y, dem[x, y], elevation, azimuth)
+    return shadows
+
+
+@njit
+def _walked_shadow_mask(dem, valid, elevation, azimuth):
+    # A ray cast from the point of every valid pixel on its sweep line,
+    # walked point by point to the edge of the DEM, marking the valid pixels
+    # of the points below it until it meets one above it.
+    major, step, slope, step_length = _sweep_direction(azimuth)
+    drop = 30*np.tan(elevation)*step_length
+    rate = slope*step
+    n_major, n_minor = dem.shape[major], dem.shape[1-major]
+    shadows = np.zeros(dem.shape, dtype=np.bool_)
+    for x in range(dem.shape[0]):
+        for y in range(dem.shape[1]):
+            if not valid[x, y]:
+                continue
+            a, b = (x, y) if major == 0 else (y, x)
+            c = b - _line_offset(rate, a)
+            offset, weight = _line_point(rate, a)
+            height = _line_altitude(dem, valid, major, a, c + offset, weight, n_minor) + drop*(step*a)
+            a += step
+            while 0 <= a < n_major:
+                b = c + _line_offset(rate, a)
+                if not 0 <= b < n_minor:
+                    break
+                square = (a, b) if major == 0 else (b, a)
+                if valid[square]:
+                    offset, weight = _line_point(rate, a)
+                    if _line_altitude(dem, valid, major, a, c + offset, weight, n_minor) + drop*(step*a) > height:
+                        break
+                    shadows[square] = True
+                a += step
+    return shadows
+
+
+def _walked_calc_shadow_mask(dem, elevs, azis):
+    # The walked rays of every block of the sun grid, on its pixels.
+    valid = dem != -32768
+    stepsize = max(int(np.round(dem.shape[0] / elevs.shape[0])), 1)
+    shadows = np.zeros(dem.shape, dtype=np.bool_)
+    for i in range(elevs.shape[0]):
+        for j in range(elevs.shape[1]):
+            rows = slice(i*stepsize, None if i == elevs.shape[0]-1 else (i+1)*stepsize)
+            cols = slice(j*stepsize, None if j == elevs.shape[1]-1 else (j+1)*stepsize)
+            if elevs[i, j] <= 0:
+                shadows[rows, cols] = valid[rows, cols]
+            else:
+                shadows[rows, cols] = _walked_shadow_mask(dem, valid, elevs[i, j], azis[i, j])[rows, cols]
+    return shadows
+
+
+def test_calc_shadow_mask_matches_walked_rays():
+    dem = _terrain()
+    spans = dem_spans(dem)
+    azimuth_grids = [np.full((3, 4), np.radians(azimuth)) for azimuth in (0, 45, 90, 160, 180, 225, 290, 359.9)]
+    azimuth_grids.append(np.random.default_rng(2).uniform(0, 2*np.pi, (3, 4)))
+    pyramid = max_pyramid(dem, 4)
+    for elevation in (0.05, 0.15, 0.4, 1.2):
+        for azis in azimuth_grids:
+            elevs = np.full(azis.shape, elevation)
+            elevs[0, 0] = -0.1
+            walked = _walked_calc_shadow_mask(dem, elevs, azis)
+            # Tiles along the sweep once the groups of lines run out, and
+            # halos entered past the cells of the pyramid.
+            for n_tiles in (1, 64):
+                assert np.array_equal(calc_shadow_mask(dem, spans, elevs, azis, n_tiles), walked)
+                assert np.array_equal(calc_shadow_mask(dem, spans, elevs, azis, n_tiles, pyramid), walked)
+
+
+def test_calc_shadow_mask_matches_line_lists_along_axes():
+    # The Bresenham lines of every ray follow the rows and columns, and end
+    # where the ray meets sea level.
+    dem = _terrain()
+    dem[dem < 0] = 0
+    valid = dem != -32768
+    spans = dem_spans(dem)
+    for elevation in (0.05, 0.15, 0.4):
+        for azimuth in (0.0, 0.5*np.pi, np.pi, 1.5*np.pi):
+            elevs, azis = np.full((1, 1), elevation), np.full((1, 1), azimuth)
+            shadows = calc_shadow_mask(dem, spans, elevs, azis)
+            assert shadows[valid].any()
+            assert np.array_equal(shadows[valid], _line_list_shadow_mask(elevation, azimuth, dem)[valid])
+
+
+def test_calc_shadow_mask_matches_ray_march_at_oblique_azimuths():
+    # The lines follow the sun, so on smooth terrain only the edges of the
+    # shadows, where the sweep samples the terrain a pixel at a time, differ
+    # from a fine ray march.
+    dem = _ridges()
+    valid = dem != -32768
+    spans = dem_spans(dem)
+    for elevation in (0.1, 0.2):
+        for azimuth in (20.0, 60.0, 110.0, 160.0, 200.0, 250.0, 290.0, 340.0):
+            elevs, azis = np.full((1, 1), elevation), np.full((1, 1), np.radians(azimuth))
+            marched = _ray_marched_shadow_mask(dem, elevation, np.radians(azimuth))
+            shadows = calc_shadow_mask(dem, spans, elevs, azis)
+            assert not shadows[~valid].any()
+            assert (shadows != marched)[valid].mean() < 0.015
+
+
+def test_shadow_mask_matches_calc_shadow_mask():
+    dem = _terrain()
+    valid = dem != -32768
+    spans = dem_spans(dem)
+    for altitude in (3.0, 10.0, 30.0):
+        for azimuth in (0.0, 30.0, 90.0, 135.0, 200.0, 270.0, 315.0):
+            elevs, azis = np.full((1, 1), np.radians(altitude)), np.full((1, 1), np.radians(azimuth))
+            shadows = shadow_mask(altitude, azimuth, dem)
+            assert np.array_equal(shadows == 1, calc_shadow_mask(dem, spans, elevs, azis))
+            assert (shadows[valid & (shadows != 1)] == -32768).all() and (shadows[~valid] == -32768).all()
+
+
+def test_shadow_mask_below_horizon():
+    dem = _dem()
+    valid = dem != -32768
+    for altitude in (-5.0, 0.0):
+        shadows = shadow_mask(altitude, 135.0, dem)
+        assert (shadows[valid] == 1).all()
+        assert (shadows[~valid] == -32768).all()
+
+    # Not the sun at 355 degrees, high in the sky.
+    assert (shadow_mask(-5.0, 135.0, dem) != shadow_mask(355.0, 135.0, dem))[valid].any()
+
+
+def test_shadow_mask_wraps_azimuth():
+    dem = _dem()
+    assert np.array_equal(shadow_mask(20.0, 495.0, dem), shadow_mask(20.0, 135.0, dem))
+    assert np.array_equal(shadow_mask(20.0, -45.0, dem), shadow_mask(20.0, 315.0, dem))
+
+
+def test_calc_shadow_mask_below_horizon():
+    dem = _dem()
+    valid = dem != -32768
+    shadows = calc_shadow_mask(dem, dem_spans(dem), np.full((1, 1), np.radians(-5)), np.full((1, 1), 2.0))
+    assert shadows[valid].all()
+    assert not shadows[~valid].any()
+
+
+def _write_dem(path, dem):
+    profile = {
+        'driver': 'GTiff', 'height': dem.shape[0], 'width': dem.shape[1], 'count': 1, 'dtype': 'int16',
+        'nodata': -32768, 'crs': 'EPSG:4326', 'transform': Affine(1/3600, 0, 3, 0, -1/3600, 10)
+    }
+    with rio.open(path, 'w', **profile) as dataset:
+        dataset.write(dem, 1)
+
+
+def _bordered_dem():
+    # Hills with a border without data wider than the longest shadow at 20
+    # degrees.
+    rng = np.random.default_rng(2)
+    x, y = np.ogrid[:300, :400]
+    dem = (250 + 120*np.sin(x/13)*np.cos(y/21) + rng.integers(0, 30, (300, 400))).astype(np.int16)
+    dem[:40], dem[-40:], dem[:, :40], dem[:, -40:] = -32768, -32768, -32768, -32768
+    return dem
+
+
+def test_shadow_mask_windows_below_horizon(tmp_path):
+    dem = _dem()
+    _write_dem(tmp_path / 'dem.tif', dem)
+    with rio.open(tmp_path / 'dem.tif') as elevation:
+        shadow_mask_windows(elevation, tmp_path / 'shadows.tif', -5.0, 135.0, max_memory=2**20)
+    with rio.open(tmp_path / 'shadows.tif') as shadows:
+        assert np.array_equal(shadows.read(1), shadow_mask(-5.0, 135.0, dem))
+
+
+def test_shadow_mask_windows_match_shadow_mask(tmp_path):
+    # Windows cut at 2**21 bytes, on the lines of the whole raster, also
+    # where the rays leave it.
+    bordered = _bordered_dem()
+    for dem in (bordered, bordered[40:-40, 40:-40]):
+        _write_dem(tmp_path / 'dem.tif', dem)
+        with rio.open(tmp_path / 'dem.tif') as elevation:
+            for azimuth in (0.0, 75.0, 135.0, 200.0, 290.0):
+                expected = shadow_mask(20.0, azimuth, dem, n_tiles=1)
+                assert (expected == 1).any()
+                shadow_mask_windows(
+                    elevation, tmp_path / 'shadows.tif', 20.0, azimuth, max_memory=2**21, n_tiles=32
+                )
+                with rio.open(tmp_path / 'shadows.tif') as shadows:
+                    assert np.array_equal(shadows.read(1), expected)
+
+
+def _cell_maxima(dem, level, row_off, col_off):
+    # Highest altitude in every cell of a level, one cell at a time.
+    side = 2**level
+    rows = range(row_off >> level, ((row_off + dem.shape[0] - 1) >> level) + 1)
+    cols = range(col_off >> level, ((col_off + dem.shape[1] - 1) >> level) + 1)
+    maxima = np.empty((len(rows), len(cols)), dtype=np.int16)
+    for i, row in enumerate(rows):
+        for j, col in enumerate(cols):
+            x0, y0 = max(row*side - row_off, 0), max(col*side - col_off, 0)
+            maxima[i, j] = dem[x0:(row+1)*side - row_off, y0:(col+1)*side - col_off].max()
+    return maxima
+
+
+def _levels(pyramid):
+    maxima, offsets, shapes = pyramid
+    return [maxima[offsets[n]:offsets[n+1]].reshape(shapes[n]) for n in range(len(shapes))]
+
+
+def test_max_pyramid_cells():
+    # Aligned to a raster the DEM is a window of, also one starting before
+    # the first row and column of the raster.
+    dem = _terrain()
+    for row_off, col_off in ((0, 0), (5, 3), (-7, 9), (-3, -21)):
+        levels = _levels(max_pyramid(dem, 5, row_off, col_off))
+        assert len(levels) == 5
+        for level, maxima in enumerate(levels, 1):
+            assert np.array_equal(maxima, _cell_maxima(dem, level, row_off, col_off))
+
+
+def test_max_pyramid_rasters_next_to_the_dem(tmp_path):
+    dem = _terrain()
+    _write_dem(tmp_path / 'dem.tif', dem)
+    with rio.open(tmp_path / 'dem.tif') as elevation:
+        pyramid = max_pyramid_rasters(elevation, 4, max_memory=2**12)
+        paths = [tmp_path / f'dem_max_{2**level}.tif' for level in range(1, 5)]
+        assert [Path(level.name) for level in pyramid] == paths
+        for level, maxima in zip(pyramid, _levels(max_pyramid(dem, 4))):
+            assert np.array_equal(level.read(1), maxima)
+
+        # Reused while the DEM is unchanged.
+        modified = [path.stat().st_mtime_ns for path in paths]
+        pyramid = max_pyramid_rasters(elevation, 4)
+        assert [path.stat().st_mtime_ns for path in paths] == modified
+
+        # The levels of a window reach past the edges of the raster, and
+        # hold at least the maxima of the window padded with nodata.
+        padded = np.pad(dem, 32, constant_values=-32768)
+        for row_off, col_off, height, width in ((-20, -20, 60, 70), (50, 90, 60, 50), (0, 0, 90, 120)):
+            window = padded[row_off+32:row_off+32+height, col_off+32:col_off+32+width]
+            levels = _levels(_read_pyramid(pyramid, row_off, col_off, height, width))
+            for level, expected in zip(levels, _levels(max_pyramid(window, 4, row_off, col_off))):
+                assert level.shape == expected.shape and (level >= expected).all()
+        assert all(
+            np.array_equal(level, expected)
+            for level, expected in zip(_levels(_read_pyramid(pyramid, 0, 0, 90, 120)), _levels(max_pyramid(dem, 4)))
+        )
+
+
+def test_terrain_rasters_rebuilt_when_the_dem_changes(tmp_path):
+    # Reused while the DEM is unchanged, and rebuilt when its contents
+    # change on the same grid.
+    dem = _terrain()
+    _write_dem(tmp_path / 'dem.tif', dem)
+    builders = [
+        lambda elevation: slope_aspect_rasters(elevation, tmp_path / 'terrain'),
+        lambda elevation: [horizon_rasters(elevation, tmp_path / 'terrain', 8)],
+        lambda elevation: [sky_view_factor_raster(elevation, tmp_path / 'terrain', 8)],
+        lambda elevation: max_pyramid_rasters(elevation, 3)
+    ]
+    with rio.open(tmp_path / 'dem.tif') as elevation:
+        built = [[raster.read() for raster in build(elevation)] for build in builders]
+        paths = sorted((tmp_path / 'terrain').glob('*.tif')) + sorted(tmp_path.glob('dem_max_*.tif'))
+        modified = [path.stat().st_mtime_ns for path in paths]
+        reused = [[raster.read() for raster in build(elevation)] for build in builders]
+        assert [path.stat().st_mtime_ns for path in paths] == modified
+        assert all(np.array_equal(a, b) for rasters, again in zip(built, reused) for a, b in zip(rasters, again))
+
+    _write_dem(tmp_path / 'dem.tif', np.flip(dem, axis=1))
+    with rio.open(tmp_path / 'dem.tif') as elevation:
+        rebuilt = [[raster.read() for raster in build(elevation)] for build in builders]
+    assert all(path.stat().st_mtime_ns != before for path, before in zip(paths, modified))
+    assert all(not np.array_equal(a, b) for rasters, again in zip(built, rebuilt) for a, b in zip(rasters, again))
+
+
+def test_horizons_of_flat_terrain(tmp_path):
+    dem = np.full((50, 60), 250, dtype=np.int16)
+    dem[:, :4] = -32768
+    horizons = horizon_angles(dem, 16)
+    assert (horizons[:, :, 4:] == 0).all() and (horizons[:, :, :4] == -32768).all()
+    elevs, azis = np.full((2, 2), 0.05), np.full((2, 2), 2.0)
+    assert not horizon_shadow_mask(horizons, elevs, azis).any()
+
+    _write_dem(tmp_path / 'dem.tif', dem)
+    with rio.open(tmp_path / 'dem.tif') as elevation, horizon_rasters(elevation, tmp_path, 16) as raster:
+        assert np.array_equal(raster.read(), horizons)
+
+
+def test_horizons_of_a_ridge():
+    # A ridge along a row casts the horizon atan(height cos(azimuth) /
+    # distance) on the pixels south of it, toward the azimuths within 45
+    # degrees of north, and none toward the south.
+    dem = np.full((80, 60), 100, dtype=np.int16)
+    dem[20] = 400
+    horizons = horizon_angles(dem, 16) / HORIZON_SCALE
+    distances = 30*np.arange(1, 26)
+    for sector in (14, 15, 0, 1, 2):
+        expected = np.arctan(300*np.cos(2*np.pi*sector/16) / distances)
+        assert np.abs(horizons[sector, 21:46, 30] - expected).max() < 1e-4
+    assert (horizons[8, 21:, :] == 0).all()
+
+
+def test_horizon_shadow_mask_matches_calc_shadow_mask():
+    # At the azimuths of the sectors, the two sweeps only differ where the
+    # lines toward the sun are a fraction of a pixel apart, on less than 2%
+    # of the pixels.
+    dem = _ridges()
+    valid = dem != -32768
+    spans = dem_spans(dem)
+    horizons = horizon_angles(dem, 16, HORIZON_MIN_ELEVATION)
+    for elevation in (0.1, 0.2, 0.4):
+        for sector in range(16):
+            elevs, azis = np.full((1, 1), elevation), np.full((1, 1), 2*np.pi*sector/16)
+            shadows = horizon_shadow_mask(horizons, elevs, azis)
+            assert (shadows != calc_shadow_mask(dem, spans, elevs, azis))[valid].mean() < 0.02
+
+
+def test_sky_view_factor_of_flat_terrain_and_nodata(tmp_path):
+    dem = np.full((50, 60), 250, dtype=np.int16)
+    dem[:, :4] = -32768
+    dem[30:33, 40:45] = -32768
+    valid = dem != -32768
+    svf = sky_view_factor(horizon_angles(dem, 32))
+    assert (svf[valid] == 1).all() and (svf[~valid] == -32768).all()
+
+    _write_dem(tmp_path / 'dem.tif', dem)
+    with rio.open(tmp_path / 'dem.tif') as elevation, sky_view_factor_raster(elevation, tmp_path, 32) as raster:
+        assert np.array_equal(raster.read(1), svf)
+
+
+def test_sky_view_factor_of_a_trench():
+    # Between the walls of a trench of depth h at distances a and b, the
+    # horizon toward an azimuth t off its axis is atan(h |sin(t)| / a), and
+    # the factor (1/sqrt(1 + (h/a)**2) + 1/sqrt(1 + (h/b)**2)) / 2. Away
+    # from the axis the 32 sectors resolve the nearer wall less finely.
+    for half_width, depth in ((5, 200), (10, 300), (20, 600)):
+        dem = np.full((400, 200), 1000 + depth, dtype=np.int16)
+        dem[:, 100-half_width:101+half_width] = 1000
+        svf = sky_view_factor(horizon_angles(dem, 32))[200, 100-half_width:101+half_width]
+        nearer = 30*np.arange(1, 2*half_width + 2)
+        expected = (1/np.sqrt(1 + (depth/nearer)**2) + 1/np.sqrt(1 + (depth/nearer[::-1])**2)) / 2
+        assert abs(svf[half_width] - expected[half_width]) < 2e-3
+        assert np.abs(svf - expected).max() < 0.02
+
+
+def _planes():
+    # Planes rising 3 m a 30 m pixel away from the north, east, south and
+    # west, so facing those azimuths, with a hole without data.
+    x, y = np.mgrid[:40, :50]
+    planes = {0.0: 3*x, np.pi/2: 3*(49 - y), np.pi: 3*(39 - x), 3*np.pi/2: 3*y}
+    for aspect, plane in planes.items():
+        dem = (500 + plane).astype(np.int16)
+        dem[20:23, 30:32] = -32768
+        yield aspect, dem
+
+
+def test_slope_aspect_of_planes():
+    # Inside, the stencil sees the whole plane, and along the edges across
+    # the slope half of it. At the corners and around the hole it sees a
+    # skewed part, which only bounds the slope.
+    for aspect, dem in _planes():
+        valid = dem != -32768
+        slopes, aspects = slope_aspect(dem, np.full(dem.shape[0], 30.0), 30.0)
+        assert (slopes[~valid] == -32768).all() and (aspects[~valid] == -32768).all()
+
+        skewed = np.zeros(dem.shape, dtype=np.bool_)
+        skewed[19:24, 29:33] = True
+        skewed[[0, 0, -1, -1], [0, -1, 0, -1]] = True
+        facing = np.abs((aspects - aspect + np.pi) % (2*np.pi) - np.pi)
+        assert facing[valid & ~skewed].max() < 1e-6
+        inside = ~skewed
+        inside[[0, -1], :] = inside[:, [0, -1]] = False
+        assert np.allclose(slopes[inside], np.arctan(0.1), atol=1e-6)
+        edge = {0.0: slopes[-1, 1:-1], np.pi/2: slopes[1:-1, 0], np.pi: slopes[0, 1:-1], 3*np.pi/2: slopes[1:-1, -1]}
+        assert np.allclose(edge[aspect], np.arctan(0.05), atol=1e-6)
+        assert (slopes[valid] > 0).all() and (slopes[valid] <= np.arctan(0.1) + 1e-6).all()
+
+
+def test_slope_aspect_windows_match_in_memory(tmp_path):
+    # A DEM of several windows of one block, with nodata across their edges.
+    dem = _terrain()
+    dem = np.tile(dem, (8, 6))[:600, :560]
+    dem[250:262, :] = -32768
+    _write_dem(tmp_path / 'dem.tif', dem)
+    paths = [tmp_path / 'slope.tif', tmp_path / 'aspect.tif']
+    with rio.open(tmp_path / 'dem.tif') as elevation:
+        slope_aspect_windows(elevation, paths, max_memory=4*2**20)
+        _, lats = coordinate_axes(elevation.transform, elevation.height, elevation.width)
+    meters_per_degree = np.pi*6378000/180
+    dxs = meters_per_degree/3600*np.cos(np.radians(lats))
+    for path, expected in zip(paths, slope_aspect(dem, dxs, meters_per_degree/3600)):
+        with rio.open(path) as raster:
+            assert raster.block_shapes[0] == (256, 256)
+            assert np.allclose(raster.read(1), expected, rtol=1e-6)
@@ -0,0 +1,200 @@
+import numpy as np
+from rasterio.transform import Affine
+
+from src.spa import _sun_ephemeris_array, solar_position, topocentric_elevation_azimuth
+from src.utils import coordinate_axes
+from src.feature_engineering import lattice_indices, lattice_weights, bilinear, bilinear_angle,\
+    solar_position_array, solar_lattice_stepsize, daylight_times, sun_elevation_bound
+from src.feature_engineering._solar_position import SOLAR_TILE_SIZE
+
+
+def _interpolated(grid, rows, cols, n_rows, n_cols):
+    # Every pixel of a lattice grid, through lattice_weights and bilinear.
+    row_lower, row_weights = lattice_weights(rows, n_rows)
+    col_lower, col_weights = lattice_weights(cols, n_cols)
+    values = np.empty((n_rows, n_cols))
+    for x in range(n_rows):
+        for y in range(n_cols):
+            values[x, y] = bilinear(grid, row_lower[x], row_weights[x], col_lower[y], col_weights[y])
+    return values
+
+
+def test_bilinear_is_exact_on_a_plane():
+    n_rows, n_cols = 37, 53
+    rows, cols = lattice_indices(n_rows, 8), lattice_indices(n_cols, 8)
+    plane = lambda x, y: 5 + 3*x - 2*y
+    grid = plane(rows[:, None].astype(float), cols[None, :].astype(float))
+    expected = plane(*np.meshgrid(np.arange(n_rows), np.arange(n_cols), indexing='ij'))
+    assert np.allclose(_interpolated(grid, rows, cols, n_rows, n_cols), expected, atol=1e-4)
+
+
+def test_lattice_weights_hit_the_nodes():
+    rows = lattice_indices(37, 8)
+    lower, weights = lattice_weights(rows, 37)
+    assert list(rows) == [0, 8, 16, 24, 32, 36]
+    assert (rows[lower] <= np.arange(37)).all()
+    assert (weights[rows[:-1]] == 0).all() and weights[36] == 1
+    assert np.allclose(weights[[4, 20, 34]], [0.5, 0.5, 0.5])
+
+
+def test_bilinear_angle_wraps_across_north():
+    grid = np.radians([[350.0, 10.0], [350.0, 10.0]])
+    for wy, expected in ((0.5, 0.0), (0.25, 355.0), (0.75, 5.0)):
+        azimuth = np.degrees(bilinear_angle(grid, 0, 0.5, 0, wy))
+        assert 0 <= azimuth < 360
+        assert abs((azimuth - expected + 180) % 360 - 180) < 1e-9
+
+    # A plain bilinear of the same cell points south.
+    assert np.isclose(np.degrees(bilinear(grid, 0, 0.5, 0, 0.5)), 180.0)
+
+
+def test_solar_lattice_stepsize_bounds_the_error():
+    n_rows, n_cols = 120, 150
+    x, y = np.ogrid[:n_rows, :n_cols]
+    dem = (300 + 200*np.sin(x/20)*np.cos(y/30)).astype(np.int16)
+    lons, lats = coordinate_axes(Affine(1/120, 0, 3, 0, -1/120, 10), n_rows, n_cols)
+    hours = np.arange(6.0, 18.0, 1.5)
+    ephemerides = _sun_ephemeris_array(
+        np.full(len(hours), 2014), np.full(len(hours), 6), np.full(len(hours), 21), hours
+    )
+    max_error = 1e-4
+    stepsize, errors = solar_lattice_stepsize(ephemerides, lons, lats, dem, max_error=max_error)
+    assert 1 < stepsize < max(n_rows, n_cols)
+    assert errors['elevation'] <= max_error and errors['cos_aoi'] <= max_error
+
+    # The bound holds at every daylight pixel, not only at the cell centers
+    # it is measured at.
+    rows, cols = lattice_indices(n_rows, stepsize), lattice_indices(n_cols, stepsize)
+    elevations, _, _ = solar_position_array(ephemerides, lons, lats, dem, rows, cols)
+    reference, _, _ = solar_position_array(
+        ephemerides, lons, lats, dem, np.arange(n_rows), np.arange(n_cols)
+    )
+    for t in range(len(hours)):
+        interpolated = _interpolated(elevations[t], rows, cols, n_rows, n_cols)
+        day = reference[t] > 0
+        assert np.abs(interpolated - reference[t])[day].max() <= max_error
+
+    # A tighter bound needs a finer lattice.
+    finer, _ = solar_lattice_stepsize(ephemerides, lons, lats, dem, max_error=max_error/10)
+    assert finer < stepsize
+
+
+def _brute_force_events(lat, lon, year, month, day):
+    # Sunrise, transit and sunset of a site at sea level from solar_position
+    # sampled every minute of the UT day and bisected, NaN without one. The
+    # hour angle is zero, up to the parallax, where the sun crosses the
+    # meridian from east to west, to the south or the north of the zenith.
+    def elevation(hour):
+        return solar_position(lat, lon, 0.0, float(year), float(month), float(day), hour)[0]
+
+    def westward(hour):
+        return -np.sin(solar_position(lat, lon, 0.0, float(year), float(month), float(day), hour)[1])
+
+    def crossing(f, low, high):
+        # Where f turns positive between low and high.
+        for _ in range(40):
+            mid = (low + high)/2
+            if f(mid) > 0:
+                high = mid
+            else:
+                low = mid
+        return (low + high)/2
+
+    hours = np.arange(0, 24*60 + 1)/60
+    elevations = np.array([elevation(hour) for hour in hours])
+    westwards = np.array([westward(hour) for hour in hours])
+    events = [np.nan]*3
+    for i in range(len(hours) - 1):
+        if elevations[i] <= 0 < elevations[i+1]:
+            events[0] = crossing(elevation, hours[i], hours[i+1])
+        if westwards[i] <= 0 < westwards[i+1]:
+            events[1] = crossing(westward, hours[i], hours[i+1])
+        if elevations[i] > 0 >= elevations[i+1]:
+            events[2] = crossing(lambda hour: -elevation(hour), hours[i], hours[i+1])
+    return events
+
+
+def test_daylight_times_match_brute_force():
+    # Across Nigeria, and at 60 and 75 degrees north, where the sun does not
+    # set at the June solstice and does not rise at the December one.
+    lons, lats = np.array([3.0, 8.5, 14.0]), np.array([4.0, 9.0, 13.5, 60.0, 75.0])
+    dem = np.zeros((len(lats), len(lons)), dtype=np.int16)
+    dem[0, 0] = -32768
+    years, months, days = np.array([2014, 2014, 2014, 2015]), np.array([3, 6, 12, 9]), np.array([20, 21, 21, 23])
+    rows, cols = np.arange(len(lats)), np.arange(len(lons))
+    times = np.stack(daylight_times(years, months, days, lons, lats, dem, rows, cols))
+    assert np.isnan(times[:, :, 0, 0]).all()
+    assert np.isnan(times[[0, 2], 1, 4]).all() and np.isnan(times[[0, 2], 2, 4]).all()
+    for d in range(len(years)):
+        for x in range(len(lats)):
+            for y in range(len(lons)):
+                if dem[x, y] == -32768:
+                    continue
+                expected = _brute_force_events(lats[x], lons[y], years[d], months[d], days[d])
+                assert np.array_equal(np.isnan(times[:, d, x, y]), np.isnan(expected))
+                assert np.nanmax(np.abs(times[:, d, x, y] - expected)) < 0.1/60
+
+
+def _random_timestamps(rng, n_times):
+    hours = rng.uniform(0, 24, n_times)
+    return _sun_ephemeris_array(
+        rng.integers(1990, 2030, n_times), rng.integers(1, 13, n_times), rng.integers(1, 29, n_times), hours
+    )
+
+
+def test_sun_elevation_bound_holds_on_random_tiles():
+    # The bound is above the elevation of every sampled point of the tile at
+    # its highest altitude, the corners and edges included.
+    rng = np.random.default_rng(0)
+    ephemerides = _random_timestamps(rng, 500)
+    for sidereal_time, right_ascension, declination in ephemerides:
+        lon0, lat0 = rng.uniform(-np.pi, np.pi), rng.uniform(-1.4, 1.2)
+        lon1, lat1 = lon0 + rng.uniform(0, 0.5), lat0 + rng.uniform(0, 0.3)
+        max_height = rng.uniform(0, 4000)
+        bound = sun_elevation_bound(sidereal_time, right_ascension, declination, lon0, lon1, lat0, lat1, max_height)
+        lats, lons = np.meshgrid(np.linspace(lat0, lat1, 25), np.linspace(lon0, lon1, 25))
+        elevations = [
+            topocentric_elevation_azimuth(lat, lon, max_height, sidereal_time, right_ascension, declination)[0]
+            for lat, lon in zip(lats.ravel(), lons.ravel())
+        ]
+        assert max(elevations) <= bound
+
+
+def test_skipped_solar_tiles_hold_the_bound():
+    # A grid around the globe, so that some tiles are at night at every
+    # timestamp and some in the day.
+    rng = np.random.default_rng(1)
+    n_rows, n_cols = 150, 200
+    dem = rng.integers(0, 3000, (n_rows, n_cols)).astype(np.int16)
+    dem[:, :10] = -32768
+    lons, lats = np.linspace(-179, 179, n_cols), np.linspace(80, -80, n_rows)
+    ephemerides = _random_timestamps(rng, 6)
+    rows, cols = np.arange(n_rows), np.arange(n_cols)
+    elevations, azimuths, aois = solar_position_array(ephemerides, lons, lats, dem, rows, cols)
+    # The tile bounds in float32 radians, as the kernel passes them.
+    lon_rads = (np.pi*lons/180).astype(np.float32)
+    lat_rads = (np.pi*lats/180).astype(np.float32)
+
+    n_skipped = 0
+    for t, (sidereal_time, right_ascension, declination) in enumerate(ephemerides):
+        for x0 in range(0, n_rows, SOLAR_TILE_SIZE):
+            for y0 in range(0, n_cols, SOLAR_TILE_SIZE):
+                tile = (t, slice(x0, x0 + SOLAR_TILE_SIZE), slice(y0, y0 + SOLAR_TILE_SIZE))
+                x1, y1 = min(x0 + SOLAR_TILE_SIZE, n_rows), min(y0 + SOLAR_TILE_SIZE, n_cols)
+                bound = sun_elevation_bound(
+                    sidereal_time, right_ascension, declination, lon_rads[y0], lon_rads[y1-1],
+                    lat_rads[x1-1], lat_rads[x0], float(dem[x0:x1, y0:y1].max())
+                )
+                if bound > 0:
+                    assert (aois[tile] != np.float32(np.pi/2)).any()
+                    continue
+                n_skipped += 1
+                assert (elevations[tile] == np.float32(bound)).all()
+                assert (aois[tile] == np.float32(np.pi/2)).all()
+                for x, y in zip(rng.integers(x0, x1, 20), rng.integers(y0, y1, 20)):
+                    elevation, _ = topocentric_elevation_azimuth(
+                        np.radians(lats[x]), np.radians(lons[y]), max(float(dem[x, y]), 0.0),
+                        sidereal_time, right_ascension, declination
+                    )
+                    assert elevation <= bound
+    assert 0 < n_skipped < len(ephemerides)*3*4
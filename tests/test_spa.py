@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from src import spa
+from src.spa import _ephemeris_table, _sun_ephemeris_array, load_ephemeris_table, sun_ephemeris_array,\
+    universal_julian_date
+
+
+def _wrapped(angle):
+    return (angle + np.pi) % (2*np.pi) - np.pi
+
+
+def _timestamps(n_days, n_times):
+    # Random times over the first days of January 1980, where the table starts.
+    rng = np.random.default_rng(0)
+    days = rng.integers(1, n_days, n_times)
+    hours = rng.uniform(0, 24, n_times)
+    return np.full(n_times, 1980), np.ones(n_times, dtype=np.int64), days, hours
+
+
+def test_table_interpolation_matches_the_series(tmp_path, monkeypatch):
+    # The first days of the minute table, built as build_ephemeris_table does.
+    n_days = 4
+    table = np.empty((n_days*1440, 4), dtype=np.float32)
+    _ephemeris_table(table, np.full(n_days, 1980), np.ones(n_days, dtype=np.int64), np.arange(1, n_days+1))
+    np.save(tmp_path / 'sun.npy', table)
+    monkeypatch.setattr(spa, 'load_ephemeris_table', lambda: np.load(tmp_path / 'sun.npy', mmap_mode='r'))
+
+    years, months, days, hours = _timestamps(n_days, 500)
+    interpolated = sun_ephemeris_array(years, months, days, hours)
+    series = _sun_ephemeris_array(years, months, days, hours)
+    assert np.abs(_wrapped(interpolated - series)).max() < 3e-7
+
+    # Timestamps past the end of the table are evaluated.
+    years = np.full(len(years), 2014)
+    assert np.array_equal(sun_ephemeris_array(years, months, days, hours), _sun_ephemeris_array(years, months, days, hours))
+
+
+def test_missing_table_falls_back_to_the_series(tmp_path, monkeypatch):
+    path = tmp_path / 'missing.npy'
+    with pytest.warns(UserWarning, match='No ephemeris table'):
+        assert load_ephemeris_table(path) is None
+
+    monkeypatch.setattr(spa, 'load_ephemeris_table', lambda: load_ephemeris_table.__wrapped__(path))
+    years, months, days, hours = _timestamps(20, 50)
+    with pytest.warns(UserWarning, match='No ephemeris table'):
+        ephemerides = sun_ephemeris_array(years, months, days, hours)
+    assert np.array_equal(ephemerides, _sun_ephemeris_array(years, months, days, hours))
+
+
+def test_universal_julian_date_of_fractional_hours():
+    # Reference dates of Meeus, Astronomical Algorithms (1998). The
+    # minutes are part of the decimal hour and count once, an extra
+    # (hour - int(hour))/1440 would move 19:21 by 21 seconds.
+    assert universal_julian_date(2000, 1, 1, 12.0) == 2451545.0
+    for year, month, day, hour, julian_date in (
+        (1987, 4, 10, 19 + 21/60, 2446896.30625),
+        (1957, 10, 4, 0.81*24, 2436116.31),
+        (1988, 1, 27, 0.0, 2447187.5),
+        (2000, 1, 1, 12.5, 2451545.0 + 0.5/24)
+    ):
+        assert abs(universal_julian_date(year, month, day, hour) - julian_date) < 1e-7
@@ -0,0 +1,52 @@
+import numpy as np
+from rasterio.transform import from_origin, rowcol, xy
+
+from src.utils import grid_index_maps, l2_cache_size, cache_tile_size
+
+
+def _rowcol_maps(transform, height, width, grid_transform, grid_height, grid_width):
+    # Coarse cell of every pixel center by a direct lookup, clipped to the grid.
+    rows, cols = np.meshgrid(np.arange(height), np.arange(width), indexing='ij')
+    xs, ys = xy(transform, rows.ravel(), cols.ravel())
+    grid_rows, grid_cols = rowcol(grid_transform, xs, ys)
+    grid_rows = np.clip(np.reshape(grid_rows, (height, width)), 0, grid_height-1)
+    grid_cols = np.clip(np.reshape(grid_cols, (height, width)), 0, grid_width-1)
+    return grid_rows, grid_cols
+
+
+def test_grid_index_maps_match_rowcol():
+    # A 1 arc second DEM, and coarse grids offset from it by a fraction of a
+    # pixel, with cells that are not a whole number of pixels, and that end
+    # inside the DEM on every side.
+    transform = from_origin(3.0, 10.0, 1/3600, 1/3600)
+    height, width = 700, 900
+    grids = [
+        (from_origin(2.9, 10.1, 0.1, 0.1), 4, 5),
+        (from_origin(3.0123, 9.9871, 0.0173, 0.0217), 8, 11),
+        (from_origin(3.05, 9.95, 0.4, 0.4), 1, 1),
+    ]
+    for grid_transform, grid_height, grid_width in grids:
+        rows, cols = grid_index_maps(transform, height, width, grid_transform, grid_height, grid_width)
+        assert rows.shape == (height,) and cols.shape == (width,)
+        expected_rows, expected_cols = _rowcol_maps(
+            transform, height, width, grid_transform, grid_height, grid_width
+        )
+        assert np.array_equal(np.broadcast_to(rows[:, None], (height, width)), expected_rows)
+        assert np.array_equal(np.broadcast_to(cols[None, :], (height, width)), expected_cols)
+
+    # The second grid leaves pixels out on every side, which map to its edges.
+    rows, cols = grid_index_maps(transform, height, width, *grids[1])
+    assert rows[0] == 0 and rows[-1] == 7 and cols[0] == 0 and cols[-1] == 10
+    assert (rows == 0).sum() > 1 and (cols == 10).sum() > 1
+
+
+def test_l2_cache_size(monkeypatch):
+    monkeypatch.setenv('L2_CACHE_SIZE', '512K')
+    assert l2_cache_size() == 512*1024
+    monkeypatch.setenv('L2_CACHE_SIZE', '2097152')
+    assert l2_cache_size() == 2*1024**2
+    monkeypatch.delenv('L2_CACHE_SIZE')
+    assert l2_cache_size() > 0
+
+    # Tiles of a larger cache are as large or larger.
+    assert cache_tile_size(10, 512*1024) <= cache_tile_size(10, 2*1024**2)
@@ -0,0 +1,120 @@
+import json
+
+import geopandas as gpd
+import numpy as np
+import pytest
+from rasterio.features import geometry_mask, rasterize
+from rasterio.transform import from_origin
+from shapely.geometry import MultiPolygon, Point, Polygon, box, mapping
+
+from src.feature_engineering import _valid_pixels
+from src.feature_engineering import mask_spans, window_spans, polygon_spans, valid_spans
+
+
+def _mask(spans, height, width):
+    # Boolean mask of the pixels inside spans.
+    row_ptr, starts, stops = spans
+    mask = np.zeros((height, width), dtype=np.bool_)
+    for x in range(height):
+        for s in range(row_ptr[x], row_ptr[x+1]):
+            mask[x, starts[s]:stops[s]] = True
+    return mask
+
+
+def _random_mask():
+    # Blobs with holes, and rows that are empty or full.
+    rng = np.random.default_rng(0)
+    mask = rng.uniform(size=(50, 70)) < 0.6
+    mask[10] = False
+    mask[20] = True
+    mask[:, 0] = True
+    return mask
+
+
+def test_mask_spans_round_trip():
+    mask = _random_mask()
+    row_ptr, starts, stops = spans = mask_spans(mask)
+    assert np.array_equal(_mask(spans, *mask.shape), mask)
+
+    # Spans are maximal and in increasing column order.
+    assert (starts < stops).all()
+    for x in range(mask.shape[0]):
+        row_starts, row_stops = starts[row_ptr[x]:row_ptr[x+1]], stops[row_ptr[x]:row_ptr[x+1]]
+        assert (row_starts[1:] > row_stops[:-1]).all()
+
+
+def test_window_spans_slice_the_mask():
+    mask = _random_mask()
+    spans = mask_spans(mask)
+    for row_off, col_off, height, width in ((0, 0, 50, 70), (5, 3, 20, 30), (10, 60, 1, 10), (49, 0, 1, 70), (7, 33, 43, 1)):
+        window = window_spans(spans, row_off, col_off, height, width)
+        expected = mask[row_off:row_off+height, col_off:col_off+width]
+        assert np.array_equal(_mask(window, height, width), expected)
+
+
+def _random_polygon(rng, transform, height, width):
+    # A star-shaped polygon around a point in or near the grid, with a hole
+    # or a small second polygon every so often.
+    x, y = transform * (rng.uniform(-20, width+20), rng.uniform(-20, height+20))
+    radius = rng.uniform(10, 80)*transform.a
+    angles = np.sort(rng.uniform(0, 2*np.pi, 12))
+    radii = radius*rng.uniform(0.4, 1, 12)
+    shell = list(zip(x + radii*np.cos(angles), y + radii*np.sin(angles)))
+    hole = Point(x, y).buffer(0.2*radius).exterior.coords
+    polygon = Polygon(shell, [hole]) if rng.uniform() < 0.5 else Polygon(shell)
+    if rng.uniform() < 0.3:
+        other = Point(transform * (rng.uniform(0, width), rng.uniform(0, height))).buffer(4*transform.a)
+        if not polygon.intersects(other):
+            return MultiPolygon([polygon, other])
+    return polygon
+
+
+def test_polygon_spans_match_rasterize():
+    # One pass of rasterize over the whole grid, also for polygons that
+    # reach past its edges.
+    rng = np.random.default_rng(1)
+    transform, height, width = from_origin(2.6666666666666665, 13.9, 1/3600, 1/3600), 120, 150
+    for _ in range(60):
+        polygon = _random_polygon(rng, transform, height, width)
+        expected = rasterize([polygon], out_shape=(height, width), transform=transform, all_touched=True)
+        assert np.array_equal(_mask(polygon_spans(polygon, transform, height, width), height, width), expected == 1)
+
+
+def _write_polygon(path, bounds):
+    feature = {'type': 'Feature', 'properties': {}, 'geometry': mapping(box(*bounds))}
+    path.write_text(json.dumps({'type': 'FeatureCollection', 'features': [feature]}))
+
+
+def test_valid_spans_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(_valid_pixels, 'VALID_SPANS_DIRECTORY', tmp_path / 'spans')
+    shapefile = tmp_path / 'country.geojson'
+    transform, height, width = from_origin(3, 10, 0.01, 0.01), 60, 80
+    compute = valid_spans.__wrapped__
+
+    def expected(bounds, transform=transform):
+        return geometry_mask(
+            [box(*bounds)], out_shape=(height, width), transform=transform, all_touched=True, invert=True
+        )
+
+    # Rasterized, and saved.
+    bounds = (3.123, 9.6, 3.5, 9.87)
+    _write_polygon(shapefile, bounds)
+    spans = compute(transform, height, width, shapefile)
+    assert np.array_equal(_mask(spans, height, width), expected(bounds))
+    assert len(list((tmp_path / 'spans').iterdir())) == 1
+
+    # Read back from the disk, without the polygon.
+    with monkeypatch.context() as patch:
+        patch.setattr(gpd, 'read_file', pytest.fail)
+        cached = compute(transform, height, width, shapefile)
+    assert all(np.array_equal(a, b) for a, b in zip(spans, cached))
+
+    # A new polygon under the same name, and a new grid, are not read from the disk.
+    bounds = (3.2, 9.5, 3.7, 9.9)
+    _write_polygon(shapefile, bounds)
+    spans = compute(transform, height, width, shapefile)
+    assert np.array_equal(_mask(spans, height, width), expected(bounds))
+    shifted = from_origin(3.05, 10, 0.01, 0.01)
+    spans = compute(shifted, height, width, shapefile)
+    assert np.array_equal(_mask(spans, height, width), expected(bounds, shifted))
+    assert len(list((tmp_path / 'spans').iterdir())) == 3